@@ -0,0 +1,92 @@
+# プロセス全体で共有するコンパイル済みエージェントのレジストリ
+# セッションごとに create_agent_app を呼ぶ代わりに、(コーパスのハッシュ, システムプロンプト, 構成) ごとに
+# 1つのコンパイル済みアプリを共有し、参照カウントで使われなくなったものを追い出します。
+import hashlib
+import json
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def agent_key(corpus_key: str, system_prompt: str, **options) -> str:
+    """コーパス・システムプロンプト・グラフ構成の組み合わせに対するレジストリキーを返します。"""
+    payload = json.dumps({"prompt": system_prompt, **options}, ensure_ascii=False, sort_keys=True, default=str)
+    return f"{corpus_key}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]}"
+
+
+class AgentLease:
+    """レジストリから借りたエージェントへの参照。
+    release() するか、保持しているセッションがガベージコレクトされると参照カウントが減ります。
+    """
+
+    def __init__(self, registry: "AgentRegistry", key: str, app):
+        self.key = key
+        self.app = app
+        self._finalizer = weakref.finalize(self, registry._release, key)
+
+    def release(self) -> None:
+        """参照を返却します（複数回呼んでも1回だけ返却されます）。"""
+        self._finalizer()
+
+
+class AgentRegistry:
+    """キーごとに1つのコンパイル済みアプリを保持する、スレッドセーフなレジストリ。
+    参照カウントが0になったアプリはアイドル状態になり、max_idle 件を超えると古いものから破棄されます。
+    """
+
+    def __init__(self, max_idle: int = 2):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._apps: Dict[str, object] = {}
+        self._refcounts: Dict[str, int] = {}
+        self._idle: "OrderedDict[str, None]" = OrderedDict()
+        # 同じキーのアプリを複数セッションが同時に構築しないよう、キーごとに構築用のロックを持つ
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self.counters = {"builds": 0, "reuses": 0, "evictions": 0}
+
+    def lease(self, key: str, builder: Callable[[], object]) -> AgentLease:
+        """キーに対応するアプリを借ります。未構築の場合は builder() で構築します。"""
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                app = self._apps.get(key)
+            if app is None:
+                # 構築には時間がかかるため、レジストリ全体のロックは保持しない
+                app = builder()
+                with self._lock:
+                    self._apps[key] = app
+                    self.counters["builds"] += 1
+            else:
+                with self._lock:
+                    self.counters["reuses"] += 1
+            with self._lock:
+                self._refcounts[key] = self._refcounts.get(key, 0) + 1
+                self._idle.pop(key, None)
+        return AgentLease(self, key, app)
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            if key not in self._refcounts:
+                return
+            self._refcounts[key] -= 1
+            if self._refcounts[key] > 0:
+                return
+            del self._refcounts[key]
+            self._idle[key] = None
+            while len(self._idle) > self.max_idle:
+                evicted, _ = self._idle.popitem(last=False)
+                self._apps.pop(evicted, None)
+                self._build_locks.pop(evicted, None)
+                self.counters["evictions"] += 1
+                logger.debug("使用されていないエージェントを破棄しました: %s", evicted)
+
+    def stats(self) -> Dict[str, int]:
+        """保持しているアプリ数・参照数・構築/再利用/破棄の回数を返します。"""
+        with self._lock:
+            return {"apps": len(self._apps), "active": len(self._refcounts), "idle": len(self._idle),
+                    "leases": sum(self._refcounts.values()), **self.counters}
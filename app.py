@@ -1,21 +1,36 @@
 import os
-import sys
-import importlib.util
-import importlib.machinery
 import json
+import asyncio
+import logging
+import uuid
+import itertools
 import pandas as pd # Keep pandas import for potential future use or context
 from typing import TypedDict, List, Annotated
-import operator
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
-from langchain_core.tools import tool
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.tools import StructuredTool, tool
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 from dotenv import load_dotenv
+from category_classifier import create_category_classifier
+from conversation_memory import (HISTORY_TOKEN_BUDGET, SUMMARY_TEMPLATE, append_turn, build_summary_prompt,
+                                 clip_summary, fallback_summary, format_conversation, split_history)
+from direct_answer import DirectAnswerPolicy
+from faq_loader import load_faq_data
+from instrumentation import default_metrics
+from llm_provider import LLMProvider, create_llm_provider_from_env
+from logging_setup import payload_logger
+from prompt_templates import CorpusPrompts
+from relevance_parsing import FUSED_RESPONSE_SCHEMA, RELEVANCE_RESPONSE_SCHEMA, parse_fused_response, parse_relevance_response
+from retrieval import RetrievalEngine, create_retrieval_engine
 
 load_dotenv(verbose=True)
 
-print("[DEBUG] 必要なモジュールをインポートしました")
+# ログの出力先はエントリーポイント（ui_app.py / server.py / benchmark.py）で設定します（logging_setup.configure_logging を参照）
+logger = logging.getLogger(__name__)
+# 状態全体・プロンプト・LLMの生の応答などの大きなペイロード（LOG_PAYLOAD_SAMPLE_RATE の割合だけ出力）
+payload_log = payload_logger(__name__)
+
+logger.debug("必要なモジュールをインポートしました")
 
 # 環境変数にAPIキーを設定 (リポジトリに直接記述しない)
 # ローカルでの開発時には、ターミナルで環境変数を設定するか、.env ファイル + python-dotenv を使用してください。
@@ -23,7 +38,7 @@ print("[DEBUG] 必要なモジュールをインポートしました")
 # Streamlit Cloudなどのデプロイ環境では、各サービスのシークレット管理機能を利用してください。
 google_api_key = os.getenv("GOOGLE_API_KEY")
 if not google_api_key:
-    print("[ERROR] 環境変数 GOOGLE_API_KEY が設定されていません。有効なAPIキーを設定してください。")
+    logger.error("環境変数 GOOGLE_API_KEY が設定されていません。有効なAPIキーを設定してください。")
     # 環境変数が設定されていない場合、アプリケーションが正常に動作しない可能性が高いです。
     # ここでsys.exitなどでプログラムを終了させることも検討できますが、
     # Streamlitの実行モデルに合わせ、ここではエラーメッセージ出力に留めます。
@@ -31,297 +46,754 @@ if not google_api_key:
 else:
     # LangChainが参照するためにos.environに設定
     os.environ["GOOGLE_API_KEY"] = google_api_key
-    print("[DEBUG] 環境変数GOOGLE_API_KEYを読み込みました")
+    logger.debug("環境変数GOOGLE_API_KEYを読み込みました")
 
-# PythonファイルからFAQデータ辞書を読み込む関数
+# FAQデータ辞書を読み込む関数
 def load_faq_data_from_py(file_path: str) -> dict | None:
-    """PythonファイルからFAQデータ辞書をロードします。
-    ファイルは辞書形式の変数（'_JSON'で終わる名前を想定）を含んでいる必要があります。
+    """FAQデータファイルから辞書をロードします。
+    拡張子に応じて faq_loader に登録されたローダーを使用します（.json / .jsonl / .parquet / .arrow / .py）。
+    .py ファイルは辞書形式の変数（'_JSON'で終わる名前を想定）を含んでいる必要があります。
     """
-    print(f"[DEBUG] load_faq_data_from_pyが呼び出されました: {file_path}")
-    
-    if not os.path.exists(file_path):
-        print(f"[DEBUG] エラー: ドキュメントファイルが見つかりません: {file_path}")
-        return None
-
-    try:
-        # ファイルのディレクトリを取得し、sys.pathに一時的に追加してインポート可能にする
-        file_dir = os.path.dirname(file_path)
-        module_name = os.path.splitext(os.path.basename(file_path))[0]
-        print(f"[DEBUG] モジュール名: {module_name}")
-
-        # sys.pathに一時的に追加
-        sys.path.insert(0, file_dir)
-        print(f"[DEBUG] sys.pathに追加: {file_dir}")
-
-        # モジュールをインポート
-        spec = importlib.util.spec_from_file_location(module_name, file_path)
-        if spec is None:
-            print(f"[DEBUG] エラー: Specを作成できませんでした: {file_path}")
-            sys.path.pop(0) # パスを削除
-            return None
-            
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module
-        spec.loader.exec_module(module)
-        print(f"[DEBUG] モジュールをインポートしました: {module_name}")
-
-        # '_JSON'で終わる名前の辞書形式の変数を探す
-        data_variable = None
-        for var_name in dir(module):
-            if var_name.endswith('_JSON') and isinstance(getattr(module, var_name), dict):
-                data_variable = getattr(module, var_name)
-                print(f"[DEBUG] データ変数を見つけました: {var_name}")
-                break
-
-        # 一時的に追加したパスをsys.pathから削除
-        sys.path.pop(0)
-        print("[DEBUG] sys.pathから一時パスを削除しました")
-
-        if data_variable and 'data' in data_variable and 'metadata' in data_variable:
-            print(f"[DEBUG] ドキュメント '{file_path}' を正常に読み込みました")
-            return data_variable
-        else:
-            print(f"[DEBUG] エラー: ドキュメントファイル '{file_path}' から必要なデータが見つかりません")
-            return None
+    return load_faq_data(file_path)
 
-    except Exception as e:
-        print(f"[DEBUG] エラー: ドキュメント '{file_path}' の読み込み中に予期せぬエラーが発生しました: {e}")
-        return None
+def add_turn_messages(current: List[BaseMessage], update: List[BaseMessage]) -> List[BaseMessage]:
+    """messages チャネルのリデューサー。ノードの出力は現在のターンのメッセージに追加します。
+    HumanMessage で始まる更新（グラフへの新しいターンの入力）を受け取った場合は、前のターンのメッセージを置き換えます。
+    チェックポインターで会話を引き継いでも、messages は1ターン分のメッセージだけを保持します（過去のターンは history / summary）。
+    """
+    if update and isinstance(update[0], HumanMessage):
+        return list(update)
+    return current + update
 
 # エージェントの状態を定義
 class AgentState(TypedDict):
-    messages: Annotated[List[BaseMessage], operator.add]
+    messages: Annotated[List[BaseMessage], add_turn_messages] # 現在のターンのメッセージ
     predicted_category: str
+    history: List[BaseMessage] # トークン予算内の直近の会話（conversation_memory.split_history を参照）
+    summary: str # 直近の会話からあふれた古いターンの要約
+
+logger.debug("AgentStateクラスを定義しました")
+
+# LLMプロバイダー（環境変数 LLM_PROVIDER で gemini / fake / cassette を切り替え）
+# create_agent_app に llm_provider を渡さない場合はこのプロバイダーのモデルを使用します。
+# Gemini のモデルは最初に使用されたときに作成されます（GOOGLE_API_KEY環境変数が必要です）。
+default_llm_provider = create_llm_provider_from_env()
+logger.debug("LLMプロバイダーを初期化しました: %s", default_llm_provider.name)
+
+# 検索エンジン（BM25/埋め込み）による事前絞り込みの設定
+LEXICAL_TOP_K = 20 # LLMに評価させる候補の最大件数
+RELEVANCE_THRESHOLD = 70 # 関連度閾値
+
+# 関連度評価の分割と並列実行の設定
+RELEVANCE_CHUNK_SIZE = 20 # 1回のLLM呼び出しで評価する候補の最大件数（超える場合は分割して並列に評価する）
+RELEVANCE_PARALLELISM = 4 # 1回の検索で同時に実行する分割評価のLLM呼び出し数
+RELEVANCE_PARSE_RETRIES = 1 # 関連度評価の応答から結果を取り出せない場合に、同じプロンプトで再評価する最大回数
+
+# ローカルのカテゴリー分類器を使う場合の推奨の閾値（create_agent_app の local_classifier_threshold に指定する。既定では使わない）
+# 確信度がこの値以上であれば、LLMによるカテゴリー分類を省略する
+LOCAL_CLASSIFIER_THRESHOLD = 0.7
+
+# create_agent_app で選択できるグラフ構成
+# classic: 分類 → ツール選択（LLM） → ツール実行 → 最終応答
+# fast: 分類 → 検索ツールを直接実行 → 最終応答（fuse_classification=True で分類と関連度評価を1回のLLM呼び出しに統合）
+PIPELINES = ("classic", "fast")
+
+
+def parse_json_response(response_text: str) -> dict:
+    """LLMの応答からマークダウンのコードブロック記号を取り除き、JSONとしてパースします。"""
+    # 応答に不要なマークダウンが含まれている場合を考慮してクリーンアップを試みる
+    response_text_cleaned = response_text.replace("```json", "").replace("```", "").strip()
+    payload_log.debug("クリーンアップ後の評価応答:\n%s", response_text_cleaned)
+    return json.loads(response_text_cleaned)
+
+
+def select_answer(candidate_rows: List[dict], most_relevant_index, max_relevance_score) -> str:
+    """LLMの評価結果（QA_PAIR_NのNと関連度スコア）から、ユーザーに返す回答を決定します。"""
+    # 最も関連性の高いQAペアのインデックスが有効かつ閾値以上のスコアの場合
+    if isinstance(most_relevant_index, int) and 1 <= most_relevant_index <= len(candidate_rows):
+        if max_relevance_score >= RELEVANCE_THRESHOLD:
+            logger.debug("閾値(%s)以上の関連度(%s)で回答候補を見つけました。", RELEVANCE_THRESHOLD, max_relevance_score)
+            # '回答例' キーが存在することを確認して回答を取得
+            return candidate_rows[most_relevant_index - 1].get('回答例', '回答が見つかりませんでした。')
+        logger.debug("最大関連度スコア(%s)が閾値(%s)未満です。", max_relevance_score, RELEVANCE_THRESHOLD)
+        return "申し訳ございません、お探しの情報は見つかりませんでした。別の言葉でお試しいただくか、より詳細な情報をお知らせください。"
+    logger.debug("LLMから適切な most_relevant_index (%s) が得られませんでした（範囲外またはNone）。", most_relevant_index)
+    return "申し訳ございません、LLMが適切なQAペアを特定できませんでした。別の言葉でお試しください。"
+
+
+def candidate_summary(row: dict, score) -> dict:
+    """検索結果の候補として返すQAの行と関連度スコア（LLMで評価していない場合は None）。"""
+    return {"カテゴリー": row.get("カテゴリー"), "質問": row.get("質問"), "回答例": row.get("回答例"), "score": score}
+
+
+def relevance_ranking(candidate_rows: List[dict], result: dict | None) -> List[dict]:
+    """関連度評価の結果（parse_relevance_response の戻り値）から、評価した候補のリスト（最も関連性の高い1件）を返します。"""
+    if result is None or not 1 <= result["index"] <= len(candidate_rows):
+        return []
+    return [candidate_summary(candidate_rows[result["index"] - 1], result["score"])]
+
+
+def merge_chunk_evaluations(responses: List, chunk_size: int) -> str:
+    """分割して評価した各チャンクの応答を、全候補に対する1回の評価と同じ形式のJSONテキストにまとめます。
+    インデックスはチャンク内の番号から全候補での番号に付け替え、関連度スコアが最も高いチャンクの結果を採用します。
+    結果を取り出せない応答（または例外）のチャンクは除外し、すべて失敗した場合は最初の応答をそのまま返します
+    （すべて例外の場合は最初の例外を送出します）。
+    """
+    best = None
+    for position, response in enumerate(responses):
+        if isinstance(response, Exception):
+            logger.warning("チャンク%dの関連度評価に失敗しました: %s", position + 1, response)
+            continue
+        result, _ = parse_relevance_response(response)
+        if result is None:
+            logger.warning("チャンク%dの応答から関連度評価の結果を読み取れませんでした", position + 1)
+            continue
+        if best is None or result["score"] > best["score"]:
+            best = {"index": result["index"] + position * chunk_size, "score": result["score"]}
+    if best is None:
+        first_text = next((response for response in responses if not isinstance(response, Exception)), None)
+        if first_text is None:
+            raise responses[0]
+        return first_text
+    return json.dumps(best)
+
+
+def direct_tool_call(tool_name: str, tool_args: dict) -> dict:
+    """LLMを介さずに実行するツール呼び出し（ToolCall）を作成します。"""
+    return {"name": tool_name, "args": tool_args, "id": f"direct_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+
+
+def direct_tool_messages(tool_name: str, tool_args: dict, tool_result: str, artifact=None) -> List[BaseMessage]:
+    """LLMを介さずにツールを実行した結果を、classic構成と同じ (ToolCall付きAIMessage, ToolMessage) の形で返します。"""
+    tool_call = direct_tool_call(tool_name, tool_args)
+    return [
+        AIMessage(content="", tool_calls=[tool_call]),
+        ToolMessage(content=tool_result, name=tool_name, tool_call_id=tool_call["id"], artifact=artifact),
+    ]
+
+def format_qa_block(candidate_rows: List[dict], tag_categories: bool = False) -> str:
+    """関連度評価プロンプトに埋め込む候補の一覧（QA_PAIR_N 形式）を返します。tag_categories=True では各候補にカテゴリーを付けます。"""
+    return "\n".join(
+        f"QA_PAIR_{idx+1}: " + (f"[{item.get('カテゴリー')}] " if tag_categories else "") + f"質問: {item['質問']}"
+        for idx, item in enumerate(candidate_rows)
+    )
+
+
+def message_text(message: BaseMessage) -> str:
+    """メッセージ（またはチャンク）の本文をテキストとして返します。"""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    # モデルによっては本文がパートのリストで返されるため、テキスト部分だけを連結する
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+
+
+def stream_llm_text(model, prompt) -> tuple[str, str | None]:
+    """llm.stream で応答を生成し、(全文, メッセージID) を返します。
+    グラフを stream_mode="messages" で実行している場合、各チャンクはトークンとして呼び出し元に送出されます。
+    """
+    full_message = None
+    for chunk in model.stream(prompt):
+        full_message = chunk if full_message is None else full_message + chunk
+    if full_message is None:
+        return "", None
+    return message_text(full_message), full_message.id
+
+
+async def astream_llm_text(model, prompt) -> tuple[str, str | None]:
+    """stream_llm_text の非同期版です（llm.astream を使用します）。"""
+    full_message = None
+    async for chunk in model.astream(prompt):
+        full_message = chunk if full_message is None else full_message + chunk
+    if full_message is None:
+        return "", None
+    return message_text(full_message), full_message.id
+
+
+# トークン単位でUIにストリーミングするノード
+STREAMED_NODE = "generate_final_response"
+
+
+class _AgentEventCollector:
+    """stream_mode=["updates", "messages"] のチャンクを (種類, 内容) のイベントに変換します。"""
+
+    def __init__(self):
+        self.final_message = None
+        self.streamed_any_token = False
+
+    def feed(self, mode: str, chunk) -> List[tuple]:
+        events = []
+        if mode == "messages":
+            message_chunk, metadata = chunk
+            if metadata.get("langgraph_node") == STREAMED_NODE and isinstance(message_chunk, AIMessageChunk):
+                text = message_text(message_chunk)
+                if text:
+                    self.streamed_any_token = True
+                    events.append(("token", text))
+        else:
+            for node_name, update in chunk.items():
+                events.append(("progress", node_name))
+                if node_name == STREAMED_NODE and isinstance(update, dict) and update.get("messages"):
+                    self.final_message = update["messages"][-1]
+        return events
+
+    def finish(self) -> List[tuple]:
+        events = []
+        if self.final_message is not None and not self.streamed_any_token:
+            # ストリーミングに対応していないモデルの場合は、最終応答をまとめて1トークンとして返す
+            events.append(("token", message_text(self.final_message)))
+        events.append(("final", self.final_message))
+        return events
+
+
+def stream_agent_events(agent_app, inputs: dict, config: dict | None = None):
+    """グラフをストリーミング実行し、イベントを順に返すジェネレーター。
+    ("progress", ノード名): ノードの実行が完了した
+    ("token", テキスト): 最終応答のトークン
+    ("final", AIMessage | None): 最終応答のメッセージ（グラフ終了時に1回だけ）
+    """
+    collector = _AgentEventCollector()
+    for mode, chunk in agent_app.stream(inputs, config, stream_mode=["updates", "messages"]):
+        yield from collector.feed(mode, chunk)
+    yield from collector.finish()
 
-print("[DEBUG] AgentStateクラスを定義しました")
 
-# LLMインスタンス
-# GOOGLE_API_KEY環境変数が設定されていない場合、ここでエラーが発生する可能性があります。
-llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.2)
-relevance_scorer_llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0)
-print("[DEBUG] LLMインスタンスを初期化しました")
+async def astream_agent_events(agent_app, inputs: dict, config: dict | None = None):
+    """stream_agent_events の非同期版です。async_nodes=True で作成したアプリにはこちらを使用してください。"""
+    collector = _AgentEventCollector()
+    async for mode, chunk in agent_app.astream(inputs, config, stream_mode=["updates", "messages"]):
+        for event in collector.feed(mode, chunk):
+            yield event
+    for event in collector.finish():
+        yield event
 
-# LangGraphエージェントアプリを作成・コンパイルする関数
-def create_agent_app(qa_data: List[dict], categories: List[str], agent_identity: str, system_prompt: str) -> StateGraph:
-    """指定されたQAデータ、カテゴリー、アイデンティティ、システムプロンプトでLangGraphエージェントアプリを作成・コンパイルします。"""
-    print("[DEBUG] create_agent_appが呼び出されました")
-    print(f"[DEBUG] パラメータ: qa_data長={len(qa_data)}, categories={categories}, agent_identity={agent_identity}")
 
+async def ainvoke_agent(agent_app, question: str, config: dict | None = None) -> str:
+    """質問文を受け取り、最終応答のテキストを返す非同期エントリーポイント（ASGIサーバーなどから使用）。"""
+    result = await agent_app.ainvoke({"messages": [HumanMessage(content=question)]}, config)
+    return message_text(result["messages"][-1])
+
+
+# LangGraphエージェントアプリを作成・コンパイルする関数
+def create_agent_app(qa_data: List[dict], categories: List[str], agent_identity: str, system_prompt: str,
+                     lexical_top_k: int = LEXICAL_TOP_K, lexical_direct_answer: bool = False,
+                     retrieval_engine: str | RetrievalEngine = "bm25", index_cache_key: str | None = None,
+                     pipeline: str = "classic", fuse_classification: bool = False,
+                     async_nodes: bool = False, prefetch_categories: int = 2,
+                     relevance_batcher=None, llm_provider: LLMProvider | None = None,
+                     local_classifier_threshold: float | None = None,
+                     cross_category_fallback: bool = True, relevance_chunk_size: int = RELEVANCE_CHUNK_SIZE,
+                     relevance_parallelism: int = RELEVANCE_PARALLELISM,
+                     relevance_parse_retries: int = RELEVANCE_PARSE_RETRIES,
+                     history_token_budget: int | None = HISTORY_TOKEN_BUDGET, checkpointer=None,
+                     direct_answer: DirectAnswerPolicy | None = None) -> StateGraph:
+    """指定されたQAデータ、カテゴリー、アイデンティティ、システムプロンプトでLangGraphエージェントアプリを作成・コンパイルします。
+    lexical_top_k: 検索エンジンで絞り込んだ上位何件をLLMの関連度評価に渡すか。
+    lexical_direct_answer: Trueの場合、検索スコアが決定的であればLLMを呼ばずに回答を返します。
+    retrieval_engine: "bm25"（文字n-gram BM25）、"embedding"（埋め込み行列）、または RetrievalEngine インスタンス。
+    index_cache_key: 指定した場合、検索インデックスをディスクキャッシュから読み込みます（index_cache.corpus_cache_key を参照）。
+    pipeline: グラフ構成（PIPELINES を参照）。"fast" ではツール選択のためのLLM呼び出しを省略します。
+    fuse_classification: pipeline="fast" のとき、カテゴリー分類と関連度評価を1回の構造化出力呼び出しで行います。
+    async_nodes: Trueの場合、ノードを非同期（ainvoke / astream）で実装したグラフを返します。
+        ainvoke / astream（または ainvoke_agent / astream_agent_events）で実行してください。
+    prefetch_categories: async_nodes=True かつ pipeline="fast" のとき、検索スコア上位のカテゴリーをこの数だけ推測し、
+        LLMによる分類と並行して関連度評価を先行実行します（0で無効）。
+    relevance_batcher: relevance_batcher.RelevanceBatcher を指定すると、同じカテゴリーへの同時の関連度評価を
+        1回のLLM呼び出しにまとめます（複数の会話を並行して処理するサーバー向け）。
+    llm_provider: 役割ごとのチャットモデルを提供するプロバイダー（llm_provider.py を参照）。省略時は default_llm_provider。
+    local_classifier_threshold: qa_data から学習したローカル分類器（category_classifier.py）の確信度がこの値以上なら、
+        LLMによるカテゴリー分類を省略します（推奨値は LOCAL_CLASSIFIER_THRESHOLD）。None（既定）でローカル分類器を使用しません。
+        ローカル分類器は最後の質問だけを見るため、会話の履歴や要約がある場合は常に、文脈を渡すLLMで分類します。
+    cross_category_fallback: Trueの場合、予測カテゴリー内の最大関連度スコアが RELEVANCE_THRESHOLD 未満であれば、
+        他のカテゴリーを検索エンジンで事前に順位付けし、上位の候補を1回のLLM呼び出しで評価します。
+        検索ツールは回答のテキストと、関連度の高い順のカテゴリー横断の候補（ToolMessage の artifact）を返します。
+    relevance_chunk_size: 関連度評価の候補がこの件数を超える場合（lexical_top_k を大きくした場合など）、
+        この件数ずつに分割し、最大 relevance_parallelism 件のLLM呼び出しで並列に評価してチャンクごとの最大値をまとめます。
+        分割した評価は relevance_batcher を使用しません。
+    relevance_parse_retries: 関連度評価の応答は RELEVANCE_RESPONSE_SCHEMA の構造化出力で受け取り、途中で途切れた応答なども
+        parse_relevance_response で可能な限り読み取ります。結果を取り出せなかった応答のプロンプトだけを、この回数まで再評価します。
+        分類と関連度評価の統合（fuse_classification）の応答も FUSED_RESPONSE_SCHEMA の構造化出力で受け取り、同じように読み取ります。
+    history_token_budget: 各ターンの最後に質問と応答を会話の履歴（history）に追加し、履歴がこのトークン数（概算）を超えたら
+        古いターンをLLMで要約（summary）に畳み込みます。履歴と要約はカテゴリー分類と最終応答のプロンプトに埋め込みます。
+        None で履歴を要約せずにすべて残します（conversation_memory.py を参照）。
+    checkpointer: LangGraph のチェックポインター（checkpoint_store.py を参照）。指定した場合、同じ thread_id
+        （config["configurable"]["thread_id"]）の呼び出しの間で会話の履歴と要約が引き継がれます。
+        指定しない場合、会話の履歴は1回の呼び出しの中だけで使われます。
+    direct_answer: 最終応答の高速パスのポリシー（direct_answer.py を参照）。検索結果の最上位の候補の関連度スコアが
+        ポリシーの閾値以上であれば、generate_final_response でLLMを呼ばずに回答例（またはその定型文・事前に言い換えた回答）を返します。
+        最終応答の生成方法は faq_final_responses メトリクスに記録します。None では常にLLMで生成します。
+    """
+    if pipeline not in PIPELINES:
+        raise ValueError(f"未対応のパイプラインです: {pipeline}（利用可能: {', '.join(PIPELINES)}）")
+    logger.debug("create_agent_appが呼び出されました")
+    logger.debug("パラメータ: qa_data長=%d, categories=%s, agent_identity=%s", len(qa_data), categories, agent_identity)
+
+    # 役割ごとのLLM（最終応答・ツール選択 / 関連度評価 / カテゴリー分類）
+    provider = llm_provider or default_llm_provider
+    llm = provider.chat_model("response")
+    relevance_scorer_llm = provider.json_model("relevance", RELEVANCE_RESPONSE_SCHEMA)
+    fused_scorer_llm = provider.json_model("relevance", FUSED_RESPONSE_SCHEMA) # 分類と関連度評価の統合
+    classification_llm = provider.chat_model("classifier")
+    summary_llm = provider.chat_model("summary")
+
+    engine = None
+    category_classifier = None
+    evaluation_blocks = {}
     if not qa_data or not categories:
-        print("[DEBUG] 警告: QAデータまたはカテゴリーが空です")
+        logger.warning("QAデータまたはカテゴリーが空です")
         # データがない場合の代替ツール定義
         @tool
         def search_qa_by_category(query: str, category: str) -> str:
              """データが利用できないため検索できません。"""
-             print("[DEBUG] 空のデータセットに対する検索が試みられました")
+             logger.debug("空のデータセットに対する検索が試みられました")
              return "申し訳ございません、現在参照できるFAQデータがありません。"
         tools = [search_qa_by_category]
     else:
-        # search_qa_by_category ツールをこの関数内で定義
-        @tool
-        def search_qa_by_category(query: str, category: str) -> str:
-            """指定されたカテゴリー内で、ユーザーの質問に関連する回答を検索します。"""
-            print(f"[DEBUG] search_qa_by_categoryが呼び出されました: query='{query}', category='{category}'")
+        # カテゴリー別の検索インデックスをコーパスごとに一度だけ構築
+        engine = create_retrieval_engine(retrieval_engine, qa_data, cache_key=index_cache_key)
+        logger.debug("検索エンジンを構築しました: %s", type(engine).__name__)
+        if local_classifier_threshold is not None:
+            category_classifier = create_category_classifier(qa_data, cache_key=index_cache_key)
+        # 行数が lexical_top_k 以下のカテゴリーは毎回全件を評価するため、評価用の候補一覧を事前に整形しておく
+        # （それより大きいカテゴリーはクエリごとに上位K件だけを整形する。分割して評価するカテゴリーは除く）
+        # 整形した一覧は、カテゴリー専用の関連度評価テンプレートのプレフィックスに含める（CorpusPrompts を参照）
+        for category in categories:
+            category_rows = engine.rows(category)
+            if 0 < len(category_rows) <= min(lexical_top_k, relevance_chunk_size):
+                evaluation_blocks[category] = format_qa_block(category_rows)
+
+        def rank_across_categories(query: str, search_categories: List[str]) -> List[tuple]:
+            """検索エンジンのスコアで複数カテゴリーの候補を事前に順位付けし、上位K件の (スコア, カテゴリー, 行) を返します。
+            LLMを使わないため、カテゴリー数が多くてもLLM呼び出しは増えません。
+            """
+            candidates = []
+            for search_category in search_categories:
+                candidates.extend((score, search_category, engine.rows(search_category)[idx])
+                                  for idx, score in engine.search(query, search_category, lexical_top_k) if score > 0)
+            candidates.sort(key=lambda candidate: -candidate[0])
+            return candidates[:lexical_top_k]
+
+        def build_evaluation_prompt(query: str, candidate_rows: List[dict], category_label: str,
+                                    tag_categories: bool = False, precompiled: bool = False) -> str:
+            """候補の関連度をLLMに一括で評価させるプロンプトを返します。tag_categories=True では各候補にカテゴリーを付けます。
+            precompiled=True の場合は、候補を整形せずに category_label の事前に整形した一覧を含むテンプレートを使用します。
+            """
+            if precompiled:
+                return prompts.category_relevance[category_label].render(query=query)
+            # 各QAペアをLLMに評価させるための形式に変換
+            qa_block = format_qa_block(candidate_rows, tag_categories)
+            # 評価用QAブロックの先頭部分をログ出力
+            payload_log.debug("評価用QAブロック（最初の500文字）:\n%.500s", qa_block)
+            # 応答は RELEVANCE_RESPONSE_SCHEMA の最小限のJSON
+            return prompts.relevance.render(category=category_label, qa_block=qa_block, query=query)
+
+        def build_evaluation_prompts(query: str, candidate_rows: List[dict], category_label: str,
+                                     tag_categories: bool = False, precompiled: bool = False) -> List[str]:
+            """評価用プロンプトのリストを返します。候補が relevance_chunk_size 件を超える場合は、チャンクごとのプロンプトに分割します。"""
+            if len(candidate_rows) <= relevance_chunk_size:
+                return [build_evaluation_prompt(query, candidate_rows, category_label, tag_categories, precompiled)]
+            return [build_evaluation_prompt(query, candidate_rows[start:start + relevance_chunk_size], category_label,
+                                            tag_categories)
+                    for start in range(0, len(candidate_rows), relevance_chunk_size)]
+
+        def prepare_search(query: str, category: str) -> tuple:
+            """検索エンジンで候補を絞り込み、(そのまま返す結果, LLM評価対象の候補, 評価用プロンプトのリスト) を返します。
+            評価用プロンプトが None の場合、LLMによる評価は不要です（候補は検索スコアが決定的な1件、またはカテゴリーにデータがない場合は空）。
+            """
+            logger.debug("search_qa_by_categoryが呼び出されました: query='%s', category='%s'", query, category)
             # 検索対象データ長とカテゴリーをログ出力
-            print(f"[DEBUG] 検索対象データ長: {len(qa_data) if qa_data else 0}")
-            print(f"[DEBUG] 検索対象カテゴリー: {category}")
-
-            best_match_answer = "申し訳ございません、お探しの情報は見つかりませんでした。"
-            max_relevance_score = -1
+            logger.debug("検索対象データ長: %d", len(qa_data))
+            logger.debug("検索対象カテゴリー: %s", category)
 
-            # カテゴリーでデータをフィルタリング
-            filtered_qa_data = [item for item in qa_data if item.get('カテゴリー') == category]
+            # 事前構築済みのカテゴリー別インデックスを参照（クエリごとの全件走査を行わない）
+            filtered_qa_data = engine.rows(category)
             # フィルタリング後のデータ数をログ出力
-            print(f"[DEBUG] フィルタリング後のQAデータ数（カテゴリー'{category}'）: {len(filtered_qa_data)}")
+            logger.debug("フィルタリング後のQAデータ数（カテゴリー'%s'）: %d", category, len(filtered_qa_data))
 
             if not filtered_qa_data:
-                print(f"[DEBUG] カテゴリー '{category}' にデータがありません")
-                return f"申し訳ございません、指定されたカテゴリー「{category}」には関連情報がありませんでした。"
-
-            # 各QAペアをLLMに評価させるための形式に変換
-            qa_for_llm_evaluation = []
-            for idx, item in enumerate(filtered_qa_data):
-                question = item.get('質問', '')
-                if question:
-                    qa_for_llm_evaluation.append(f"QA_PAIR_{idx+1}: 質問: {question}")
-
-            if not qa_for_llm_evaluation:
-                print("[DEBUG] 有効な質問データがありません")
-                return f"指定されたカテゴリー「{category}」には有効な質問データがありませんでした。"
+                logger.debug("カテゴリー '%s' にデータがありません", category)
+                return f"申し訳ございません、指定されたカテゴリー「{category}」には関連情報がありませんでした。", [], None
+
+            # 検索エンジンで上位K件の候補に絞り込み、LLMにはその候補だけを評価させる
+            lexical_hits = engine.search(query, category, lexical_top_k)
+            logger.debug("検索エンジンによる上位候補: %s", lexical_hits)
+
+            if lexical_direct_answer and engine.is_decisive(query, category, lexical_hits):
+                logger.debug("検索スコアが決定的なため、LLM評価を省略します")
+                best_row = filtered_qa_data[lexical_hits[0][0]]
+                return best_row.get('回答例', '回答が見つかりませんでした。'), [best_row], None
+
+            if len(filtered_qa_data) <= lexical_top_k:
+                # 候補数がK件以下なら全件をそのまま評価する（候補一覧は事前に整形済み）
+                candidate_rows = filtered_qa_data
+                precompiled = category in evaluation_blocks
+            else:
+                # 字句的に一致しない場合でも意味的に関連する可能性があるため、不足分は先頭から補う
+                # （カテゴリー全体は走査せず、先頭から必要な件数だけを見る）
+                shortlisted = [idx for idx, _ in lexical_hits]
+                if len(shortlisted) < lexical_top_k:
+                    shortlisted_set = set(shortlisted)
+                    shortlisted.extend(itertools.islice(
+                        (idx for idx in range(len(filtered_qa_data)) if idx not in shortlisted_set),
+                        lexical_top_k - len(shortlisted)))
+                candidate_rows = [filtered_qa_data[idx] for idx in shortlisted]
+                precompiled = False
+            logger.debug("LLM評価対象の候補数: %d", len(candidate_rows))
+            return None, candidate_rows, build_evaluation_prompts(query, candidate_rows, category, precompiled=precompiled)
+
+        def evaluate_relevance(candidate_rows: List[dict], evaluation_response: str) -> tuple:
+            """関連度評価LLMの応答を読み取り、(回答, 最大関連度スコア, 関連度の高い順の候補) を返します。
+            応答から結果を読み取れなかった場合、最大関連度スコアは None です。
+            """
+            # LLMからの生の応答をログ出力
+            payload_log.debug("LLMからの生の評価応答:\n%s", evaluation_response)
+            result, _ = parse_relevance_response(evaluation_response)
+            if result is None:
+                logger.warning("LLMの応答から関連度評価の結果を読み取れませんでした")
+                # 読み取れなかった応答をログ出力
+                payload_log.debug("読み取れなかった応答:\n%s", evaluation_response)
+                return "申し訳ございません、関連情報の評価中にエラーが発生しました。別の言葉でお試しください。", None, []
+
+            # 読み取った結果からインデックスとスコアを取得
+            max_relevance_score = result["score"]
+            logger.debug("LLM評価結果: index=%s, score=%s", result["index"], max_relevance_score)
+            best_match_answer = select_answer(candidate_rows, result["index"], max_relevance_score)
 
-            qa_block = "\n".join(qa_for_llm_evaluation)
-            # 評価用QAブロックの先頭部分をログ出力
-            print(f"[DEBUG] 評価用QAブロック（最初の500文字）:\n{qa_block[:500]}{'...' if len(qa_block) > 500 else ''}")
-
-            # LLMに一括で関連度を評価させるプロンプト
-            evaluation_prompt = f"""
-ユーザーの質問: "{query}"
-
-以下の社内ドキュメントの質問リストについて、それぞれの質問がユーザーの質問と意味的にどの程度関連しているかを評価してください。
-関連度を0から100の整数で評価し、最も関連性の高いQAペアのインデックス（QA_PAIR_NのN）と、その関連度スコアを特定してください。
-
-評価結果は、JSON形式で出力してください。
-JSONの形式は以下の通りです。
-{{
-    "evaluations": [
-        {{ "index": N, "score": S }},
-        ...
-    ],
-    "most_relevant_index": N_most_relevant,
-    "max_score": S_max
-}}
-- "index": QA_PAIR_NのNです。
-- "score": 関連度スコア（0-100の整数）です。
-- "most_relevant_index": 関連度が最も高いQAペアのNです。
-- "max_score": 最も高い関連度スコアです。
-
----
-社内ドキュメントの質問リスト（カテゴリー: {category}）:
-{qa_block}
----
-評価結果:
-"""
-            # 評価用プロンプトは長い場合があるのでログ出力はコメントアウト
-            # print(f"[DEBUG] 評価用プロンプト（最初の500文字）:\n{evaluation_prompt[:500]}{'...' if len(evaluation_prompt) > 500 else ''}")
+            # search_qa_by_category 関数の最終結果をログ出力
+            logger.debug("search_qa_by_category 最終結果: %s (最大関連度スコア: %s)", best_match_answer, max_relevance_score)
+            return best_match_answer, max_relevance_score, relevance_ranking(candidate_rows, result)
+
+        def search_failure(e: Exception) -> str:
+            # 予期せぬエラーの場合、完全なトレースバックをログ出力
+            logger.exception("評価中に予期せぬエラーが発生しました: %s", e)
+            return "申し訳ございません、情報の検索中に問題が発生しました。再度お試しください。"
+
+        def prepare_fallback(query: str, category: str, max_relevance_score) -> tuple:
+            """予測カテゴリーでの最大関連度スコアが閾値未満の場合に、他のカテゴリーから検索エンジンで事前順位付けした
+            (候補, 評価用プロンプトのリスト) を返します。カテゴリー横断の検索が不要な場合、評価用プロンプトは None です。
+            """
+            if not cross_category_fallback or not isinstance(max_relevance_score, (int, float)) \
+                    or max_relevance_score >= RELEVANCE_THRESHOLD:
+                return [], None
+            candidates = rank_across_categories(query, [other for other in categories if other != category])
+            logger.debug("カテゴリー '%s' で閾値以上の候補がないため、他のカテゴリーの候補%d件を評価します", category, len(candidates))
+            if not candidates:
+                return [], None
+            candidate_rows = [row for _, _, row in candidates]
+            return candidate_rows, build_evaluation_prompts(query, candidate_rows, "予測カテゴリー以外", tag_categories=True)
+
+        def merge_fallback(primary: tuple, fallback: tuple) -> tuple:
+            """予測カテゴリーと他のカテゴリーの評価結果をまとめ、(回答, 関連度の高い順の候補) を返します。"""
+            answer, _, ranked = primary
+            fallback_answer, fallback_score, fallback_ranked = fallback
+            ranked = sorted(ranked + fallback_ranked, key=lambda candidate: -(candidate["score"] or 0))
+            if isinstance(fallback_score, (int, float)) and fallback_score >= RELEVANCE_THRESHOLD:
+                logger.debug("他のカテゴリー '%s' で回答候補を見つけました", fallback_ranked[0]["カテゴリー"] if fallback_ranked else None)
+                return fallback_answer, ranked
+            return answer, ranked
+
+        def unreadable_responses(responses: List, positions: List[int], attempt: int) -> List[int]:
+            """positions の応答のうち、結果を読み取れなかったもの（例外を除く）の位置を返します。
+            読み取りの結果は faq_relevance_responses メトリクスに記録します。
+            """
+            unreadable = []
+            for position in positions:
+                if isinstance(responses[position], Exception):
+                    continue
+                _, outcome = parse_relevance_response(responses[position])
+                default_metrics.inc("faq_relevance_responses", {"result": outcome})
+                if outcome == "failed":
+                    unreadable.append(position)
+            if unreadable and attempt < relevance_parse_retries:
+                logger.warning("関連度評価の応答%d件から結果を読み取れなかったため再評価します（%d/%d回目）",
+                               len(unreadable), attempt + 1, relevance_parse_retries)
+            return unreadable
+
+        def score_prompts(evaluation_prompts: List[str], first_attempt: int = 0) -> List:
+            """評価用プロンプトをLLMで評価し、応答テキストのリストを返します。
+            プロンプトが複数（分割評価）の場合は最大 relevance_parallelism 件ずつ並列に評価し、失敗した呼び出しは例外を要素とします。
+            結果を読み取れない応答のプロンプトだけを、最大 relevance_parse_retries 回まで再評価します
+            （first_attempt は、すでに行った評価の回数です）。
+            """
+            responses = [None] * len(evaluation_prompts)
+            pending = list(range(len(evaluation_prompts)))
+            for attempt in range(first_attempt, relevance_parse_retries + 1):
+                if len(evaluation_prompts) == 1:
+                    responses[0] = relevance_scorer_llm.invoke(evaluation_prompts[0]).content.strip()
+                else:
+                    results = relevance_scorer_llm.batch([evaluation_prompts[position] for position in pending],
+                                                         config={"max_concurrency": relevance_parallelism},
+                                                         return_exceptions=True)
+                    for position, result in zip(pending, results):
+                        responses[position] = result if isinstance(result, Exception) else result.content.strip()
+                pending = unreadable_responses(responses, pending, attempt)
+                if not pending:
+                    break
+            return responses
+
+        async def ascore_prompts(evaluation_prompts: List[str], first_attempt: int = 0) -> List:
+            responses = [None] * len(evaluation_prompts)
+            pending = list(range(len(evaluation_prompts)))
+            for attempt in range(first_attempt, relevance_parse_retries + 1):
+                if len(evaluation_prompts) == 1:
+                    responses[0] = (await relevance_scorer_llm.ainvoke(evaluation_prompts[0])).content.strip()
+                else:
+                    results = await relevance_scorer_llm.abatch([evaluation_prompts[position] for position in pending],
+                                                                config={"max_concurrency": relevance_parallelism},
+                                                                return_exceptions=True)
+                    for position, result in zip(pending, results):
+                        responses[position] = result if isinstance(result, Exception) else result.content.strip()
+                pending = unreadable_responses(responses, pending, attempt)
+                if not pending:
+                    break
+            return responses
+
+        def request_evaluation(query: str, category: str | None, candidate_rows: List[dict],
+                               evaluation_prompts: List[str]) -> tuple:
+            """評価用プロンプトをLLMで評価し、(評価の応答, 評価対象の候補) を返します。
+            プロンプトが複数（分割評価）の場合は並列に評価し、チャンクごとの結果をまとめます。
+            category を指定した1件の評価は、relevance_batcher があれば同じカテゴリーへの同時リクエストとまとめて評価し、
+            その応答から結果を読み取れない場合は単独のプロンプトで再評価します。
+            """
+            if len(evaluation_prompts) > 1:
+                logger.debug("候補%d件を%d個のチャンクに分割して評価します", len(candidate_rows), len(evaluation_prompts))
+                return merge_chunk_evaluations(score_prompts(evaluation_prompts), relevance_chunk_size), candidate_rows
+            if category is not None and relevance_batcher is not None:
+                # 同じカテゴリーへの同時リクエストとまとめて評価する（評価対象は各リクエストの候補を連結したもの）
+                response, batch_rows = relevance_batcher.score(query, category, candidate_rows, evaluation_prompts[0])
+                if relevance_parse_retries == 0 or not unreadable_responses([response], [0], 0):
+                    return response, batch_rows
+                return score_prompts(evaluation_prompts, first_attempt=1)[0], candidate_rows
+            return score_prompts(evaluation_prompts)[0], candidate_rows
+
+        async def arequest_evaluation(query: str, category: str | None, candidate_rows: List[dict],
+                                      evaluation_prompts: List[str]) -> tuple:
+            if len(evaluation_prompts) > 1:
+                logger.debug("候補%d件を%d個のチャンクに分割して評価します", len(candidate_rows), len(evaluation_prompts))
+                return merge_chunk_evaluations(await ascore_prompts(evaluation_prompts), relevance_chunk_size), candidate_rows
+            if category is not None and relevance_batcher is not None:
+                response, batch_rows = await asyncio.to_thread(relevance_batcher.score, query, category, candidate_rows,
+                                                               evaluation_prompts[0])
+                if relevance_parse_retries == 0 or not unreadable_responses([response], [0], 0):
+                    return response, batch_rows
+                return (await ascore_prompts(evaluation_prompts, first_attempt=1))[0], candidate_rows
+            return (await ascore_prompts(evaluation_prompts))[0], candidate_rows
+
+        def score_category(query: str, category: str) -> tuple:
+            """予測カテゴリー内の候補を評価し、(回答, 最大関連度スコア, 関連度の高い順の候補) を返します。"""
+            direct_result, candidate_rows, evaluation_prompts = prepare_search(query, category)
+            if evaluation_prompts is None:
+                return direct_result, None if candidate_rows else -1, [candidate_summary(row, None) for row in candidate_rows]
+            # LLMによる評価を実行
+            evaluation_response, candidate_rows = request_evaluation(query, category, candidate_rows, evaluation_prompts)
+            return evaluate_relevance(candidate_rows, evaluation_response)
+
+        async def ascore_category(query: str, category: str) -> tuple:
+            direct_result, candidate_rows, evaluation_prompts = prepare_search(query, category)
+            if evaluation_prompts is None:
+                return direct_result, None if candidate_rows else -1, [candidate_summary(row, None) for row in candidate_rows]
+            evaluation_response, candidate_rows = await arequest_evaluation(query, category, candidate_rows,
+                                                                            evaluation_prompts)
+            return evaluate_relevance(candidate_rows, evaluation_response)
+
+        def search_with_fallback(query: str, category: str, primary: tuple) -> tuple:
+            fallback_rows, fallback_prompts = prepare_fallback(query, category, primary[1])
+            if fallback_prompts is None:
+                return primary[0], primary[2]
+            fallback_response, _ = request_evaluation(query, None, fallback_rows, fallback_prompts)
+            return merge_fallback(primary, evaluate_relevance(fallback_rows, fallback_response))
+
+        async def asearch_with_fallback(query: str, category: str, primary: tuple) -> tuple:
+            fallback_rows, fallback_prompts = prepare_fallback(query, category, primary[1])
+            if fallback_prompts is None:
+                return primary[0], primary[2]
+            fallback_response, _ = await arequest_evaluation(query, None, fallback_rows, fallback_prompts)
+            return merge_fallback(primary, evaluate_relevance(fallback_rows, fallback_response))
+
+        def run_search(query: str, category: str) -> tuple:
+            try:
+                return search_with_fallback(query, category, score_category(query, category))
+            except Exception as e:
+                return search_failure(e), []
 
+        async def arun_search(query: str, category: str) -> tuple:
             try:
-                # LLMによる評価を実行
-                evaluation_response = relevance_scorer_llm.invoke(evaluation_prompt).content.strip()
-                # LLMからの生の応答をログ出力
-                print(f"[DEBUG] LLMからの生の評価応答:\n{evaluation_response}")
-
-                # LLMの応答をJSONとしてパース
-                # 応答に不要なマークダウンが含まれている場合を考慮してクリーンアップを試みる
-                response_text_cleaned = evaluation_response.replace("```json", "").replace("```", "").strip()
-                print(f"[DEBUG] クリーンアップ後の評価応答:\n{response_text_cleaned}")
-
-                # クリーンアップしたテキストに対して json.loads を試みる
-                parsed_result = json.loads(response_text_cleaned)
-
-                # パース結果からインデックスとスコアを取得
-                most_relevant_index = parsed_result.get("most_relevant_index")
-                max_relevance_score = parsed_result.get("max_score", -1)
-
-                # パース結果をログ出力
-                print(f"[DEBUG] LLM評価結果のパース後: most_relevant_index={most_relevant_index}, max_score={max_relevance_score}")
-
-                RELEVANCE_THRESHOLD = 70 # 関連度閾値
-
-                # 最も関連性の高いQAペアのインデックスが有効かつ閾値以上のスコアの場合
-                if most_relevant_index is not None and 1 <= most_relevant_index <= len(filtered_qa_data):
-                    if max_relevance_score >= RELEVANCE_THRESHOLD:
-                         # '回答例' キーが存在することを確認して回答を取得
-                         best_match_answer = filtered_qa_data[most_relevant_index - 1].get('回答例', '回答が見つかりませんでした。')
-                         print(f"[DEBUG] 閾値({RELEVANCE_THRESHOLD})以上の関連度({max_relevance_score})で回答候補を見つけました。")
-                    else:
-                         best_match_answer = "申し訳ございません、お探しの情報は見つかりませんでした。別の言葉でお試しいただくか、より詳細な情報をお知らせください。"
-                         print(f"[DEBUG] 最大関連度スコア({max_relevance_score})が閾値({RELEVANCE_THRESHOLD})未満です。")
-                else:
-                    best_match_answer = "申し訳ございません、LLMが適切なQAペアを特定できませんでした。別の言葉でお試しください。"
-                    print(f"[DEBUG] LLMから適切な most_relevant_index ({most_relevant_index}) が得られませんでした（範囲外またはNone）。")
-
-            except json.JSONDecodeError as e:
-                print(f"[DEBUG] エラー: LLMの応答がJSONとしてパースできませんでした: {e}")
-                # パースに失敗した応答をログ出力
-                print(f"[DEBUG] パースに失敗した応答:\n{evaluation_response}")
-                best_match_answer = "申し訳ございません、関連情報の評価中にエラーが発生しました。別の言葉でお試しください。"
+                return await asearch_with_fallback(query, category, await ascore_category(query, category))
             except Exception as e:
-                print(f"[DEBUG] エラー: 評価中に予期せぬエラーが発生しました: {e}")
-                import traceback
-                # 予期せぬエラーの場合、完全なトレースバックをログ出力
-                traceback.print_exc()
-                best_match_answer = "申し訳ございません、情報の検索中に問題が発生しました。再度お試しください。"
+                return search_failure(e), []
 
-            # search_qa_by_category 関数の最終結果をログ出力
-            print(f"[DEBUG] search_qa_by_category 最終結果: {best_match_answer} (最大関連度スコア: {max_relevance_score if max_relevance_score != -1 else 'N/A'})")
-            return best_match_answer
+        # 同期実行（invoke）と非同期実行（ainvoke）の両方に対応したツールとして登録
+        # ToolCall として実行すると、回答をテキスト、関連度の高い順の候補を artifact とする ToolMessage を返す
+        search_qa_by_category = StructuredTool.from_function(
+            func=run_search, coroutine=arun_search, name="search_qa_by_category",
+            description="指定されたカテゴリー内で、ユーザーの質問に関連する回答を検索します。見つからない場合は他のカテゴリーも検索します。",
+            response_format="content_and_artifact",
+        )
 
         tools = [search_qa_by_category] # search_qa_by_category のリスト
 
     # ツールをLLMインスタンスにバインド
     llm_with_tools = llm.bind_tools(tools)
 
+    # プロンプトの静的な部分（システムプロンプト・指示・カテゴリー一覧・事前に整形した質問リスト）をコーパスごとに一度だけ組み立て、
+    # 各プロンプトの先頭に同じ文字列を置く（プロバイダーのプレフィックスキャッシュが効くよう、リクエストごとの部分は後ろに置く）
+    prompts = CorpusPrompts(system_prompt, agent_identity, categories, evaluation_blocks)
+    for template in [*prompts.templates(), SUMMARY_TEMPLATE]:
+        provider.register_prompt_prefix(template)
 
-    # ノードの定義
-    def classify_category(state: AgentState) -> AgentState:
-        """ユーザーの質問がどのカテゴリーに属するかを分類します。"""
-        print("[DEBUG] classify_category ノードが実行されました。")
-        print(f"[DEBUG] 入力状態: {state}")
-        last_message = state["messages"][-1]
-        print(f"[DEBUG] 最後のメッセージ: {last_message}")
-
-        # create_agent_app 関数に渡された categories を使用
-        category_list_str = ", ".join(f"'{cat}'" for cat in categories)
-        print(f"[DEBUG] 利用可能なカテゴリー: {category_list_str}")
 
-        classifier_prompt = f"""
-{system_prompt}
+    # プロンプトの組み立てと応答の解釈（同期・非同期ノードで共通）
+    def conversation_block(state: AgentState, heading: str) -> str:
+        """会話の要約と直近の会話をプロンプトに埋め込むブロックを返します（過去の会話がなければ空文字列）。"""
+        context = format_conversation(state.get("summary", ""), state.get("history", []))
+        return f"{heading}\n{context}\n" if context else ""
 
-ユーザーからの以下の質問が、以下のカテゴリーのどれに最も当てはまるかを判断してください。
-
-利用可能なカテゴリー: {category_list_str}
-
-もし質問が上記のカテゴリーのどれにも当てはまらない、または非常に一般的な質問や個人的な質問の場合は、「その他」と回答してください。
-（「その他」というカテゴリーも上記のリストに含まれています）
-
-回答は、上記のカテゴリー名（例: 'ファンクラブ・会員サービス', 'チケット・イベント' など）のいずれか、または「その他」という単語のみを返してください。
-余計な文字は含めないでください。
-
-質問: {last_message.content}
-分類:
-"""
-        print(f"[DEBUG] 分類用プロンプト:\n{classifier_prompt}")
+    def build_classifier_prompt(state: AgentState) -> str:
+        payload_log.debug("入力状態: %s", state)
+        last_message = state["messages"][-1]
+        payload_log.debug("最後のメッセージ: %s", last_message)
+        # カテゴリー一覧とシステムプロンプトは事前に組み立てたプレフィックスに含まれている
+        classifier_prompt = prompts.classifier.render(
+            conversation=conversation_block(state, "質問が前の会話を受けたもの（「それ」「その場合」など）であれば、以下の会話の文脈も考慮してください。"),
+            question=last_message.content)
+        payload_log.debug("分類用プロンプト:\n%s", classifier_prompt)
+        return classifier_prompt
+
+    def classify_locally(state: AgentState) -> AgentState | None:
+        """ローカル分類器の確信度が閾値以上なら分類結果を返し、閾値未満なら None を返します（LLMで分類する）。"""
+        if category_classifier is None:
+            return None
+        if state.get("history") or state.get("summary"):
+            # 「週末は？」のような続きの質問は最後のメッセージだけでは分類できないため、会話の文脈を渡すLLMで分類する
+            logger.debug("会話の文脈があるため、LLMで分類します")
+            return None
+        category, confidence = category_classifier.predict(state["messages"][-1].content)
+        if category not in categories or confidence < local_classifier_threshold:
+            logger.debug("ローカル分類の確信度が低いため、LLMで分類します: %s (%.2f)", category, confidence)
+            return None
+        logger.debug("ローカル分類器で分類しました: %s (%.2f)", category, confidence)
+        return {"predicted_category": category}
 
-        classification_llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0)
-        classification_response = classification_llm.invoke(classifier_prompt).content.strip()
-        print(f"[DEBUG] LLMからの生の応答: {classification_response}")
+    def resolve_category(classification_response: str) -> AgentState:
+        logger.debug("LLMからの生の応答: %s", classification_response)
 
         # 渡された categories リストに対してチェック
         if classification_response not in categories:
-            print(f"[DEBUG] 分類結果 '{classification_response}' が不正なカテゴリーです。")
+            logger.debug("分類結果 '%s' が不正なカテゴリーです。", classification_response)
             classification_response = "その他" # フォールバック
-            print(f"[DEBUG] 「その他」にフォールバックしました。")
+            logger.debug("「その他」にフォールバックしました。")
 
-        print(f"[DEBUG] 最終的な分類結果: {classification_response}")
+        logger.debug("最終的な分類結果: %s", classification_response)
         return {"predicted_category": classification_response}
 
-
-    def call_search_tool(state: AgentState) -> AgentState:
-        """LLMが `search_qa_by_category` ツールを選択し、ToolCallメッセージを生成します。"""
-        print("[DEBUG] call_search_tool ノードが実行されました。")
-        last_message = state["messages"][-1]
-        predicted_category = state["predicted_category"]
-
+    def build_tool_request(state: AgentState) -> List[BaseMessage]:
+        return [
+            HumanMessage(content=prompts.tool_request.render(query=state["messages"][-1].content,
+                                                             category=state["predicted_category"]))
+        ]
+
+    def accept_tool_call(ai_message_with_tool_call: AIMessage) -> AgentState:
+        if ai_message_with_tool_call.tool_calls:
+            logger.debug("モデルがツール呼び出しを提案しました: %s", ai_message_with_tool_call.tool_calls)
+            # ツール呼び出しを含むメッセージを次のノードに渡す
+            return {"messages": [ai_message_with_tool_call]}
+        else:
+            logger.debug("モデルはツール呼び出しを提案しませんでした。最終応答生成に直接進みます。")
+            # ツール呼び出しが含まれないAIMessageを次のノードに渡す
+            return {"messages": [ai_message_with_tool_call]}
+
+    def tool_call_failure(e: Exception) -> AgentState:
+        # エラーの完全なトレースバックをログ出力
+        logger.exception("call_search_toolノードでLLM呼び出し中に予期せぬエラーが発生しました: %s", e)
+        # エラーメッセージをUIに表示するため、エラー内容を含むAIMessageを返す
+        error_message_content = f"申し訳ございません、ツール呼び出しの準備中にエラーが発生しました。\nエラー詳細: {e}"
+        return {"messages": [AIMessage(content=error_message_content)]}
+
+    def prepare_fused(query: str) -> tuple:
+        """全カテゴリーから検索エンジンで候補を集め、(スコア上位K件の候補, 統合評価用プロンプト) を返します。"""
+        candidates = rank_across_categories(query, categories)
+        logger.debug("統合評価の候補数: %d", len(candidates))
+        if not candidates:
+            return candidates, None
+
+        qa_block = format_qa_block([row for _, _, row in candidates], tag_categories=True)
+        fused_prompt = prompts.fused.render(qa_block=qa_block, query=query)
+        return candidates, fused_prompt
+
+    def fused_failure(e: Exception) -> None:
+        logger.exception("統合評価中に予期せぬエラーが発生しました: %s", e)
+
+    def fused_retry_needed(fused_response: str, attempt: int) -> bool:
+        """統合評価の応答から結果を読み取れず、再評価する場合に True を返します。
+        読み取りの結果は faq_relevance_responses メトリクスに記録します。
+        """
+        _, outcome = parse_fused_response(fused_response)
+        default_metrics.inc("faq_relevance_responses", {"result": outcome})
+        if outcome != "failed" or attempt >= relevance_parse_retries:
+            return False
+        logger.warning("統合評価の応答から結果を読み取れなかったため再評価します（%d/%d回目）", attempt + 1, relevance_parse_retries)
+        return True
+
+    def score_fused(fused_prompt: str) -> str | None:
+        """統合評価用プロンプトをLLMで評価し、応答テキストを返します（LLM呼び出しに失敗した場合は None）。
+        結果を読み取れない応答は、最大 relevance_parse_retries 回まで再評価します。
+        """
         try:
-            # この関数内でバインドされた llm_with_tools を使用
-            # LLMを呼び出し、ToolCallを含むAIMessageを生成しようとする
-            ai_message_with_tool_call = llm_with_tools.invoke([
-                HumanMessage(content=f"ユーザーの質問「{last_message.content}」について、予測されたカテゴリーが「{predicted_category}」です。この情報を使って、社内ドキュメント検索ツール `search_qa_by_category` を使用して情報を検索してください。検索クエリはユーザーの質問内容そのままを渡してください。")
-            ])
-
-            if ai_message_with_tool_call.tool_calls:
-                print(f"[DEBUG] モデルがツール呼び出しを提案しました: {ai_message_with_tool_call.tool_calls}")
-                # ツール呼び出しを含むメッセージを次のノードに渡す
-                return {"messages": [ai_message_with_tool_call]}
-            else:
-                print("[DEBUG] モデルはツール呼び出しを提案しませんでした。最終応答生成に直接進みます。")
-                # ツール呼び出しが含まれないAIMessageを次のノードに渡す
-                return {"messages": [ai_message_with_tool_call]}
-
+            for attempt in range(relevance_parse_retries + 1):
+                fused_response = fused_scorer_llm.invoke(fused_prompt).content.strip()
+                if not fused_retry_needed(fused_response, attempt):
+                    return fused_response
         except Exception as e:
-            print(f"[DEBUG] エラー: call_search_toolノードでLLM呼び出し中に予期せぬエラーが発生しました: {e}")
-            import traceback
-            # エラーの完全なトレースバックをログ出力
-            traceback.print_exc()
-            # エラーメッセージをUIに表示するため、エラー内容を含むAIMessageを返す
-            error_message_content = f"申し訳ございません、ツール呼び出しの準備中にエラーが発生しました。\nエラー詳細: {e}"
-            return {"messages": [AIMessage(content=error_message_content)]}
+            fused_failure(e)
+            return None
 
+    async def ascore_fused(fused_prompt: str) -> str | None:
+        try:
+            for attempt in range(relevance_parse_retries + 1):
+                fused_response = (await fused_scorer_llm.ainvoke(fused_prompt)).content.strip()
+                if not fused_retry_needed(fused_response, attempt):
+                    return fused_response
+        except Exception as e:
+            fused_failure(e)
+            return None
 
-    def generate_final_response(state: AgentState) -> AgentState:
-        """最終的なテキスト応答を生成します。"""
-        print("[DEBUG] generate_final_response ノードが実行されました。")
+    def finish_fused(query: str, candidates: list, fused_response: str | None) -> AgentState:
+        """統合評価の応答から予測カテゴリーと検索結果を決定し、ツール実行結果のメッセージとして返します。
+        fused_response が None の場合（LLM呼び出しに失敗した場合）はエラーメッセージを検索結果とします。
+        """
+        predicted_category = "その他"
+        ranked = []
+        if fused_response is None:
+            tool_result = "申し訳ございません、情報の検索中に問題が発生しました。再度お試しください。"
+        else:
+            payload_log.debug("LLMからの生の統合評価応答:\n%s", fused_response)
+            result, _ = parse_fused_response(fused_response)
+            if result is None:
+                logger.warning("LLMの応答から統合評価の結果を読み取れませんでした")
+                tool_result = "申し訳ございません、関連情報の評価中にエラーが発生しました。別の言葉でお試しください。"
+            else:
+                if result["category"] in categories:
+                    predicted_category = result["category"]
+                candidate_rows = [row for _, _, row in candidates]
+                tool_result = select_answer(candidate_rows, result["index"], result["score"])
+                ranked = relevance_ranking(candidate_rows, result)
+
+        logger.debug("統合評価の結果: category=%s, result=%s", predicted_category, tool_result)
+        tool_args = {"query": query, "category": predicted_category}
+        return {"predicted_category": predicted_category,
+                "messages": direct_tool_messages(search_qa_by_category.name, tool_args, tool_result, ranked)}
+
+    def guess_categories(query: str, limit: int) -> List[str]:
+        """検索エンジンの最上位スコアが高い順に、質問が属しそうなカテゴリーを最大 limit 件返します。"""
+        best_scores = []
+        for category in categories:
+            hits = engine.search(query, category, 1)
+            if hits and hits[0][1] > 0:
+                best_scores.append((hits[0][1], category))
+        best_scores.sort(key=lambda item: -item[0])
+        return [category for _, category in best_scores[:limit]]
+
+    def build_response_prompt(state: AgentState) -> str:
         last_message = state["messages"][-1]
 
         # 履歴から元の HumanMessage の内容を探す
@@ -334,65 +806,269 @@ JSONの形式は以下の通りです。
              # 履歴にHumanMessageがない場合のフォールバック (通常は発生しない想定)
              original_query = state["messages"][0].content
 
+        conversation = conversation_block(state, "これまでのユーザーとの会話は以下の通りです。")
+        if isinstance(last_message, ToolMessage):
+            return prompts.answer.render(conversation=conversation, query=original_query, tool_result=last_message.content)
+        # ツール呼び出しが行われなかった場合（例: カテゴリー分類が「その他」になった場合など）
+        return prompts.direct_answer.render(conversation=conversation, query=original_query)
+
+    def turn_history(state: AgentState) -> tuple:
+        """このターンの質問と応答を履歴に追加し、(トークン予算内の履歴, 要約に回す古いターン) を返します。"""
+        question = next((message for message in state["messages"] if isinstance(message, HumanMessage)), None)
+        answer = state["messages"][-1] if state["messages"] else None
+        history = state.get("history", [])
+        if question is not None and isinstance(answer, AIMessage):
+            history = append_turn(history, message_text(question), message_text(answer))
+        return split_history(history, history_token_budget)
+
+    def summarized_history(state: AgentState, kept: List[BaseMessage], evicted: List[BaseMessage],
+                           summary_response: str | None) -> AgentState:
+        summary = state.get("summary", "")
+        if evicted:
+            if summary_response:
+                summary = clip_summary(summary_response)
+            else:
+                summary = fallback_summary(summary, evicted)
+            logger.debug("古い会話 %d 件を要約しました（要約: %d 文字, 残した履歴: %d 件）", len(evicted), len(summary), len(kept))
+        return {"history": kept, "summary": summary}
 
-        final_response_content = ""
+    def summary_failure(e: Exception) -> None:
+        logger.warning("会話の要約に失敗しました。過去の質問を要約の代わりに残します: %s", e)
 
-        if isinstance(last_message, ToolMessage):
-            tool_result = last_message.content
-
-            response_prompt = f"""
-あなたは{agent_identity}です。
-ユーザーの質問「{original_query}」に対する社内ドキュメントの検索結果は以下の通りです。
----
-検索結果: {tool_result}
----
-この検索結果と{agent_identity}として、ユーザーに分かりやすく、丁寧かつ親しみやすい言葉で回答を生成してください。
-もし検索結果が「申し訳ございません、お探しの情報が見つかりませんでした。」または「指定されたカテゴリーには関連情報がありませんでした。」という内容であった場合、ユーザーの質問を理解できなかったことを丁寧に伝え、他に何かお手伝いできることがないか尋ねるようにしてください。
-"""
-            final_response_content = llm.invoke(response_prompt).content
-        else:
-             # ツール呼び出しが行われなかった場合（例: カテゴリー分類が「その他」になった場合など）
-             general_prompt = f"""
-あなたは{agent_identity}です。
-ユーザーからの以下の質問「{original_query}」に、丁寧かつ親しみやすい言葉で回答してください。
-もし回答できない内容であれば、その旨を伝え、他に何かお手伝いできることがないか尋ねてください。
-"""
-             final_response_content = llm.invoke(general_prompt).content
+    def direct_final_response(state: AgentState) -> str | None:
+        """高速パスのポリシーで、LLMを呼ばずに返す最終応答を返します（使わない場合は None）。
+        最終応答の生成方法（llm / ポリシー名）を faq_final_responses メトリクスに記録します。
+        """
+        last_message = state["messages"][-1]
+        answer = None
+        if direct_answer is not None and isinstance(last_message, ToolMessage) and last_message.artifact:
+            answer = direct_answer.answer(agent_identity, last_message.artifact[0], last_message.content)
+        if answer is not None:
+            logger.debug("関連度スコアが高いため、LLMを呼ばずに最終応答を返します（%s）", direct_answer.mode)
+        default_metrics.inc("faq_final_responses", {"path": direct_answer.mode if answer is not None else "llm"})
+        return answer
 
+    def final_response_message(final_response_content: str, response_id: str | None) -> AgentState:
+        payload_log.debug("最終応答: %s", final_response_content)
+        # ストリーミングしたチャンクと同じIDにすることで、LangGraphの messages ストリームで重複して送出されないようにする
+        return {"messages": [AIMessage(content=final_response_content, id=response_id)]}
 
-        print(f"[DEBUG] 最終応答: {final_response_content}")
-        return {"messages": [AIMessage(content=final_response_content)]}
 
+    # ノードの定義
+    def classify_category(state: AgentState) -> AgentState:
+        """ユーザーの質問がどのカテゴリーに属するかを分類します。"""
+        logger.debug("classify_category ノードが実行されました。")
+        local_result = classify_locally(state)
+        if local_result is not None:
+            return local_result
+        classifier_prompt = build_classifier_prompt(state)
+        return resolve_category(classification_llm.invoke(classifier_prompt).content.strip())
 
-    # LangGraph の構築
-    graph = StateGraph(AgentState)
 
-    # ノードの追加
-    graph.add_node("classify_category", classify_category)
-    graph.add_node("call_search_tool", call_search_tool)
-    graph.add_node("tool_executor", ToolNode(tools)) # このスコープで定義された tools を使用
-    graph.add_node("generate_final_response", generate_final_response)
+    def call_search_tool(state: AgentState) -> AgentState:
+        """LLMが `search_qa_by_category` ツールを選択し、ToolCallメッセージを生成します。"""
+        logger.debug("call_search_tool ノードが実行されました。")
+        try:
+            # この関数内でバインドされた llm_with_tools を使用
+            # LLMを呼び出し、ToolCallを含むAIMessageを生成しようとする
+            return accept_tool_call(llm_with_tools.invoke(build_tool_request(state)))
+        except Exception as e:
+            return tool_call_failure(e)
 
 
-    # グラフの開始点
-    graph.set_entry_point("classify_category")
+    def search_directly(state: AgentState) -> AgentState:
+        """LLMにツールを選択させず、予測カテゴリーで search_qa_by_category を直接実行します（fast構成）。"""
+        logger.debug("search_directly ノードが実行されました。")
+        tool_call = direct_tool_call(search_qa_by_category.name,
+                                     {"query": state["messages"][-1].content, "category": state["predicted_category"]})
+        # ToolCall として実行し、検索結果の候補（artifact）を含む ToolMessage を受け取る
+        return {"messages": [AIMessage(content="", tool_calls=[tool_call]), search_qa_by_category.invoke(tool_call)]}
 
-    graph.add_edge("classify_category", "call_search_tool")
-    graph.add_edge("call_search_tool", "tool_executor")
-    graph.add_edge("tool_executor", "generate_final_response")
-    graph.add_edge("generate_final_response", END)
 
+    def classify_and_search(state: AgentState) -> AgentState:
+        """カテゴリー分類と関連度評価を1回のLLM呼び出しで行います（fast構成 + fuse_classification）。"""
+        logger.debug("classify_and_search ノードが実行されました。")
+        query = state["messages"][-1].content
+        candidates, fused_prompt = prepare_fused(query)
+        if fused_prompt is None:
+            # 字句的な候補がない場合は、通常の分類 → 検索にフォールバック
+            logger.debug("候補がないため、分類と検索を個別に実行します")
+            classified = classify_category(state)
+            return {**classified, **search_directly({**state, **classified})}
+        return finish_fused(query, candidates, score_fused(fused_prompt))
 
-    # グラフをコンパイル
-    compiled_app = graph.compile()
 
-    print("LangGraph エージェントがコンパイルされました。")
-    
-    print(f"読み込んだFAQデータ:")
-    print(f"- 総レコード数: {len(qa_data)}")
-    print(f"- カテゴリー数: {len(categories)}")
-    print(f"- カテゴリー一覧: {', '.join(categories)}")
-    print(f"- エージェントアイデンティティ: {agent_identity}")
+    def generate_final_response(state: AgentState) -> AgentState:
+        """最終的なテキスト応答を生成します。"""
+        logger.debug("generate_final_response ノードが実行されました。")
+        direct_response = direct_final_response(state)
+        if direct_response is not None:
+            return final_response_message(direct_response, None)
+        return final_response_message(*stream_llm_text(llm, build_response_prompt(state)))
+
+
+    def remember_turn(state: AgentState) -> AgentState:
+        """このターンの質問と応答を会話の履歴に追加し、トークン予算を超えた古いターンを要約に畳み込みます。"""
+        logger.debug("remember_turn ノードが実行されました。")
+        kept, evicted = turn_history(state)
+        summary_response = None
+        if evicted:
+            try:
+                summary_response = message_text(summary_llm.invoke(build_summary_prompt(state.get("summary", ""), evicted)))
+            except Exception as e:
+                summary_failure(e)
+        return summarized_history(state, kept, evicted, summary_response)
+
+
+    # 非同期ノード（async_nodes=True）。LLM呼び出しは ainvoke / astream で行い、イベントループをブロックしない
+    async def aclassify_category(state: AgentState) -> AgentState:
+        """classify_category の非同期版です。"""
+        logger.debug("classify_category ノード（非同期）が実行されました。")
+        local_result = classify_locally(state)
+        if local_result is not None:
+            return local_result
+        classifier_prompt = build_classifier_prompt(state)
+        return resolve_category((await classification_llm.ainvoke(classifier_prompt)).content.strip())
+
+
+    async def acall_search_tool(state: AgentState) -> AgentState:
+        """call_search_tool の非同期版です。"""
+        logger.debug("call_search_tool ノード（非同期）が実行されました。")
+        try:
+            return accept_tool_call(await llm_with_tools.ainvoke(build_tool_request(state)))
+        except Exception as e:
+            return tool_call_failure(e)
+
+
+    async def asearch_directly(state: AgentState) -> AgentState:
+        """search_directly の非同期版です。"""
+        logger.debug("search_directly ノード（非同期）が実行されました。")
+        tool_call = direct_tool_call(search_qa_by_category.name,
+                                     {"query": state["messages"][-1].content, "category": state["predicted_category"]})
+        return {"messages": [AIMessage(content="", tool_calls=[tool_call]), await search_qa_by_category.ainvoke(tool_call)]}
+
+
+    async def aclassify_and_search(state: AgentState) -> AgentState:
+        """classify_and_search の非同期版です。"""
+        logger.debug("classify_and_search ノード（非同期）が実行されました。")
+        query = state["messages"][-1].content
+        candidates, fused_prompt = prepare_fused(query)
+        if fused_prompt is None:
+            logger.debug("候補がないため、分類と検索を個別に実行します")
+            classified = await aclassify_category(state)
+            return {**classified, **(await asearch_directly({**state, **classified}))}
+        return finish_fused(query, candidates, await ascore_fused(fused_prompt))
+
+
+    async def aclassify_and_prefetch(state: AgentState) -> AgentState:
+        """LLMによるカテゴリー分類と、検索スコア上位カテゴリーの関連度評価を並行して実行します（非同期fast構成）。
+        分類結果が先行評価したカテゴリーのいずれかであれば、その評価結果をそのまま使用します。
+        ローカル分類器で分類できた場合は、先行評価を行わずにそのカテゴリーだけを評価します。
+        """
+        logger.debug("classify_and_prefetch ノードが実行されました。")
+        query = state["messages"][-1].content
+        classified = classify_locally(state)
+        if classified is None:
+            guessed_categories = guess_categories(query, prefetch_categories)
+            logger.debug("先行評価するカテゴリー: %s", guessed_categories)
+
+            async def prefetch(category: str) -> tuple:
+                # 先行評価は予測カテゴリー内だけで行い、カテゴリー横断の検索は分類結果が確定してから行う
+                try:
+                    return await ascore_category(query, category)
+                except Exception as e:
+                    return search_failure(e), None, []
+
+            classification_response, *prefetched_results = await asyncio.gather(
+                classification_llm.ainvoke(build_classifier_prompt(state)),
+                *(prefetch(category) for category in guessed_categories)
+            )
+            classified = resolve_category(classification_response.content.strip())
+            predicted_category = classified["predicted_category"]
+            prefetched = dict(zip(guessed_categories, prefetched_results))
+            if predicted_category in prefetched:
+                logger.debug("先行評価の結果を使用します: %s", predicted_category)
+                try:
+                    tool_result, ranked = await asearch_with_fallback(query, predicted_category,
+                                                                      prefetched[predicted_category])
+                except Exception as e:
+                    tool_result, ranked = search_failure(e), []
+                tool_args = {"query": query, "category": predicted_category}
+                return {**classified,
+                        "messages": direct_tool_messages(search_qa_by_category.name, tool_args, tool_result, ranked)}
+            logger.debug("分類結果 '%s' は先行評価の対象外のため、検索を実行します", predicted_category)
+        else:
+            # ローカルで分類できた場合は先行評価せず、分類したカテゴリーだけを評価する
+            logger.debug("ローカルで分類できたため、先行評価を行いません")
+        return {**classified, **(await asearch_directly({**state, **classified}))}
+
+
+    async def agenerate_final_response(state: AgentState) -> AgentState:
+        """generate_final_response の非同期版です。"""
+        logger.debug("generate_final_response ノード（非同期）が実行されました。")
+        direct_response = direct_final_response(state)
+        if direct_response is not None:
+            return final_response_message(direct_response, None)
+        return final_response_message(*(await astream_llm_text(llm, build_response_prompt(state))))
+
+
+    async def aremember_turn(state: AgentState) -> AgentState:
+        """remember_turn の非同期版です。"""
+        logger.debug("remember_turn ノード（非同期）が実行されました。")
+        kept, evicted = turn_history(state)
+        summary_response = None
+        if evicted:
+            try:
+                summary_response = message_text(await summary_llm.ainvoke(
+                    build_summary_prompt(state.get("summary", ""), evicted)))
+            except Exception as e:
+                summary_failure(e)
+        return summarized_history(state, kept, evicted, summary_response)
+
+
+    def node(sync_node, async_node):
+        return async_node if async_nodes else sync_node
+
+
+    # LangGraph の構築
+    graph = StateGraph(AgentState)
+
+    # ノードの追加とグラフの開始点
+    graph.add_node("generate_final_response", node(generate_final_response, agenerate_final_response))
+    graph.add_node("remember_turn", node(remember_turn, aremember_turn))
+    if pipeline == "classic":
+        graph.add_node("classify_category", node(classify_category, aclassify_category))
+        graph.add_node("call_search_tool", node(call_search_tool, acall_search_tool))
+        graph.add_node("tool_executor", ToolNode(tools)) # このスコープで定義された tools を使用
+        graph.set_entry_point("classify_category")
+        graph.add_edge("classify_category", "call_search_tool")
+        graph.add_edge("call_search_tool", "tool_executor")
+        graph.add_edge("tool_executor", "generate_final_response")
+    elif fuse_classification and engine is not None:
+        graph.add_node("classify_and_search", node(classify_and_search, aclassify_and_search))
+        graph.set_entry_point("classify_and_search")
+        graph.add_edge("classify_and_search", "generate_final_response")
+    elif async_nodes and engine is not None and prefetch_categories > 0:
+        graph.add_node("classify_and_prefetch", aclassify_and_prefetch)
+        graph.set_entry_point("classify_and_prefetch")
+        graph.add_edge("classify_and_prefetch", "generate_final_response")
+    else:
+        graph.add_node("classify_category", node(classify_category, aclassify_category))
+        graph.add_node("search_directly", node(search_directly, asearch_directly))
+        graph.set_entry_point("classify_category")
+        graph.add_edge("classify_category", "search_directly")
+        graph.add_edge("search_directly", "generate_final_response")
+
+    graph.add_edge("generate_final_response", "remember_turn")
+    graph.add_edge("remember_turn", END)
+
+    # グラフをコンパイル（チェックポインターを指定した場合は thread_id ごとに会話の状態を保存する）
+    compiled_app = graph.compile(checkpointer=checkpointer)
+
+    logger.info("LangGraph エージェントがコンパイルされました（総レコード数: %d, カテゴリー数: %d, "
+                "エージェントアイデンティティ: %s, パイプライン: %s%s）", len(qa_data), len(categories), agent_identity,
+                pipeline, " (分類・関連度評価を統合)" if pipeline == "fast" and fuse_classification else "")
+    logger.debug("カテゴリー一覧: %s", categories)
 
     return compiled_app
 
@@ -0,0 +1,1356 @@
+# 性能計測用のベンチマークスクリプト
+# 使い方: python benchmark.py <サブコマンド> [オプション]
+#   例: python benchmark.py retrieval --sizes 50 5000 500000
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+# 合成FAQデータの生成に使う語彙
+_SUBJECTS = ["営業時間", "支払い方法", "予約", "会員登録", "パスワード", "配送", "返品", "ポイント",
+             "領収書", "駐車場", "アレルギー", "チケット", "グッズ", "Wi-Fi", "解約", "請求書"]
+_VERBS = ["を教えてください", "はどうすればいいですか", "について知りたいです", "は可能ですか",
+          "を変更したいです", "ができません", "の確認方法は？", "はいつですか"]
+_MODIFIERS = ["", "土日の", "オンラインでの", "店舗での", "海外からの", "初めての", "法人の", "スマホアプリの"]
+
+
+def synthetic_qa_data(n_rows: int, n_categories: int = 10, seed: int = 0) -> List[dict]:
+    """ベンチマーク用に、doc/*.py と同じ形式の合成QAデータを生成します。"""
+    rng = random.Random(seed)
+    categories = [f"カテゴリー{i}" for i in range(n_categories)]
+    return [
+        {
+            "カテゴリー": categories[i % n_categories],
+            "質問": f"{rng.choice(_MODIFIERS)}{rng.choice(_SUBJECTS)}{rng.choice(_VERBS)}（{i}）",
+            "回答例": f"回答例{i}: {rng.choice(_SUBJECTS)}については公式サイトをご確認ください。",
+        }
+        for i in range(n_rows)
+    ]
+
+
+def measure_latencies(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """funcをrepeat回実行し、p50/p99レイテンシ（ミリ秒）を返します。"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 4),
+        "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4),
+    }
+
+
+def bench_retrieval(args: argparse.Namespace) -> List[dict]:
+    """検索エンジンごとに、1カテゴリー内の検索レイテンシをコーパスサイズ別に計測します。"""
+    from retrieval import create_retrieval_engine
+
+    results = []
+    queries = [f"{s}{v}" for s in _SUBJECTS for v in _VERBS]
+    for n_rows in args.sizes:
+        # 全行を1カテゴリーに入れ、1回の検索で走査する行数を n_rows にする
+        qa_data = synthetic_qa_data(n_rows, n_categories=1)
+        for engine_name in args.engines:
+            start = time.perf_counter()
+            engine = create_retrieval_engine(engine_name, qa_data)
+            build_seconds = time.perf_counter() - start
+            query_iter = iter(queries * (args.repeat // len(queries) + 1))
+            latencies = measure_latencies(lambda: engine.search(next(query_iter), "カテゴリー0", args.top_k), args.repeat)
+            results.append({"engine": engine_name, "rows": n_rows, "build_s": round(build_seconds, 3), **latencies})
+    return results
+
+
+def bench_index_cache(args: argparse.Namespace) -> List[dict]:
+    """検索インデックスのコールドスタート（構築+保存）とキャッシュからの読み込み時間を比較します。"""
+    import tempfile
+
+    from index_cache import IndexCache
+    from retrieval import create_retrieval_engine
+
+    results = []
+    qa_data = synthetic_qa_data(args.rows)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # キャッシュキーはソースファイルの内容から決まるため、合成データをファイルに書き出す
+        source_path = os.path.join(tmp_dir, "synthetic_faq.json")
+        with open(source_path, "w", encoding="utf-8") as f:
+            json.dump({"metadata": {}, "data": qa_data}, f, ensure_ascii=False)
+        cache = IndexCache(os.path.join(tmp_dir, "cache"))
+        key = cache.key_for_source(source_path)
+        for engine_name in args.engines:
+            start = time.perf_counter()
+            create_retrieval_engine(engine_name, qa_data, cache_key=key, cache=cache)
+            cold_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            engine = create_retrieval_engine(engine_name, qa_data, cache_key=key, cache=cache)
+            warm_seconds = time.perf_counter() - start
+            latencies = measure_latencies(lambda: engine.search("営業時間を教えてください", "カテゴリー0", 20), 50)
+            results.append({"engine": engine_name, "rows": args.rows, "cold_s": round(cold_seconds, 3),
+                            "warm_ms": round(warm_seconds * 1000, 2), "warm_search": latencies})
+    return results
+
+
+def bench_load(args: argparse.Namespace) -> List[dict]:
+    """FAQファイルの形式ごとの読み込み時間を比較します（doc/*.py と合成コーパス）。"""
+    import glob
+    import tempfile
+
+    from faq_loader import FAQ_WRITERS, convert_faq_file, load_faq_data
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sources = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc", "*.py")))
+        # 大規模コーパスはレガシー形式（'_JSON'辞書を含む.py）として書き出して変換元にする
+        synthetic_path = os.path.join(tmp_dir, f"synthetic_{args.rows}.py")
+        with open(synthetic_path, "w", encoding="utf-8") as f:
+            f.write("SYNTHETIC_FAQ_JSON = ")
+            json.dump({"metadata": {"description": "合成FAQ"}, "data": synthetic_qa_data(args.rows)}, f,
+                      ensure_ascii=False, indent=1)
+        sources.append(synthetic_path)
+
+        for source_path in sources:
+            paths = {"py": source_path}
+            for output_format in FAQ_WRITERS:
+                paths[output_format] = convert_faq_file(source_path, output_format, tmp_dir)
+            for file_format, file_path in paths.items():
+                latencies = measure_latencies(lambda: load_faq_data(file_path), args.repeat)
+                results.append({"source": os.path.basename(source_path), "format": file_format,
+                                "bytes": os.path.getsize(file_path), **latencies})
+    return results
+
+
+def load_doc_corpora() -> List[tuple]:
+    """doc/ 内の各コーパスを (ファイル名, QAデータ, カテゴリー, アイデンティティ) のリストで返します。"""
+    from faq_loader import discover_faq_files, load_faq_data
+
+    corpora = []
+    for file_path in discover_faq_files(os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc")):
+        faq_data = load_faq_data(file_path)
+        qa_data = faq_data["data"]
+        categories = sorted({item["カテゴリー"] for item in qa_data if item.get("カテゴリー")})
+        identity = faq_data["metadata"].get("description", "AIアシスタント")
+        corpora.append((os.path.basename(file_path), qa_data, categories, identity))
+    return corpora
+
+
+def bench_pipeline(args: argparse.Namespace) -> List[dict]:
+    """レイテンシを挿入した偽LLMで、グラフ構成ごとの回答までの時間を比較します。"""
+    from langchain_core.messages import HumanMessage
+
+    import app
+
+    fake_llm = patch_fake_llm(args.latency)
+
+    variants = {"classic": {"pipeline": "classic"}, "fast": {"pipeline": "fast"},
+                "fast+fused": {"pipeline": "fast", "fuse_classification": True}}
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        questions = [item["質問"] for item in qa_data][:args.questions]
+        for variant, options in variants.items():
+            agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", **options)
+            fake_llm.call_count = 0
+            question_iter = iter(questions * args.repeat)
+            latencies = measure_latencies(
+                lambda: agent.invoke({"messages": [HumanMessage(content=next(question_iter))]}),
+                len(questions) * args.repeat,
+            )
+            results.append({"doc": doc_name, "pipeline": variant, "llm_latency_ms": args.latency * 1000,
+                            "llm_calls_per_question": fake_llm.call_count / (len(questions) * args.repeat),
+                            **latencies})
+    return results
+
+
+def patch_fake_llm(latency: float = 0.0):
+    """app モジュールの既定のLLMプロバイダーを偽LLMに差し替え、差し替えた偽LLMを返します。"""
+    import app
+    from llm_provider import FakeProvider
+
+    provider = FakeProvider(latency=latency)
+    app.default_llm_provider = provider
+    return provider.model
+
+
+def bench_sessions(args: argparse.Namespace) -> List[dict]:
+    """多数のセッションを模擬し、セッションごとのコンパイルと共有レジストリのメモリ・起動時間を比較します。"""
+    import gc
+    import tracemalloc
+
+    import app
+    from agent_registry import AgentRegistry, agent_key
+    from faq_loader import discover_faq_files, load_faq_data
+    from index_cache import default_index_cache
+
+    patch_fake_llm()
+    doc_paths = discover_faq_files(os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc"))
+
+    def start_session(session_id: int, registry: AgentRegistry = None):
+        # ui_app.py と同様に、セッションごとにFAQデータを読み込んでエージェントを用意する
+        doc_path = doc_paths[session_id % len(doc_paths)]
+        faq_data = load_faq_data(doc_path)
+        qa_data = faq_data["data"]
+        categories = sorted({item["カテゴリー"] for item in qa_data if item.get("カテゴリー")})
+        identity = faq_data["metadata"].get("description", "AIアシスタント")
+        system_prompt = f"あなたは{identity}です。"
+        cache_key = default_index_cache.key_for_source(doc_path)
+        build = lambda: app.create_agent_app(qa_data, categories, identity, system_prompt, index_cache_key=cache_key)
+        if registry is None:
+            return build()
+        return registry.lease(agent_key(cache_key, system_prompt), build)
+
+    results = []
+    for mode in ("per-session", "registry"):
+        registry = AgentRegistry() if mode == "registry" else None
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        sessions = [start_session(session_id, registry) for session_id in range(args.sessions)]
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {"mode": mode, "sessions": args.sessions, "startup_s": round(elapsed, 3),
+                  "memory_mb": round(current / 1024 / 1024, 2), "peak_memory_mb": round(peak / 1024 / 1024, 2)}
+        if registry is not None:
+            result["registry"] = registry.stats()
+        results.append(result)
+        del sessions
+    return results
+
+
+def bench_async(args: argparse.Namespace) -> List[dict]:
+    """同時会話数ごとに、同期グラフ（スレッドプール）と非同期グラフのスループットを比較します（偽LLM使用）。"""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from langchain_core.messages import HumanMessage
+
+    import app
+
+    fake_llm = patch_fake_llm(args.latency)
+    doc_name, qa_data, categories, identity = load_doc_corpora()[0]
+    questions = [item["質問"] for item in qa_data]
+    variants = {
+        "sync-threads": {"pipeline": "fast"},
+        "async": {"pipeline": "fast", "async_nodes": True, "prefetch_categories": 0},
+        "async+prefetch": {"pipeline": "fast", "async_nodes": True, "prefetch_categories": 2},
+    }
+
+    def summarize(variant: str, concurrency: int, samples: List[float], elapsed: float, calls: int) -> dict:
+        samples.sort()
+        return {"doc": doc_name, "variant": variant, "concurrency": concurrency, "conversations": len(samples),
+                "llm_latency_ms": args.latency * 1000, "throughput_per_s": round(len(samples) / elapsed, 2),
+                "p50_ms": round(statistics.median(samples), 2),
+                "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2),
+                "llm_calls_per_conversation": round(calls / len(samples), 2)}
+
+    results = []
+    for variant, options in variants.items():
+        agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", **options)
+        for concurrency in args.concurrency:
+            conversations = [questions[i % len(questions)] for i in range(concurrency * args.rounds)]
+            samples = []
+            fake_llm.call_count = 0
+
+            if options.get("async_nodes"):
+                async def converse(question: str, semaphore: asyncio.Semaphore) -> None:
+                    async with semaphore:
+                        start = time.perf_counter()
+                        await app.ainvoke_agent(agent, question)
+                        samples.append((time.perf_counter() - start) * 1000)
+
+                async def run_all() -> None:
+                    semaphore = asyncio.Semaphore(concurrency)
+                    await asyncio.gather(*(converse(question, semaphore) for question in conversations))
+
+                start = time.perf_counter()
+                asyncio.run(run_all())
+            else:
+                def converse_sync(question: str) -> None:
+                    start = time.perf_counter()
+                    agent.invoke({"messages": [HumanMessage(content=question)]})
+                    samples.append((time.perf_counter() - start) * 1000)
+
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    list(executor.map(converse_sync, conversations))
+            results.append(summarize(variant, concurrency, samples, time.perf_counter() - start,
+                                     fake_llm.call_count))
+    return results
+
+
+def bench_server(args: argparse.Namespace) -> List[dict]:
+    """server.py をプロセス内で起動し、同時接続数ごとの /chat のRPSとテールレイテンシを計測します（偽LLM使用）。"""
+    import http.client
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    fake_llm = patch_fake_llm(args.latency)
+    import server
+
+    # 全コーパスの質問を (コーパス名, 質問) の組にして、コーパスとカテゴリーが混在した負荷をかける
+    requests = [(os.path.splitext(doc_name)[0], item["質問"])
+                for doc_name, qa_data, _, _ in load_doc_corpora() for item in qa_data]
+    results = []
+    for batching in (False, True):
+        corpora = server.load_corpora(batching=batching, max_batch_size=args.max_batch_size,
+                                      max_wait_ms=args.max_wait_ms)
+        random.Random(0).shuffle(requests)
+        httpd = server.FaqHTTPServer(("127.0.0.1", 0), corpora, workers=args.workers)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+        def post_chat(corpus_name: str, message: str) -> float:
+            start = time.perf_counter()
+            connection = http.client.HTTPConnection("127.0.0.1", httpd.server_port, timeout=60)
+            connection.request("POST", "/chat", json.dumps({"corpus": corpus_name, "message": message}),
+                               {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status != 200:
+                raise RuntimeError(f"/chat が {response.status} を返しました")
+            return (time.perf_counter() - start) * 1000
+
+        try:
+            for concurrency in args.concurrency:
+                total = concurrency * args.rounds
+                batch = [requests[i % len(requests)] for i in range(total)]
+                fake_llm.call_count = 0
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    samples = sorted(executor.map(lambda request: post_chat(*request), batch))
+                elapsed = time.perf_counter() - start
+                results.append({
+                    "batching": batching, "concurrency": concurrency, "requests": total, "workers": args.workers,
+                    "llm_latency_ms": args.latency * 1000, "rps": round(total / elapsed, 2),
+                    "p50_ms": round(statistics.median(samples), 1),
+                    "p95_ms": round(samples[min(total - 1, int(total * 0.95))], 1),
+                    "p99_ms": round(samples[min(total - 1, int(total * 0.99))], 1),
+                    "llm_calls_per_request": round(fake_llm.call_count / total, 2),
+                })
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+    return results
+
+
+def create_benchmark_provider(args: argparse.Namespace):
+    """コマンドライン引数からベンチマーク用のLLMプロバイダーを作成します。"""
+    from llm_provider import CassetteProvider, FakeProvider, GeminiProvider
+
+    if args.provider == "fake":
+        return FakeProvider(latency=args.latency, latency_distribution=args.latency_distribution,
+                            latency_spread=args.latency_spread, tokens_per_second=args.tokens_per_second,
+                            seed=args.seed)
+    if args.provider == "cassette":
+        return CassetteProvider(args.cassette, inner=GeminiProvider() if args.cassette_mode != "replay" else None,
+                                mode=args.cassette_mode)
+    return GeminiProvider()
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {"p50_ms": round(statistics.median(samples), 2),
+            "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2)}
+
+
+def bench_e2e(args: argparse.Namespace) -> List[dict]:
+    """doc/ 内の全コーパスをグラフ構成ごとに実行し、ノード別のレイテンシ・トークン数とスループットを計測します。
+    --output で結果をJSONファイルに保存し、--baseline で以前の結果との比較を出力します。
+    """
+    import subprocess
+
+    from langchain_core.messages import HumanMessage
+
+    import app
+    from instrumentation import RequestTrace
+
+    provider = create_benchmark_provider(args)
+    variants = {"classic": {"pipeline": "classic"}, "fast": {"pipeline": "fast"},
+                "fast+fused": {"pipeline": "fast", "fuse_classification": True}}
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        questions = [item["質問"] for item in qa_data][:args.questions]
+        for variant in args.pipelines:
+            agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。",
+                                         llm_provider=provider, **variants[variant])
+            node_samples: Dict[str, List[float]] = {}
+            usage: Dict[str, Dict[str, int]] = {}
+            totals = []
+            start = time.perf_counter()
+            for question in questions:
+                # ノード・LLM呼び出しのスパンを記録する（プロセス全体のメトリクスには加算しない）
+                trace = RequestTrace(metrics=None)
+                agent.invoke({"messages": [HumanMessage(content=question)]}, {"callbacks": [trace]})
+                finished = trace.finish()
+                totals.append(finished["duration_ms"])
+                for span in finished["spans"]:
+                    if span["kind"] == "node":
+                        node_samples.setdefault(span["name"], []).append(span["duration_ms"])
+                    elif span["kind"] == "llm":
+                        node_usage = usage.setdefault(span["attributes"]["node"],
+                                                      {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0})
+                        node_usage["llm_calls"] += 1
+                        node_usage["input_tokens"] += span["attributes"].get("prompt_tokens", 0)
+                        node_usage["output_tokens"] += span["attributes"].get("completion_tokens", 0)
+            elapsed = time.perf_counter() - start
+
+            nodes = {}
+            for node_name, samples in node_samples.items():
+                node_usage = usage.get(node_name, {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0})
+                nodes[node_name] = {**_percentiles(samples),
+                                    **{key: round(value / len(questions), 2) for key, value in node_usage.items()}}
+            output_tokens = sum(node_usage["output_tokens"] for node_usage in usage.values())
+            results.append({
+                "doc": doc_name, "pipeline": variant, "provider": provider.name, "questions": len(questions),
+                "total": _percentiles(totals), "throughput_qps": round(len(questions) / elapsed, 2),
+                "output_tokens_per_s": round(output_tokens / elapsed, 1),
+                "input_tokens_per_question": round(
+                    sum(node_usage["input_tokens"] for node_usage in usage.values()) / len(questions), 1),
+                "nodes": nodes,
+            })
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = {(result["doc"], result["pipeline"]): result for result in json.load(f)["results"]}
+        for result in results:
+            previous = baseline.get((result["doc"], result["pipeline"]))
+            if previous:
+                result["vs_baseline"] = {
+                    "total_p50_ratio": round(result["total"]["p50_ms"] / max(previous["total"]["p50_ms"], 1e-9), 3),
+                    "input_tokens_delta": round(result["input_tokens_per_question"]
+                                                - previous["input_tokens_per_question"], 1),
+                }
+    if args.output:
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except OSError:
+            commit = None
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": commit, "config": {key: value for key, value in vars(args).items()
+                                                    if key not in ("output", "baseline")},
+                       "results": results}, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def bench_logging(args: argparse.Namespace) -> List[dict]:
+    """ログ出力の方式ごとに、1リクエストあたりの処理時間とログ出力による増加分を計測します（遅延なしの偽LLM使用）。
+    sync-debug は変更前の print と同様に、リクエストのスレッドで全メッセージを書式化して同期的に書き込みます。
+    出力先はいずれも os.devnull です。
+    """
+    import logging
+
+    import logging_setup
+
+    devnull = open(os.devnull, "w", encoding="utf-8")
+    logging_setup.configure_logging("INFO", stream=devnull)
+    from langchain_core.messages import HumanMessage
+
+    import app
+
+    patch_fake_llm(0.0)
+    doc_name, qa_data, categories, identity = load_doc_corpora()[0]
+    questions = [item["質問"] for item in qa_data]
+    root = logging.getLogger()
+    queue_handlers = list(root.handlers)
+    sync_handler = logging.StreamHandler(devnull)
+    sync_handler.setFormatter(logging.Formatter(logging_setup.LOG_FORMAT))
+
+    # (名前, レベル, ハンドラー, ペイロードのサンプリング率)
+    variants = [("disabled", None, queue_handlers, 1.0),
+                ("sync-debug", "DEBUG", [sync_handler], 1.0),
+                ("queue-info", "INFO", queue_handlers, 1.0),
+                ("queue-debug", "DEBUG", queue_handlers, 1.0),
+                ("queue-debug-sampled", "DEBUG", queue_handlers, args.sample_rate)]
+    results = []
+    for pipeline in args.pipelines:
+        agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline=pipeline)
+        logging.disable(logging.CRITICAL)
+        for question in questions[:20]: # ウォームアップ
+            agent.invoke({"messages": [HumanMessage(content=question)]})
+        # 方式の順序による偏りを避けるため、ラウンドごとに全方式を交互に実行し、中央値をとる
+        samples: Dict[str, List[float]] = {name: [] for name, *_ in variants}
+        question_iter = iter(questions * (args.requests * len(variants) // len(questions) + 1))
+        for _ in range(args.rounds):
+            for name, level, handlers, sample_rate in variants:
+                root.handlers = handlers
+                logging.disable(logging.CRITICAL if level is None else logging.NOTSET)
+                logging_setup.configure_logging(level or "INFO", payload_sample_rate=sample_rate)
+                per_round = max(1, args.requests // args.rounds)
+                start = time.perf_counter()
+                for _ in range(per_round):
+                    agent.invoke({"messages": [HumanMessage(content=next(question_iter))]})
+                samples[name].append((time.perf_counter() - start) * 1000 / per_round)
+        baseline_ms = statistics.median(samples["disabled"])
+        for name, level, _, sample_rate in variants:
+            per_request_ms = statistics.median(samples[name])
+            results.append({"doc": doc_name, "pipeline": pipeline, "logging": name,
+                            "payload_sample_rate": sample_rate if level == "DEBUG" else None,
+                            "per_request_ms": round(per_request_ms, 3),
+                            "overhead_ms": round(per_request_ms - baseline_ms, 3)})
+    logging.disable(logging.NOTSET)
+    root.handlers = queue_handlers
+    logging_setup.configure_logging("INFO", payload_sample_rate=1.0)
+    return results
+
+
+def bench_llm_pool(args: argparse.Namespace) -> List[dict]:
+    """ローカルのスタブHTTPエンドポイントに対してGeminiクライアントで多数のリクエストを送り、
+    リクエストごとにクライアントを作成する場合と、クライアントプールを使う場合の接続数・所要時間を比較します。
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    from llm_provider import LLM_ROLES, GeminiProvider, LLMClientPool
+
+    connections = []
+    response_body = json.dumps({
+        "candidates": [{"content": {"parts": [{"text": "その他"}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 1, "totalTokenCount": 11},
+    }).encode("utf-8")
+
+    class StubGeminiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive
+        disable_nagle_algorithm = True # ヘッダーと本文の分割送信で遅延ACKを待たないようにする
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+
+        def log_message(self, format, *args):
+            pass
+
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubGeminiHandler)
+    stub.daemon_threads = True
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{stub.server_port}"
+    roles = list(LLM_ROLES)
+
+    def per_call(request_number: int):
+        # 変更前の classify_category と同様に、リクエストごとにクライアントを作成する
+        return ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0, base_url=base_url,
+                                      google_api_key="stub-key")
+
+    pool = LLMClientPool(base_url=base_url, google_api_key="stub-key")
+    # セッションごとにプロバイダーを作成しても、クライアントはプールで共有される
+    providers = [GeminiProvider(pool=pool) for _ in range(args.sessions)]
+
+    def pooled(request_number: int):
+        return providers[request_number % len(providers)].chat_model(roles[request_number % len(roles)])
+
+    results = []
+    for variant, get_model in (("per-call", per_call), ("pooled", pooled)):
+        connections.clear()
+        start = time.perf_counter()
+        for request_number in range(args.requests):
+            get_model(request_number).invoke("この質問のカテゴリーは？")
+        elapsed = time.perf_counter() - start
+        result = {"variant": variant, "requests": args.requests, "connections": len(connections),
+                  "requests_per_connection": round(args.requests / max(1, len(connections)), 1),
+                  "per_request_ms": round(elapsed * 1000 / args.requests, 3)}
+        if variant == "pooled":
+            result["pool"] = pool.stats()
+        results.append(result)
+    stub.shutdown()
+    stub.server_close()
+    return results
+
+
+def bench_classifier(args: argparse.Namespace) -> List[dict]:
+    """doc/ 内の各コーパスで、ローカルのカテゴリー分類器のオフライン正解率（1行ずつ除いて学習）と、
+    閾値ごとのLLM呼び出しを省略できる割合を計測します。
+    あわせて、コーパスの質問文でfast構成のエージェントを実行し、1問あたりのLLM呼び出し回数を比較します（偽LLM使用）。
+    """
+    from langchain_core.messages import HumanMessage
+
+    import app
+    from category_classifier import evaluate_leave_one_out
+
+    fake_llm = patch_fake_llm(0.0)
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        result = {"doc": doc_name, "categories": len(categories), **evaluate_leave_one_out(qa_data, args.thresholds)}
+        questions = [item["質問"] for item in qa_data]
+        for label, threshold in (("llm_calls_per_question_llm_only", None),
+                                 ("llm_calls_per_question_local", app.LOCAL_CLASSIFIER_THRESHOLD)):
+            agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                         local_classifier_threshold=threshold)
+            fake_llm.call_count = 0
+            for question in questions:
+                agent.invoke({"messages": [HumanMessage(content=question)]})
+            result[label] = round(fake_llm.call_count / len(questions), 3)
+        results.append(result)
+    return results
+
+
+def bench_fallback(args: argparse.Namespace) -> List[dict]:
+    """LLMによるカテゴリー分類が誤った場合（「その他」/ 別のカテゴリー）を偽LLMで再現し、
+    カテゴリー横断の検索の有無ごとに、正しい回答を返せた割合と1問あたりのLLM呼び出し回数を比較します（fast構成）。
+    """
+    import re
+
+    from langchain_core.messages import HumanMessage, ToolMessage
+
+    import app
+    from fake_llm import default_responder
+
+    fake_llm = patch_fake_llm(0.0)
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        rows_by_question = {row["質問"]: row for row in qa_data}
+        for scenario in ("その他", "wrong-category"):
+            def misclassifying_responder(prompt: str) -> str:
+                match = re.search(r"質問: (.*)\n分類:", prompt)
+                if match is None:
+                    return default_responder(prompt)
+                if scenario == "その他":
+                    return "その他"
+                true_category = rows_by_question[match.group(1)]["カテゴリー"]
+                return next(category for category in categories if category != true_category)
+
+            fake_llm.responder = misclassifying_responder
+            for fallback in (False, True):
+                agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                             local_classifier_threshold=None, cross_category_fallback=fallback)
+                fake_llm.call_count = 0
+                correct = 0
+                for row in qa_data:
+                    messages = agent.invoke({"messages": [HumanMessage(content=row["質問"])]})["messages"]
+                    tool_message = [message for message in messages if isinstance(message, ToolMessage)][-1]
+                    correct += tool_message.content == row["回答例"]
+                results.append({"doc": doc_name, "misclassified_as": scenario, "cross_category_fallback": fallback,
+                                "answer_found_rate": round(correct / len(qa_data), 3),
+                                "llm_calls_per_question": round(fake_llm.call_count / len(qa_data), 3)})
+    fake_llm.responder = default_responder
+    return results
+
+
+def bench_partition(args: argparse.Namespace) -> List[dict]:
+    """カテゴリーの絞り込みと評価用の候補一覧の整形にかかる1クエリあたりの時間と、事前構築した索引のメモリ量を比較します。
+    scan は従来の方式（クエリごとに全行を走査してカテゴリーで絞り込み、候補一覧を整形）、
+    partition は事前に構築したカテゴリー別の索引を参照する方式です（LLM・検索エンジンは使用しません）。
+    行データはJSONを経由して作成し、ファイルから読み込んだ場合と同様に行ごとに別のカテゴリー文字列を持たせます。
+    索引の構築時間は tracemalloc を有効にした状態での値です。
+    """
+    import tracemalloc
+
+    from app import LEXICAL_TOP_K, format_qa_block
+    from retrieval import partition_by_category
+
+    results = []
+    for n_categories in args.categories:
+        qa_data = json.loads(json.dumps(synthetic_qa_data(args.rows, n_categories), ensure_ascii=False))
+        categories = sorted({row["カテゴリー"] for row in qa_data})
+        rng = random.Random(0)
+        queries = [rng.choice(categories) for _ in range(args.repeat)]
+
+        def category_string_bytes() -> int:
+            strings = {id(row["カテゴリー"]): row["カテゴリー"] for row in qa_data}
+            return sum(sys.getsizeof(string) for string in strings.values())
+
+        strings_before = category_string_bytes()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        partition = partition_by_category(qa_data)
+        evaluation_blocks = {category: format_qa_block(rows) for category, rows in partition.items()
+                             if len(rows) <= LEXICAL_TOP_K}
+        build_seconds = time.perf_counter() - start
+        index_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        strings_after = category_string_bytes()
+
+        def scan(category: str) -> str:
+            filtered = [item for item in qa_data if item.get("カテゴリー") == category]
+            return "\n".join(f"QA_PAIR_{idx+1}: 質問: {item['質問']}" for idx, item in enumerate(filtered))
+
+        def lookup(category: str) -> str:
+            rows = partition.rows(category)
+            if len(rows) <= LEXICAL_TOP_K:
+                return evaluation_blocks[category]
+            return format_qa_block(rows[:LEXICAL_TOP_K])
+
+        query_iter = iter(queries * 2)
+        scan_latencies = measure_latencies(lambda: scan(next(query_iter)), args.repeat)
+        lookup_latencies = measure_latencies(lambda: lookup(next(query_iter)), args.repeat)
+        results.append({
+            "rows": args.rows, "categories": n_categories,
+            "scan_p50_ms": scan_latencies["p50_ms"], "scan_p99_ms": scan_latencies["p99_ms"],
+            "partition_p50_ms": lookup_latencies["p50_ms"], "partition_p99_ms": lookup_latencies["p99_ms"],
+            "partition_build_s": round(build_seconds, 2),
+            # 行データ自体は共有するため、索引のメモリはカテゴリー別のリスト・行番号・整形済みの候補一覧のみ
+            "index_mb": round(index_bytes / 1024 / 1024, 1),
+            "category_strings_mb": f"{strings_before / 1024 / 1024:.1f} -> {strings_after / 1024 / 1024:.3f}",
+        })
+    return results
+
+
+def bench_chunked_scoring(args: argparse.Namespace) -> List[dict]:
+    """候補数（lexical_top_k）ごとに、全候補を1回のプロンプトで評価する方式（single）と、
+    chunk_size 件ずつに分割して並列に評価する方式（chunked）の回答までの時間を比較します。
+    偽LLMの遅延は、呼び出しごとの固定遅延 + プロンプトの文字数 / input_tps + 応答の文字数 / output_tps です。
+    """
+    from langchain_core.messages import HumanMessage, ToolMessage
+
+    import app
+
+    fake_llm = patch_fake_llm(args.latency)
+    fake_llm.tokens_per_second = args.output_tps
+    fake_llm.input_tokens_per_second = args.input_tps
+    # 1カテゴリーのコーパスにし、評価対象の候補数を lexical_top_k で決める
+    qa_data = synthetic_qa_data(args.rows, n_categories=1)
+    categories = sorted({row["カテゴリー"] for row in qa_data})
+    rows = random.Random(0).sample(qa_data, args.questions)
+    results = []
+    for candidates in args.candidates:
+        for label, options in (
+            ("single", {"relevance_chunk_size": candidates}),
+            ("chunked", {"relevance_chunk_size": args.chunk_size, "relevance_parallelism": args.parallelism}),
+        ):
+            agent = app.create_agent_app(qa_data, categories, "合成FAQ", "あなたは合成FAQのアシスタントです。",
+                                         pipeline="fast", lexical_top_k=candidates, **options)
+            fake_llm.call_count = 0
+            correct = 0
+            samples = []
+            for row in rows:
+                start = time.perf_counter()
+                messages = agent.invoke({"messages": [HumanMessage(content=row["質問"])]})["messages"]
+                samples.append((time.perf_counter() - start) * 1000)
+                tool_message = [message for message in messages if isinstance(message, ToolMessage)][-1]
+                correct += tool_message.content == row["回答例"]
+            samples.sort()
+            results.append({"candidates": candidates, "mode": label,
+                            "chunks": -(-candidates // options["relevance_chunk_size"]),
+                            "p50_ms": round(statistics.median(samples), 1),
+                            "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 1),
+                            "llm_calls_per_question": round(fake_llm.call_count / len(rows), 2),
+                            "answer_found_rate": round(correct / len(rows), 3)})
+    return results
+
+
+RELEVANCE_CORRUPTIONS = ("prose", "trailing", "truncated", "garbage")
+
+
+def _corrupt_response(text: str, kind: str, cut: float) -> str:
+    # 構造化出力を使わない場合に起こる崩れた応答を再現する
+    if kind == "prose":
+        return f"評価結果は以下の通りです。\n```json\n{text}\n```\n以上です。"
+    if kind == "trailing":
+        return f"{text}\n※スコアは質問文の意味的な近さに基づいています。"
+    if kind == "truncated":
+        return text[:max(1, int(len(text) * cut))]
+    return "申し訳ありません、評価できませんでした。"
+
+
+def bench_structured_relevance(args: argparse.Namespace) -> List[dict]:
+    """関連度評価の応答の一部を崩した偽LLM（前後の文章・コードブロック / 末尾の補足 / 途中で途切れる / JSONでない）で、
+    従来の形式（全候補の evaluations 配列 + most_relevant_index / max_score）を従来のパース（コードブロック記号の除去と json.loads）
+    または parse_relevance_response で読んだ場合と、最小限のスキーマ（index, score）を parse_relevance_response で読んだ場合の
+    読み取り失敗率を比較します。
+    あわせて再評価の回数ごとのエラー応答の割合・1問あたりのLLM呼び出し回数と、応答の平均文字数（偽LLMのトークン数）を出力します。
+    """
+    from langchain_core.messages import HumanMessage, ToolMessage
+
+    import app
+    from fake_llm import _scored_qa_pairs, default_responder
+    from relevance_parsing import parse_relevance_response
+
+    fake_llm = patch_fake_llm(0.0)
+    evaluation_error = "申し訳ございません、関連情報の評価中にエラーが発生しました。別の言葉でお試しください。"
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        for retries in args.retries:
+            rng = random.Random(args.seed)
+            stats = {"responses": 0, "legacy_failed": 0, "legacy_tolerant_failed": 0, "failed": 0, "salvaged": 0,
+                     "legacy_chars": 0, "legacy_top3_chars": 0, "chars": 0}
+
+            def corrupting_responder(prompt: str) -> str:
+                response = default_responder(prompt)
+                if "社内ドキュメントの質問リスト" not in prompt:
+                    return response
+                query = prompt.split('ユーザーの質問: "', 1)[1].split('"\n', 1)[0]
+                scored = _scored_qa_pairs(query, prompt)
+                evaluations = [{"index": index, "score": score} for index, _, score in sorted(scored)]
+                legacy = json.dumps({"evaluations": evaluations, "most_relevant_index": scored[0][0],
+                                     "max_score": scored[0][2]})
+                legacy_top3 = json.dumps({"evaluations": [{"index": index, "score": score} for index, _, score in scored[:3]],
+                                          "most_relevant_index": scored[0][0], "max_score": scored[0][2]})
+                stats["responses"] += 1
+                stats["legacy_chars"] += len(legacy)
+                stats["legacy_top3_chars"] += len(legacy_top3)
+                stats["chars"] += len(response)
+                if rng.random() < args.corruption_rate:
+                    kind, cut = rng.choice(RELEVANCE_CORRUPTIONS), rng.random()
+                    legacy, response = _corrupt_response(legacy, kind, cut), _corrupt_response(response, kind, cut)
+                try:
+                    stats["legacy_failed"] += not isinstance(app.parse_json_response(legacy).get("most_relevant_index"), int)
+                except (json.JSONDecodeError, AttributeError):
+                    stats["legacy_failed"] += 1
+                stats["legacy_tolerant_failed"] += parse_relevance_response(legacy)[1] == "failed"
+                _, outcome = parse_relevance_response(response)
+                stats["failed"] += outcome == "failed"
+                stats["salvaged"] += outcome == "salvaged"
+                return response
+
+            fake_llm.responder = corrupting_responder
+            agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                         relevance_parse_retries=retries)
+            fake_llm.call_count = 0
+            errors = correct = 0
+            for row in qa_data:
+                messages = agent.invoke({"messages": [HumanMessage(content=row["質問"])]})["messages"]
+                tool_message = [message for message in messages if isinstance(message, ToolMessage)][-1]
+                errors += tool_message.content == evaluation_error
+                correct += tool_message.content == row["回答例"]
+            responses = max(1, stats["responses"])
+            results.append({
+                "doc": doc_name, "corruption_rate": args.corruption_rate, "parse_retries": retries,
+                "legacy_parse_failure_rate": round(stats["legacy_failed"] / responses, 3),
+                "legacy_tolerant_parse_failure_rate": round(stats["legacy_tolerant_failed"] / responses, 3),
+                "parse_failure_rate": round(stats["failed"] / responses, 3),
+                "salvaged_rate": round(stats["salvaged"] / responses, 3),
+                "error_answer_rate": round(errors / len(qa_data), 3),
+                "answer_found_rate": round(correct / len(qa_data), 3),
+                "llm_calls_per_question": round(fake_llm.call_count / len(qa_data), 3),
+                "output_chars_legacy": round(stats["legacy_chars"] / responses, 1),
+                "output_chars_legacy_top3": round(stats["legacy_top3_chars"] / responses, 1),
+                "output_chars": round(stats["chars"] / responses, 1),
+            })
+    fake_llm.responder = default_responder
+    return results
+
+
+def bench_ui_rerun(args: argparse.Namespace) -> List[dict]:
+    """Streamlit の AppTest で ui_app.py を実行し、初回の実行と、その後の再実行（ボタンのクリックやチャットの送信ごとに
+    起きるスクリプト全体の再実行）の所要時間を計測します。偽LLMを使用し、LLMは呼び出しません。
+    スクリプトは一時ディレクトリにコピーし、doc/ の各コーパスと、--categories のカテゴリー数ごとに --rows 行の合成コーパス
+    （--rows 0 では使わない）を配置して実行します。質問テンプレートの iframe（components.html）とネイティブなウィジェットの数、
+    それらのブラウザに送る要素のサイズもあわせて出力します。
+    """
+    import shutil
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # LLMプロバイダーとインデックスのキャッシュは、モジュールの読み込み時に環境変数から決まる
+        os.environ["LLM_PROVIDER"] = "fake"
+        os.environ["FAQ_INDEX_CACHE_DIR"] = os.path.join(work_dir, "cache")
+        from streamlit.testing.v1 import AppTest
+
+        from faq_loader import discover_faq_files, write_json
+
+        source_doc_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc")
+        doc_dir = os.path.join(work_dir, "doc")
+        os.makedirs(doc_dir)
+        for file_path in discover_faq_files(source_doc_dir):
+            shutil.copy(file_path, doc_dir)
+        if os.path.isdir(os.path.join(source_doc_dir, "prompts")):
+            shutil.copytree(os.path.join(source_doc_dir, "prompts"), os.path.join(doc_dir, "prompts"))
+        corpora = [os.path.basename(file_path) for file_path in discover_faq_files(doc_dir)]
+        for n_categories in args.categories if args.rows else []:
+            corpus = f"synthetic_{n_categories}cat.json"
+            write_json({"metadata": {"description": "合成FAQ"}, "data": synthetic_qa_data(args.rows, n_categories)},
+                       os.path.join(doc_dir, corpus))
+            corpora.append(corpus)
+        script_path = os.path.join(work_dir, "ui_app.py")
+        shutil.copy(args.script, script_path)
+
+        results = []
+        for corpus in corpora:
+            app_test = AppTest.from_file(script_path, default_timeout=600)
+            app_test.session_state["selected_doc_name"] = corpus
+            start = time.perf_counter()
+            app_test.run()
+            first_run_ms = (time.perf_counter() - start) * 1000
+            if app_test.exception:
+                raise RuntimeError(f"{corpus}: {app_test.exception[0].message}")
+            samples = []
+            for _ in range(args.reruns):
+                start = time.perf_counter()
+                app_test.run()
+                samples.append((time.perf_counter() - start) * 1000)
+            samples.sort()
+            iframes, widgets = app_test.get("iframe"), app_test.get("button_group")
+            template_bytes = sum(len(element.proto.SerializeToString()) for element in [*iframes, *widgets])
+            results.append({"script": os.path.basename(args.script), "corpus": corpus,
+                            "template_iframes": len(iframes), "template_widgets": len(widgets),
+                            "template_payload_kb": round(template_bytes / 1024, 1),
+                            "first_run_ms": round(first_run_ms, 1),
+                            "rerun_p50_ms": round(statistics.median(samples), 1),
+                            "rerun_p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 1)})
+    return results
+
+
+def _saver_bytes(saver, thread_id: str) -> int:
+    # チェックポインターがスレッドのために保持しているシリアライズ済みのデータの合計バイト数
+    if hasattr(saver, "stored_bytes"):
+        return saver.stored_bytes(thread_id)
+    total = sum(len(checkpoint[1]) + len(metadata[1]) for checkpoints in saver.storage.get(thread_id, {}).values()
+                for checkpoint, metadata, _ in checkpoints.values())
+    total += sum(len(value[1]) for key, value in saver.blobs.items() if key[0] == thread_id)
+    return total + sum(len(write[2][1]) for key, writes in saver.writes.items() if key[0] == thread_id
+                       for write in writes.values())
+
+
+def bench_conversation_memory(args: argparse.Namespace) -> List[dict]:
+    """1つの会話（thread_id）で --turns ターンの質問を続け、--report-every ターンごとに、会話の状態が使うメモリ
+    （tracemalloc で計測したプロセス内の増加分と、チェックポインターが保存しているバイト数）、プロンプトに埋め込む
+    会話の文脈のトークン数（概算）、1ターンの所要時間と要約のLLM呼び出し回数を出力します（偽LLM使用）。
+    unbounded は標準の InMemorySaver で履歴を要約しない構成（ステップごとのチェックポイントと全履歴を保持）です。
+    """
+    import gc
+    import tempfile
+    import tracemalloc
+
+    from langchain_core.messages import HumanMessage
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    import app
+    from checkpoint_store import LatestInMemorySaver, SQLiteCheckpointSaver
+    from conversation_memory import HISTORY_TOKEN_BUDGET, estimate_tokens, format_conversation
+
+    fake_llm = patch_fake_llm()
+    doc_name, qa_data, categories, identity = load_doc_corpora()[0]
+    questions = [item["質問"] for item in qa_data if item.get("質問")]
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        variants = {
+            "unbounded": (lambda: InMemorySaver(), None),
+            "window+memory": (lambda: LatestInMemorySaver(), HISTORY_TOKEN_BUDGET),
+            "window+sqlite": (lambda: SQLiteCheckpointSaver(os.path.join(work_dir, "conversations.sqlite3")),
+                              HISTORY_TOKEN_BUDGET),
+        }
+        for variant in args.variants:
+            make_saver, token_budget = variants[variant]
+            saver = make_saver()
+            agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                         history_token_budget=token_budget, checkpointer=saver)
+            config = {"configurable": {"thread_id": "bench"}}
+            gc.collect()
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            samples, calls_before = [], fake_llm.call_count
+            for turn in range(1, args.turns + 1):
+                start = time.perf_counter()
+                agent.invoke({"messages": [HumanMessage(content=questions[turn % len(questions)])]}, config)
+                samples.append((time.perf_counter() - start) * 1000)
+                if turn % args.report_every == 0:
+                    gc.collect()
+                    values = agent.get_state(config).values
+                    results.append({
+                        "variant": variant, "doc": doc_name, "turn": turn,
+                        "retained_kb": round((tracemalloc.get_traced_memory()[0] - baseline) / 1024, 1),
+                        "stored_kb": round(_saver_bytes(saver, "bench") / 1024, 1),
+                        "context_tokens": estimate_tokens(format_conversation(values.get("summary", ""),
+                                                                              values.get("history", []))),
+                        "turn_p50_ms": round(statistics.median(samples), 2),
+                        "llm_calls_per_turn": round((fake_llm.call_count - calls_before) / len(samples), 2),
+                    })
+                    samples, calls_before = [], fake_llm.call_count
+            tracemalloc.stop()
+            if hasattr(saver, "close"):
+                saver.close()
+    return results
+
+
+def bench_prompt_prefix(args: argparse.Namespace) -> List[dict]:
+    """doc/ 内の各コーパスでグラフ構成ごとに複数ターンの会話を実行し、LLMに送ったすべてのプロンプトが
+    登録されたテンプレートのプレフィックス（LLMProvider.register_prompt_prefix）で始まることを検証します（偽LLM使用）。
+    同じコーパスからエージェントを2回作成し、プレフィックスがバイト単位で一致することも検証します。
+    構成ごとにプロンプトに占めるプレフィックスの割合と、偽LLMが報告したキャッシュ済みのトークンの割合を出力し、
+    最後にテンプレートごとの1リクエストあたりのプロンプトの組み立て時間（マイクロ秒）を出力します。
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.messages import HumanMessage
+
+    import app
+    from checkpoint_store import LatestInMemorySaver
+    from llm_provider import FakeProvider
+    from prompt_templates import CorpusPrompts
+
+    class PromptRecorder(BaseCallbackHandler):
+        def __init__(self):
+            self.prompts: List[str] = []
+            self.input_tokens = self.cached_tokens = 0
+
+        def on_chat_model_start(self, serialized, messages, **kwargs):
+            self.prompts.extend("\n".join(str(message.content) for message in batch) for batch in messages)
+
+        def on_llm_end(self, response, **kwargs):
+            for generations in response.generations:
+                for generation in generations:
+                    usage = getattr(generation.message, "usage_metadata", None) or {}
+                    self.input_tokens += usage.get("input_tokens", 0)
+                    self.cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0)
+
+    variants = {"classic": {"pipeline": "classic"}, "fast": {"pipeline": "fast"},
+                "fast+fused": {"pipeline": "fast", "fuse_classification": True}}
+    results = []
+    for doc_name, qa_data, categories, identity in load_doc_corpora():
+        system_prompt = f"あなたは{identity}です。"
+        questions = [item["質問"] for item in qa_data if item.get("質問")]
+        registered = None
+        for variant, options in variants.items():
+            provider = FakeProvider()
+            agent = app.create_agent_app(qa_data, categories, identity, system_prompt, llm_provider=provider,
+                                         checkpointer=LatestInMemorySaver(), **options)
+            prefixes = dict(provider.model.prompt_prefixes)
+            if registered is not None and {key: prefixes[key] for key in registered} != registered:
+                raise AssertionError(f"{doc_name}: エージェントを作成し直すとプレフィックスが変わりました")
+            registered = registered or prefixes
+            recorder = PromptRecorder()
+            for conversation in range(args.conversations):
+                config = {"callbacks": [recorder], "configurable": {"thread_id": f"bench-{conversation}"}}
+                for turn in range(args.turns):
+                    question = questions[(conversation * args.turns + turn) % len(questions)]
+                    agent.invoke({"messages": [HumanMessage(content=question)]}, config)
+            prefix_chars, used_keys = 0, set()
+            for prompt in recorder.prompts:
+                matches = [(len(prefix), key) for key, prefix in prefixes.items() if prompt.startswith(prefix)]
+                if not matches:
+                    raise AssertionError(f"{doc_name}/{variant}: 登録されたプレフィックスで始まらないプロンプトです: {prompt[:80]!r}")
+                length, key = max(matches)
+                prefix_chars += length
+                used_keys.add(key)
+            total_chars = sum(len(prompt) for prompt in recorder.prompts)
+            results.append({
+                "doc": doc_name, "pipeline": variant, "prompts": len(recorder.prompts),
+                "templates_registered": len(prefixes), "templates_used": len(used_keys),
+                "prefix_share": round(prefix_chars / total_chars, 3) if total_chars else 0.0,
+                "cached_token_share": round(recorder.cached_tokens / recorder.input_tokens, 3)
+                if recorder.input_tokens else 0.0,
+            })
+
+        # テンプレートごとの組み立て時間（関連度評価は、質問リストを事前に整形したテンプレートと、リクエストごとに整形する場合を比較）
+        category_rows = {category: [row for row in qa_data if row.get("カテゴリー") == category] for category in categories}
+        prompts = CorpusPrompts(system_prompt, identity, categories,
+                                {category: app.format_qa_block(rows) for category, rows in category_rows.items() if rows})
+        query, conversation_text = questions[0], "直近の会話:\nユーザー: こんにちは\nアシスタント: こんにちは。"
+        category = next(category for category, rows in category_rows.items() if rows)
+        renders = {
+            "classifier": lambda: prompts.classifier.render(conversation=conversation_text, question=query),
+            "relevance (precompiled)": lambda: prompts.category_relevance[category].render(query=query),
+            "relevance (per-request)": lambda: prompts.relevance.render(
+                category=category, qa_block=app.format_qa_block(category_rows[category]), query=query),
+            "tool_request": lambda: prompts.tool_request.render(query=query, category=category),
+            "answer": lambda: prompts.answer.render(conversation=conversation_text, query=query,
+                                                    tool_result=qa_data[0].get("回答", "")),
+        }
+        for name, render in renders.items():
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                render()
+            results.append({"doc": doc_name, "template": name, "chars": len(render()),
+                            "render_us": round((time.perf_counter() - start) / args.repeat * 1e6, 2)})
+    return results
+
+
+def bench_direct_answer(args: argparse.Namespace) -> List[dict]:
+    """最終応答の高速パスのポリシー（off / verbatim / template / rephrased）ごとに、回答までの時間と、
+    generate_final_response のLLM呼び出しを省略した質問の割合（高速パスの割合）を計測します（遅延と生成速度を設定した偽LLM使用）。
+    質問は、FAQの質問そのもの・前半だけの言い換え・FAQにない質問を順に混ぜたものです。
+    rephrased では、計測の前に direct_answer.rephrase_corpus で全回答例を言い換えた参照表を作成します（作成時間も出力）。
+    """
+    import tempfile
+
+    from langchain_core.callbacks import BaseCallbackHandler
+    from langchain_core.messages import HumanMessage
+
+    import app
+    from direct_answer import DirectAnswerPolicy, RephrasedAnswers, rephrase_corpus
+    from llm_provider import FakeProvider
+
+    class FinalResponseCounter(BaseCallbackHandler):
+        def __init__(self):
+            self.calls = 0
+
+        def on_chat_model_start(self, serialized, messages, *, metadata=None, **kwargs):
+            if (metadata or {}).get("langgraph_node") == app.STREAMED_NODE:
+                self.calls += 1
+
+    off_topic = ["今日の天気はどうですか？", "おすすめの映画を教えてください。", "株価の見通しは？"]
+    provider = FakeProvider(latency=args.latency, tokens_per_second=args.tokens_per_second)
+    results = []
+    baseline_ms = {} # コーパスごとの off の平均（off を計測しない場合は削減率を出力しない）
+    with tempfile.TemporaryDirectory() as work_dir:
+        rephrased = RephrasedAnswers(os.path.join(work_dir, "rephrased_answers.json"))
+        for doc_name, qa_data, categories, identity in load_doc_corpora():
+            faq_questions = [item["質問"] for item in qa_data if item.get("質問")]
+            questions = []
+            for position in range(args.questions):
+                question = faq_questions[position // 3 % len(faq_questions)]
+                questions.append([question, question[:len(question) // 2] + "について知りたいです。",
+                                  off_topic[position // 3 % len(off_topic)]][position % 3])
+            for policy_name in args.policies:
+                if policy_name == "rephrased":
+                    start = time.perf_counter()
+                    count = rephrase_corpus(qa_data, identity, rephrased, FakeProvider())
+                    results.append({"doc": doc_name, "policy": policy_name, "rephrased_answers": count,
+                                    "rephrase_build_s": round(time.perf_counter() - start, 3)})
+                policy = DirectAnswerPolicy(policy_name, args.threshold, rephrased if policy_name == "rephrased" else None)
+                agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。",
+                                             pipeline=args.pipeline, llm_provider=provider, direct_answer=policy)
+                counter = FinalResponseCounter()
+                samples = {"fast": [], "llm": []}
+                for question in questions:
+                    calls_before, start = counter.calls, time.perf_counter()
+                    agent.invoke({"messages": [HumanMessage(content=question)]}, {"callbacks": [counter]})
+                    samples["llm" if counter.calls > calls_before else "fast"].append((time.perf_counter() - start) * 1000)
+                all_samples = samples["fast"] + samples["llm"]
+                mean_ms = statistics.mean(all_samples)
+                baseline_ms.setdefault(doc_name, mean_ms if policy_name == "off" else None)
+                results.append({
+                    "doc": doc_name, "policy": policy_name, "pipeline": args.pipeline, "questions": len(questions),
+                    "fast_path_share": round(len(samples["fast"]) / len(questions), 3),
+                    "mean_ms": round(mean_ms, 1), **_percentiles(all_samples),
+                    "fast_path_mean_ms": round(statistics.mean(samples["fast"]), 1) if samples["fast"] else None,
+                    "llm_path_mean_ms": round(statistics.mean(samples["llm"]), 1) if samples["llm"] else None,
+                    "mean_reduction": round(1 - mean_ms / baseline_ms[doc_name], 3) if baseline_ms[doc_name] else None,
+                })
+    return results
+
+
+def _current_rss_bytes() -> int:
+    # Linux では現在のRSS、それ以外では最大RSSを返す
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _faq_store_probe(mode: str, json_path: str, store_dir: str, result_queue) -> None:
+    # 別プロセスで1つの方式だけを読み込み、読み込み前後のRSSの差と行アクセスの時間を返す
+    import gc
+
+    from faq_loader import load_faq_data
+    from faq_store import FaqStore
+    from retrieval import partition_by_category
+
+    gc.collect()
+    baseline = _current_rss_bytes()
+    start = time.perf_counter()
+    if mode == "dicts":
+        qa_data = load_faq_data(json_path)["data"]
+    elif mode == "store":
+        faq_data = load_faq_data(json_path)
+        qa_data = FaqStore.from_faq_data(faq_data)
+        del faq_data
+    else:
+        qa_data = FaqStore.load(store_dir)
+    partition = partition_by_category(qa_data)
+    load_seconds = time.perf_counter() - start
+    gc.collect()
+    rss = _current_rss_bytes() - baseline
+
+    rng = random.Random(0)
+    categories = list(partition)
+    lookups = [(rng.choice(categories), rng.random()) for _ in range(10000)]
+    start = time.perf_counter()
+    for category, fraction in lookups:
+        rows = partition[category]
+        rows[int(fraction * len(rows))].get("回答例")
+    access_us = (time.perf_counter() - start) / len(lookups) * 1e6
+    result_queue.put({"load_s": round(load_seconds, 2), "rss_mb": round(rss / 1024 / 1024, 1),
+                      "row_access_us": round(access_us, 2)})
+
+
+def bench_faq_store(args: argparse.Namespace) -> List[dict]:
+    """合成コーパスを行の辞書（従来）/ 列指向の FaqStore / 保存済みの FaqStore のメモリマップで読み込み、
+    カテゴリー別に分割した状態でのRSSの増加量と、ランダムな行の回答例を読む時間を比較します。
+    各方式はそれぞれ別のプロセスで計測します。
+    """
+    import multiprocessing
+    import tempfile
+
+    from faq_store import FaqStore
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        faq_data = {"metadata": {"description": "合成FAQ"},
+                    "data": synthetic_qa_data(args.rows, args.categories)}
+        json_path = os.path.join(tmp_dir, "synthetic_faq.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(faq_data, f, ensure_ascii=False)
+        store_dir = os.path.join(tmp_dir, "faq_store")
+        os.makedirs(store_dir)
+        FaqStore.from_faq_data(faq_data).save(store_dir)
+        del faq_data
+
+        for mode in ("dicts", "store", "store-mmap"):
+            result_queue = context.Queue()
+            process = context.Process(target=_faq_store_probe, args=(mode, json_path, store_dir, result_queue))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            results.append({"rows": args.rows, "categories": args.categories, "mode": mode, **result})
+    return results
+
+
+BENCHMARKS = {
+    "retrieval": bench_retrieval,
+    "index-cache": bench_index_cache,
+    "load": bench_load,
+    "pipeline": bench_pipeline,
+    "sessions": bench_sessions,
+    "async": bench_async,
+    "server": bench_server,
+    "e2e": bench_e2e,
+    "logging": bench_logging,
+    "llm-pool": bench_llm_pool,
+    "classifier": bench_classifier,
+    "fallback": bench_fallback,
+    "partition": bench_partition,
+    "faq-store": bench_faq_store,
+    "chunked-scoring": bench_chunked_scoring,
+    "structured-relevance": bench_structured_relevance,
+    "ui-rerun": bench_ui_rerun,
+    "conversation-memory": bench_conversation_memory,
+    "prompt-prefix": bench_prompt_prefix,
+    "direct-answer": bench_direct_answer,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FAQエージェントの性能ベンチマーク")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    retrieval_parser = subparsers.add_parser("retrieval", help="検索エンジンのp50/p99レイテンシ")
+    retrieval_parser.add_argument("--sizes", type=int, nargs="+", default=[50, 5_000, 500_000])
+    retrieval_parser.add_argument("--engines", nargs="+", default=["embedding", "bm25"])
+    retrieval_parser.add_argument("--top-k", type=int, default=20)
+    retrieval_parser.add_argument("--repeat", type=int, default=200)
+
+    cache_parser = subparsers.add_parser("index-cache", help="インデックスのディスクキャッシュによる起動時間")
+    cache_parser.add_argument("--rows", type=int, default=100_000)
+    cache_parser.add_argument("--engines", nargs="+", default=["embedding", "bm25"])
+
+    load_parser = subparsers.add_parser("load", help="FAQファイル形式ごとの読み込み時間")
+    load_parser.add_argument("--rows", type=int, default=100_000, help="合成コーパスの行数")
+    load_parser.add_argument("--repeat", type=int, default=5)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="グラフ構成ごとの回答までの時間（偽LLM使用）")
+    pipeline_parser.add_argument("--latency", type=float, default=0.2, help="LLM呼び出し1回あたりの遅延（秒）")
+    pipeline_parser.add_argument("--questions", type=int, default=5, help="コーパスごとに使う質問数")
+    pipeline_parser.add_argument("--repeat", type=int, default=1)
+
+    sessions_parser = subparsers.add_parser("sessions", help="多数のセッションでのメモリ使用量と起動時間")
+    sessions_parser.add_argument("--sessions", type=int, default=200)
+
+    async_parser = subparsers.add_parser("async", help="同時会話数ごとの同期/非同期グラフのスループット（偽LLM使用）")
+    async_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    async_parser.add_argument("--latency", type=float, default=0.1, help="LLM呼び出し1回あたりの遅延（秒）")
+    async_parser.add_argument("--rounds", type=int, default=3, help="同時会話数あたりの会話数の倍率")
+
+    server_parser = subparsers.add_parser("server", help="HTTPサーバーの負荷試験（RPS・テールレイテンシ、偽LLM使用）")
+    server_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    server_parser.add_argument("--latency", type=float, default=0.1, help="LLM呼び出し1回あたりの遅延（秒）")
+    server_parser.add_argument("--rounds", type=int, default=4, help="同時接続数あたりのリクエスト数の倍率")
+    server_parser.add_argument("--workers", type=int, default=64)
+    server_parser.add_argument("--max-batch-size", type=int, default=8)
+    server_parser.add_argument("--max-wait-ms", type=float, default=10.0)
+
+    e2e_parser = subparsers.add_parser("e2e", help="全コーパスのノード別レイテンシ・トークン数・スループット")
+    e2e_parser.add_argument("--provider", choices=["fake", "cassette", "gemini"], default="fake")
+    e2e_parser.add_argument("--latency", type=float, default=0.1, help="偽LLMの遅延（秒、lognormalでは中央値）")
+    e2e_parser.add_argument("--latency-distribution", choices=["constant", "uniform", "normal", "lognormal"],
+                            default="lognormal")
+    e2e_parser.add_argument("--latency-spread", type=float, default=0.3)
+    e2e_parser.add_argument("--tokens-per-second", type=float, default=200.0, help="偽LLMの生成速度（0で無制限）")
+    e2e_parser.add_argument("--seed", type=int, default=0)
+    e2e_parser.add_argument("--cassette", default=os.path.join(".cache", "llm_cassette.json"))
+    e2e_parser.add_argument("--cassette-mode", choices=["replay", "record", "auto"], default="replay")
+    e2e_parser.add_argument("--questions", type=int, default=5, help="コーパスごとに使う質問数")
+    e2e_parser.add_argument("--pipelines", nargs="+", choices=["classic", "fast", "fast+fused"],
+                            default=["classic", "fast", "fast+fused"])
+    e2e_parser.add_argument("--output", help="結果を保存するJSONファイル")
+    e2e_parser.add_argument("--baseline", help="比較対象とする以前の --output のJSONファイル")
+
+    logging_parser = subparsers.add_parser("logging", help="ログ出力の方式ごとの1リクエストあたりのオーバーヘッド（偽LLM使用）")
+    logging_parser.add_argument("--requests", type=int, default=500, help="方式ごとのリクエスト数")
+    logging_parser.add_argument("--rounds", type=int, default=10)
+    logging_parser.add_argument("--pipelines", nargs="+", choices=["classic", "fast"], default=["classic", "fast"])
+    logging_parser.add_argument("--sample-rate", type=float, default=0.1, help="大きなペイロードのログのサンプリング率")
+
+    pool_parser = subparsers.add_parser("llm-pool", help="Geminiクライアントのプールによる接続の再利用（スタブHTTPエンドポイント使用）")
+    pool_parser.add_argument("--requests", type=int, default=1000)
+    pool_parser.add_argument("--sessions", type=int, default=20, help="プールを共有するプロバイダー（セッション）数")
+
+    classifier_parser = subparsers.add_parser("classifier", help="ローカルのカテゴリー分類器の正解率とLLM呼び出しの削減率")
+    classifier_parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9])
+
+    partition_parser = subparsers.add_parser("partition", help="カテゴリー別の索引による1クエリあたりの絞り込み時間とメモリ量")
+    partition_parser.add_argument("--rows", type=int, default=1_000_000)
+    partition_parser.add_argument("--categories", type=int, nargs="+", default=[10, 1000, 100_000])
+    partition_parser.add_argument("--repeat", type=int, default=20)
+    store_parser = subparsers.add_parser("faq-store", help="行の辞書と列指向の FaqStore（メモリマップ）のRSSと行アクセス時間")
+    store_parser.add_argument("--rows", type=int, default=1_000_000)
+    store_parser.add_argument("--categories", type=int, default=1000)
+    chunked_parser = subparsers.add_parser("chunked-scoring",
+                                           help="関連度評価の分割・並列実行の有無ごとの回答までの時間（遅延モデル付きの偽LLM使用）")
+    chunked_parser.add_argument("--rows", type=int, default=1000)
+    chunked_parser.add_argument("--candidates", type=int, nargs="+", default=[20, 100, 400])
+    chunked_parser.add_argument("--chunk-size", type=int, default=20)
+    chunked_parser.add_argument("--parallelism", type=int, default=4)
+    chunked_parser.add_argument("--questions", type=int, default=10)
+    chunked_parser.add_argument("--latency", type=float, default=0.3, help="LLM呼び出しごとの固定遅延（秒）")
+    chunked_parser.add_argument("--input-tps", type=float, default=4000.0, help="プロンプトの処理速度（文字/秒）")
+    chunked_parser.add_argument("--output-tps", type=float, default=200.0, help="応答の生成速度（文字/秒）")
+    structured_parser = subparsers.add_parser("structured-relevance",
+                                              help="崩れた関連度評価の応答の読み取り失敗率・再評価・応答の文字数（偽LLM使用）")
+    structured_parser.add_argument("--corruption-rate", type=float, default=0.2, help="応答を崩す割合")
+    structured_parser.add_argument("--retries", type=int, nargs="+", default=[0, 1], help="比較する再評価の回数")
+    structured_parser.add_argument("--seed", type=int, default=0)
+    ui_parser = subparsers.add_parser("ui-rerun", help="AppTest による ui_app.py の初回実行と再実行の所要時間（偽LLM使用）")
+    ui_parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ui_app.py"),
+                           help="計測するStreamlitスクリプト（変更前のスクリプトとの比較用）")
+    ui_parser.add_argument("--reruns", type=int, default=30)
+    ui_parser.add_argument("--rows", type=int, default=10_000, help="合成コーパスの行数（0で合成コーパスを使わない）")
+    ui_parser.add_argument("--categories", type=int, nargs="+", default=[10, 50, 200], help="合成コーパスのカテゴリー数")
+    memory_parser = subparsers.add_parser("conversation-memory",
+                                          help="長い会話での1セッションあたりのメモリ・会話の文脈の長さ・1ターンの所要時間（偽LLM使用）")
+    memory_parser.add_argument("--turns", type=int, default=500)
+    memory_parser.add_argument("--report-every", type=int, default=100)
+    memory_parser.add_argument("--variants", nargs="+", default=["unbounded", "window+memory", "window+sqlite"],
+                               choices=["unbounded", "window+memory", "window+sqlite"])
+    prefix_parser = subparsers.add_parser("prompt-prefix",
+                                          help="プロンプトのプレフィックスの安定性の検証とプレフィックスの割合・組み立て時間（偽LLM使用）")
+    prefix_parser.add_argument("--conversations", type=int, default=4)
+    prefix_parser.add_argument("--turns", type=int, default=12, help="1つの会話のターン数（要約のプロンプトも検証する）")
+    prefix_parser.add_argument("--repeat", type=int, default=2000, help="組み立て時間の計測の繰り返し回数")
+    direct_parser = subparsers.add_parser("direct-answer",
+                                          help="最終応答の高速パスのポリシーごとの回答までの時間と高速パスの割合（偽LLM使用）")
+    direct_parser.add_argument("--policies", nargs="+", choices=["off", "verbatim", "template", "rephrased"],
+                               default=["off", "verbatim", "template", "rephrased"])
+    direct_parser.add_argument("--threshold", type=float, default=90, help="高速パスを使う関連度スコアの下限")
+    direct_parser.add_argument("--pipeline", choices=["classic", "fast"], default="fast")
+    direct_parser.add_argument("--questions", type=int, default=12, help="コーパスごとの質問数")
+    direct_parser.add_argument("--latency", type=float, default=0.05, help="LLM呼び出し1回あたりの遅延（秒）")
+    direct_parser.add_argument("--tokens-per-second", type=float, default=400.0, help="偽LLMの生成速度（0で無制限）")
+    subparsers.add_parser("fallback", help="分類を誤った場合のカテゴリー横断の検索による回答率とLLM呼び出し回数（偽LLM使用）")
+
+    args = parser.parse_args()
+    if args.benchmark != "logging": # logging ベンチマークは出力先を os.devnull にして自ら設定する
+        from logging_setup import configure_logging
+
+        configure_logging()
+    for result in BENCHMARKS[args.benchmark](args):
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# 質問のカテゴリーを推定するローカル分類器
+# FAQの各行の「カテゴリー」ラベルから、文字n-gramの埋め込みによるカテゴリーごとの重心を学習します。
+# create_agent_app で確信度が閾値以上の予測はLLMによるカテゴリー分類を省略し、閾値未満の場合だけLLMに分類させます。
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from index_cache import IndexCache, default_index_cache
+from retrieval import HashingNgramEmbedder, partition_by_category
+
+
+class NearestCentroidClassifier:
+    """質問文と回答例の埋め込みの、カテゴリーごとの重心に最も近いカテゴリーを予測する分類器。
+    確信度は重心とのコサイン類似度に scale を掛けたsoftmaxの最大値です。
+    大きなコーパスでは、カテゴリーごとに最大 max_rows_per_category 行（等間隔に抽出）だけで学習します。
+    """
+
+    def __init__(self, qa_data: Iterable[dict], dim: int = 2048, scale: float = 20.0,
+                 max_rows_per_category: int = 2000):
+        self.scale = scale
+        rows_by_category = partition_by_category(qa_data)
+        self.categories: List[str] = sorted(category for category in rows_by_category if category)
+        samples = {category: _sample_rows(rows_by_category[category], max_rows_per_category)
+                   for category in self.categories}
+        texts = {category: [_training_text(row) for row in rows] for category, rows in samples.items()}
+        self.embedder = HashingNgramEmbedder(dim).fit([text for category_texts in texts.values() for text in category_texts])
+        centroids = np.zeros((len(self.categories), dim), dtype=np.float32)
+        for position, category in enumerate(self.categories):
+            if texts[category]:
+                centroids[position] = self.embedder.embed(texts[category]).mean(axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        np.divide(centroids, norms, out=centroids, where=norms > 0)
+        self.centroids = centroids
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """(予測カテゴリー, 確信度 0〜1) を返します。カテゴリーがない場合は (None, 0.0) を返します。"""
+        if not self.categories:
+            return None, 0.0
+        logits = self.scale * (self.centroids @ self.embedder.embed([text])[0])
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.categories[best], float(probabilities[best])
+
+    def save(self, directory: str) -> None:
+        np.save(os.path.join(directory, "centroids.npy"), self.centroids)
+        np.save(os.path.join(directory, "embedder_idf.npy"), self.embedder.idf)
+        with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"categories": self.categories, "scale": self.scale, "dim": self.embedder.dim,
+                       "ngram_range": list(self.embedder.ngram_range)}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "NearestCentroidClassifier":
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        classifier = cls.__new__(cls)
+        classifier.categories = manifest["categories"]
+        classifier.scale = manifest["scale"]
+        classifier.embedder = HashingNgramEmbedder(manifest["dim"], tuple(manifest["ngram_range"]))
+        classifier.embedder.idf = np.load(os.path.join(directory, "embedder_idf.npy"))
+        classifier.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        return classifier
+
+
+def _training_text(row: dict) -> str:
+    # 質問文だけでは語彙が少ないため、回答例も学習に使う
+    return f"{row.get('質問', '')} {row.get('回答例', '')}"
+
+
+def _sample_rows(rows: List[dict], limit: int) -> List[dict]:
+    if len(rows) <= limit:
+        return rows
+    step = len(rows) / limit
+    return [rows[int(position * step)] for position in range(limit)]
+
+
+def create_category_classifier(qa_data: List[dict], cache_key: Optional[str] = None,
+                               cache: Optional[IndexCache] = None) -> NearestCentroidClassifier:
+    """qa_data からカテゴリー分類器を学習します。
+    cache_key を指定した場合、学習済みの分類器を検索インデックスと同じディスクキャッシュに保存して再利用します。
+    """
+    if cache_key is None:
+        return NearestCentroidClassifier(qa_data)
+    return (cache or default_index_cache).get_or_build(
+        cache_key, "category_classifier",
+        loader=NearestCentroidClassifier.load,
+        builder=lambda: NearestCentroidClassifier(qa_data),
+        writer=lambda classifier, directory: classifier.save(directory),
+    )
+
+
+def evaluate_leave_one_out(qa_data: List[dict], thresholds: Iterable[float]) -> Dict[str, object]:
+    """1行ずつを評価用に除いて学習し直し、その行の質問文のカテゴリーを予測するオフライン評価を行います。
+    全体の正解率と、閾値ごとのローカルで分類される割合（LLM呼び出しを省略できる割合）・その正解率を返します。
+    """
+    predictions = []
+    for held_out in range(len(qa_data)):
+        classifier = NearestCentroidClassifier(qa_data[:held_out] + qa_data[held_out + 1:])
+        category, confidence = classifier.predict(qa_data[held_out].get("質問", ""))
+        predictions.append((category == qa_data[held_out].get("カテゴリー"), confidence))
+    total = len(predictions)
+    result = {"rows": total, "accuracy": round(sum(correct for correct, _ in predictions) / total, 3) if total else 0.0,
+              "thresholds": []}
+    for threshold in thresholds:
+        routed = [correct for correct, confidence in predictions if confidence >= threshold]
+        result["thresholds"].append({
+            "threshold": threshold,
+            "llm_calls_avoided": round(len(routed) / total, 3) if total else 0.0,
+            "local_accuracy": round(sum(routed) / len(routed), 3) if routed else None,
+        })
+    return result
@@ -0,0 +1,236 @@
+# 会話の状態を保存する LangGraph のチェックポインター
+# create_agent_app(checkpointer=...) に渡すと、同じ thread_id（config["configurable"]["thread_id"]）の呼び出しの間で
+# 会話の履歴と要約が引き継がれます。標準の InMemorySaver はグラフのステップごとのチェックポイントをすべて保持するため、
+# 会話が長くなるほどメモリが増えます。ここでのチェックポインターはスレッドごとに最新のチェックポイントだけを保持します
+# （チェックポイントの履歴をたどる get_state_history やタイムトラベルは使えません）。
+#   memory: プロセス内（LatestInMemorySaver）
+#   sqlite: SQLiteファイル（SQLiteCheckpointSaver）。プロセス間・再起動後も会話を引き継げます。
+# 環境変数 CONVERSATION_STORE で切り替えられます（create_checkpointer_from_env を参照）。
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Set, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (WRITES_IDX_MAP, BaseCheckpointSaver, ChannelVersions, Checkpoint,
+                                       CheckpointMetadata, CheckpointTuple, get_checkpoint_id,
+                                       get_checkpoint_metadata)
+from langgraph.checkpoint.memory import InMemorySaver
+
+CONVERSATION_STORES = ("memory", "sqlite")
+DEFAULT_CONVERSATION_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache",
+                                               "conversations.sqlite3")
+
+
+class LatestInMemorySaver(InMemorySaver):
+    """スレッドごとに最新のチェックポイントと、それが参照するチャネルの値だけを保持する InMemorySaver。"""
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        # (thread_id, checkpoint_ns) ごとに保存済みのチャネルの値のキー（blobs のキー）
+        self._blob_keys: Dict[Tuple[str, str], Set[tuple]] = defaultdict(set)
+        self._prune_lock = threading.Lock()
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        saved_config = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        latest_versions = checkpoint["channel_versions"]
+        with self._prune_lock:
+            checkpoints = self.storage[thread_id][checkpoint_ns]
+            for checkpoint_id in [key for key in checkpoints if key != checkpoint["id"]]:
+                del checkpoints[checkpoint_id]
+                self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            blob_keys = self._blob_keys[(thread_id, checkpoint_ns)]
+            blob_keys.update((thread_id, checkpoint_ns, channel, version) for channel, version in new_versions.items())
+            for key in [key for key in blob_keys if latest_versions.get(key[2]) != key[3]]:
+                blob_keys.discard(key)
+                self.blobs.pop(key, None)
+        return saved_config
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._prune_lock:
+            for key in [key for key in self._blob_keys if key[0] == thread_id]:
+                for blob_key in self._blob_keys.pop(key):
+                    self.blobs.pop(blob_key, None)
+            self.storage.pop(thread_id, None)
+            for key in [key for key in self.writes if key[0] == thread_id]:
+                del self.writes[key]
+
+    def stored_bytes(self, thread_id: str) -> int:
+        """スレッドの保存済みデータ（シリアライズしたチェックポイント・チャネルの値・書き込み）の合計バイト数を返します。"""
+        total = 0
+        for checkpoints in self.storage.get(thread_id, {}).values():
+            for checkpoint, metadata, _ in checkpoints.values():
+                total += len(checkpoint[1]) + len(metadata[1])
+        total += sum(len(value[1]) for key, value in self.blobs.items() if key[0] == thread_id)
+        total += sum(len(write[2][1]) for key, writes in self.writes.items() if key[0] == thread_id
+                     for write in writes.values())
+        return total
+
+
+class SQLiteCheckpointSaver(BaseCheckpointSaver):
+    """SQLiteファイルに (thread_id, checkpoint_ns) ごとの最新のチェックポイントだけを保存するチェックポインター。
+    チャネルの値はチェックポイントと一緒にシリアライズして1行に保存し、新しいチェックポイントを保存すると
+    古いチェックポイントの書き込み（pending writes）を削除します。
+    """
+
+    def __init__(self, path: str = DEFAULT_CONVERSATION_STORE_PATH, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,"
+            " parent_checkpoint_id TEXT, type TEXT NOT NULL, checkpoint BLOB NOT NULL,"
+            " metadata_type TEXT NOT NULL, metadata BLOB NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_writes ("
+            " thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,"
+            " task_id TEXT NOT NULL, idx INTEGER NOT NULL, channel TEXT NOT NULL, type TEXT NOT NULL,"
+            " value BLOB NOT NULL, task_path TEXT NOT NULL,"
+            " PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))"
+        )
+        self._conn.commit()
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata"
+                " FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+            requested_id = get_checkpoint_id(config)
+            if row is None or (requested_id and requested_id != row[0]):
+                return None
+            checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata = row
+            writes = self._conn.execute(
+                "SELECT task_id, channel, type, value FROM checkpoint_writes"
+                " WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                     "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((checkpoint_type, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((value_type, value)))
+                            for task_id, channel, value_type, value in writes],
+            parent_config=({"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                             "checkpoint_id": parent_checkpoint_id}}
+                           if parent_checkpoint_id else None),
+        )
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        # スレッドごとに最新のチェックポイントしか保持しないため、指定されたスレッドの最新のチェックポイントだけを返す
+        if config is None or before is not None or limit == 0:
+            return
+        checkpoint_tuple = self.get_tuple(config)
+        if checkpoint_tuple is None:
+            return
+        if filter and any(checkpoint_tuple.metadata.get(key) != value for key, value in filter.items()):
+            return
+        yield checkpoint_tuple
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint_type, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 checkpoint_type, serialized_checkpoint, metadata_type, serialized_metadata),
+            )
+            self._conn.execute(
+                "DELETE FROM checkpoint_writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                (thread_id, checkpoint_ns, checkpoint["id"]),
+            )
+            self._conn.commit()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                                 "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 特殊なチャネル（エラー・割り込みなど）の書き込みは上書きし、通常の書き込みは最初の1回だけを保存する
+        statement = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            value_type, serialized_value = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx), channel,
+                         value_type, serialized_value, task_path))
+        with self._lock:
+            self._conn.executemany(f"{statement} INTO checkpoint_writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            self._conn.execute("DELETE FROM checkpoint_writes WHERE thread_id = ?", (thread_id,))
+            self._conn.commit()
+
+    def stored_bytes(self, thread_id: str) -> int:
+        """スレッドの保存済みデータ（チェックポイント・メタデータ・書き込み）の合計バイト数を返します。"""
+        with self._lock:
+            (checkpoint_bytes,) = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) FROM checkpoints WHERE thread_id = ?",
+                (thread_id,),
+            ).fetchone()
+            (write_bytes,) = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM checkpoint_writes WHERE thread_id = ?", (thread_id,),
+            ).fetchone()
+        return checkpoint_bytes + write_bytes
+
+    # SQLiteへのアクセスは短時間で終わるため、非同期版は同期版をそのまま呼び出す（InMemorySaver と同じ）
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        for checkpoint_tuple in self.list(config, filter=filter, before=before, limit=limit):
+            yield checkpoint_tuple
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.delete_thread(thread_id)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_checkpointer(store: str = "memory", path: Optional[str] = None) -> BaseCheckpointSaver:
+    """会話の状態を保存するチェックポインターを作成します（store: CONVERSATION_STORES のいずれか）。"""
+    if store == "memory":
+        return LatestInMemorySaver()
+    if store == "sqlite":
+        return SQLiteCheckpointSaver(path or DEFAULT_CONVERSATION_STORE_PATH)
+    raise ValueError(f"未対応の会話の保存先です: {store}（利用可能: {', '.join(CONVERSATION_STORES)}）")
+
+
+def create_checkpointer_from_env() -> BaseCheckpointSaver:
+    """環境変数 CONVERSATION_STORE（memory / sqlite）と CONVERSATION_STORE_PATH からチェックポインターを作成します。"""
+    return create_checkpointer(os.getenv("CONVERSATION_STORE", "memory"), os.getenv("CONVERSATION_STORE_PATH"))
@@ -0,0 +1,116 @@
+# 複数ターンの会話の記憶（トークン予算のスライディングウィンドウ + 古いターンのローリング要約）
+# グラフの状態には直近の会話（history）をトークン予算の範囲だけ残し、予算からあふれた古いターンは
+# 要約（summary）に畳み込みます。会話が何ターン続いても、状態の大きさとプロンプトに埋め込む履歴の長さは一定に保たれます。
+#
+# 使い方（app.create_agent_app の remember_turn ノードから呼ばれます）:
+#   history = append_turn(state.get("history", []), question, answer)
+#   history, evicted = split_history(history, token_budget)
+#   if evicted: summary = llm.invoke(build_summary_prompt(summary, evicted)) ...
+#   format_conversation(summary, history)  # プロンプトに埋め込む会話の文脈
+from typing import List, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from prompt_templates import PromptTemplate
+
+HISTORY_TOKEN_BUDGET = 1200 # 状態に残す直近の会話の最大トークン数（概算）
+HISTORY_MESSAGE_MAX_CHARS = 800 # 履歴に残す1メッセージの最大文字数（超えた部分は省略する）
+SUMMARY_MAX_CHARS = 600 # 会話の要約の最大文字数
+
+# 要約を依頼するプロンプトの見出し（fake_llm.py の偽LLMもこの文言で要約のプロンプトを判別します）
+SUMMARY_INSTRUCTION = "会話履歴の要約を更新してください。"
+
+# 要約のプロンプト（指示はすべての会話で共通のため、プレフィックスとして先頭に置く）
+SUMMARY_TEMPLATE = PromptTemplate("summary", "summary", f"""
+{SUMMARY_INSTRUCTION}
+これまでの要約と、その後の会話を読み、ユーザーの関心事・質問した内容・回答済みの内容が分かる要約を{SUMMARY_MAX_CHARS}文字以内で作成してください。
+要約の本文のみを出力してください。
+""", """
+これまでの要約: {summary}
+その後の会話:
+{transcript}
+""")
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算します（ASCII文字は4文字で1トークン、それ以外の文字は1文字で1トークン）。"""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def append_turn(history: Sequence[BaseMessage], question: str, answer: str) -> List[BaseMessage]:
+    """履歴の末尾に1ターン（質問と応答）を追加したリストを返します。
+    状態を小さく保つため、メッセージは本文だけを持つ HumanMessage / AIMessage として保存します。
+    """
+    return [*history, HumanMessage(content=_clip(question, HISTORY_MESSAGE_MAX_CHARS)),
+            AIMessage(content=_clip(answer, HISTORY_MESSAGE_MAX_CHARS))]
+
+
+def _turns(history: Sequence[BaseMessage]) -> List[List[BaseMessage]]:
+    # HumanMessage から次の HumanMessage の手前までを1ターンとする
+    turns: List[List[BaseMessage]] = []
+    for message in history:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _turn_tokens(turn: Sequence[BaseMessage]) -> int:
+    return sum(estimate_tokens(str(message.content)) for message in turn)
+
+
+def split_history(history: Sequence[BaseMessage], token_budget: int | None) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+    """履歴を (残す直近のターン, 要約に回す古いターン) に分けます。
+    合計がトークン予算以内なら何も追い出しません。予算を超えた場合は、要約の呼び出しが毎ターン発生しないよう
+    予算の半分に収まるまで古いターンから追い出します（最新のターンは常に残します）。token_budget=None では分けません。
+    """
+    if token_budget is None:
+        return list(history), []
+    turns = _turns(history)
+    tokens = [_turn_tokens(turn) for turn in turns]
+    if sum(tokens) <= token_budget:
+        return list(history), []
+    kept_from, kept_tokens = len(turns), 0
+    while kept_from > 0 and (kept_from == len(turns) or kept_tokens + tokens[kept_from - 1] <= token_budget // 2):
+        kept_from -= 1
+        kept_tokens += tokens[kept_from]
+    kept = [message for turn in turns[kept_from:] for message in turn]
+    evicted = [message for turn in turns[:kept_from] for message in turn]
+    return kept, evicted
+
+
+def _transcript(messages: Sequence[BaseMessage]) -> str:
+    return "\n".join(f"{'ユーザー' if isinstance(message, HumanMessage) else 'アシスタント'}: {message.content}"
+                     for message in messages)
+
+
+def format_conversation(summary: str, history: Sequence[BaseMessage]) -> str:
+    """プロンプトに埋め込む会話の文脈（要約と直近の会話）を返します。会話がなければ空文字列を返します。"""
+    sections = []
+    if summary:
+        sections.append(f"これまでの会話の要約: {summary}")
+    if history:
+        sections.append(f"直近の会話:\n{_transcript(history)}")
+    return "\n".join(sections)
+
+
+def build_summary_prompt(summary: str, evicted: Sequence[BaseMessage]) -> str:
+    """これまでの要約に、履歴から追い出した古いターンを畳み込むためのプロンプトを返します。"""
+    return SUMMARY_TEMPLATE.render(summary=summary or "（なし）", transcript=_transcript(evicted))
+
+
+def clip_summary(text: str) -> str:
+    """要約を SUMMARY_MAX_CHARS 文字以内に収めます（超えた場合は古い内容である先頭側を省略します）。"""
+    text = text.strip()
+    return text if len(text) <= SUMMARY_MAX_CHARS else "…" + text[-(SUMMARY_MAX_CHARS - 1):]
+
+
+def fallback_summary(summary: str, evicted: Sequence[BaseMessage]) -> str:
+    """LLMで要約できなかった場合の要約（これまでの要約に、追い出したターンのユーザーの質問を書き足します）。"""
+    questions = " / ".join(str(message.content) for message in evicted if isinstance(message, HumanMessage))
+    return clip_summary(f"{summary} ユーザーが尋ねた内容: {questions}" if summary else f"ユーザーが尋ねた内容: {questions}")
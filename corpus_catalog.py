@@ -0,0 +1,152 @@
+# FAQコーパスの読み込み結果のメモ化
+# Streamlit UI はボタンのクリックやチャットの送信のたびにスクリプト全体を再実行するため、
+# FAQファイルの一覧・読み込み・カテゴリーごとの質問の集計を、ファイルの更新時刻とサイズで検証したうえで再利用します。
+# カタログはプロセス全体で共有でき（ui_app.py では st.cache_resource で全セッションに共有）、
+# ファイルが変更された場合だけ、そのコーパスを読み込み直します。
+#
+# 使い方:
+#   catalog = CorpusCatalog("doc")
+#   catalog.files()                        # FAQファイルの一覧（ディレクトリの更新時刻が変わった場合だけ再探索）
+#   corpus = catalog.get(path)             # CorpusSnapshot（store / categories / question_pools など）
+#   catalog.system_prompt(corpus.identity) # doc/prompts/default.txt（なければ生成したデフォルト）
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from faq_loader import discover_faq_files
+from faq_store import FaqStore, load_faq_store
+from index_cache import IndexCache, default_index_cache
+from retrieval import partition_by_category
+
+logger = logging.getLogger(__name__)
+
+# カテゴリーを持たない行の質問テンプレートの表示名
+UNCATEGORIZED_LABEL = "その他"
+
+
+def _file_version(file_path: str) -> Optional[Tuple[int, int]]:
+    # (更新時刻[ns], サイズ)。ファイルが存在しない場合は None
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_system_prompt(doc_dir: str, agent_identity: str) -> str:
+    """doc/prompts/default.txt があればシステムプロンプトとして読み込みます（{agent_identity} を置き換えます）。
+    ファイルがない場合や読み込めない場合は、アイデンティティから生成したデフォルトのプロンプトを返します。
+    """
+    default_prompt_path = os.path.join(doc_dir, "prompts", "default.txt")
+    try:
+        if os.path.exists(default_prompt_path):
+            with open(default_prompt_path, "r", encoding="utf-8") as f:
+                return f.read().strip().replace("{agent_identity}", agent_identity)
+    except Exception as e:
+        logger.warning("システムプロンプトファイルの読み込み中にエラーが発生しました: %s。生成されたデフォルトプロンプトを使用します。", e)
+    return f"あなたは{agent_identity}です。"
+
+
+@dataclass(frozen=True)
+class CorpusSnapshot:
+    """あるバージョン（更新時刻とサイズ）のFAQファイルの読み込み結果と、そこから事前に計算したUI用の構造。"""
+    path: str
+    version: Tuple[int, int]
+    store: FaqStore
+    cache_key: str # 検索インデックスなどのディスクキャッシュのキー（index_cache.corpus_cache_key）
+    identity: str
+    categories: List[str]
+    # カテゴリーごとの質問を持つ行（FaqStore の行番号に対するビュー）。質問テンプレートの抽選に使う
+    question_pools: Dict[str, Sequence]
+
+
+class CorpusCatalog:
+    """FAQファイルの一覧とコーパスの読み込み結果を、ファイルの更新時刻とサイズで検証してメモ化するスレッドセーフなカタログ。"""
+
+    def __init__(self, doc_dir: str, cache: Optional[IndexCache] = None):
+        self.doc_dir = doc_dir
+        self.cache = cache or default_index_cache
+        self._lock = threading.Lock()
+        self._files: Optional[Tuple[Optional[Tuple[int, int]], List[str]]] = None
+        self._corpora: Dict[str, CorpusSnapshot] = {}
+        self._prompt: Optional[Tuple[Optional[Tuple[int, int]], str]] = None
+        # 同じファイルを複数セッションが同時に読み込まないよう、ファイルごとに読み込み用のロックを持つ
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.counters = {"hits": 0, "loads": 0, "reloads": 0}
+
+    def files(self) -> List[str]:
+        """ディレクトリ内のFAQファイル（faq_loader.discover_faq_files）を返します。
+        ファイルの追加・削除・名前の変更で変わるディレクトリの更新時刻が同じ間は、前回の結果を返します。
+        """
+        version = _file_version(self.doc_dir)
+        with self._lock:
+            if self._files is not None and self._files[0] == version:
+                return self._files[1]
+        files = discover_faq_files(self.doc_dir)
+        with self._lock:
+            self._files = (version, files)
+        return files
+
+    def get(self, file_path: str) -> Optional[CorpusSnapshot]:
+        """FAQファイルの読み込み結果を返します。前回の読み込みから更新時刻とサイズが変わっていなければ再利用します。
+        読み込みに失敗した場合は None を返します（次回の呼び出しで再度読み込みを試みます）。
+        """
+        version = _file_version(file_path)
+        if version is None:
+            return None
+        with self._lock:
+            snapshot = self._corpora.get(file_path)
+            if snapshot is not None and snapshot.version == version:
+                self.counters["hits"] += 1
+                return snapshot
+            load_lock = self._load_locks.setdefault(file_path, threading.Lock())
+        with load_lock:
+            with self._lock:
+                snapshot = self._corpora.get(file_path)
+                if snapshot is not None and snapshot.version == version:
+                    self.counters["hits"] += 1
+                    return snapshot
+            # 読み込みには時間がかかるため、カタログ全体のロックは保持しない
+            loaded = self._load(file_path, version)
+            if loaded is None:
+                return None
+            with self._lock:
+                self.counters["reloads" if file_path in self._corpora else "loads"] += 1
+                self._corpora[file_path] = loaded
+            return loaded
+
+    def _load(self, file_path: str, version: Tuple[int, int]) -> Optional[CorpusSnapshot]:
+        logger.debug("FAQファイルを読み込みます: %s", file_path)
+        cache_key = self.cache.key_for_source(file_path)
+        store = load_faq_store(file_path, self.cache)
+        if store is None:
+            return None
+        question_pools = {}
+        for category, rows in partition_by_category(store).items():
+            label = category or UNCATEGORIZED_LABEL
+            # カテゴリーのない行は「その他」カテゴリーの行の後ろにまとめる
+            question_pools[label] = rows if label not in question_pools else list(question_pools[label]) + list(rows)
+        return CorpusSnapshot(file_path, version, store, cache_key, store.metadata.get("description", "AIアシスタント"),
+                              store.categories, question_pools)
+
+    def system_prompt(self, agent_identity: str) -> str:
+        """doc/prompts/default.txt のシステムプロンプトを返します（load_system_prompt を参照）。
+        ファイルの内容は更新時刻とサイズが変わった場合だけ読み込み直します。
+        """
+        prompt_path = os.path.join(self.doc_dir, "prompts", "default.txt")
+        version = _file_version(prompt_path)
+        with self._lock:
+            prompt = self._prompt
+        if prompt is None or prompt[0] != version:
+            # {agent_identity} を置き換える前のテンプレートを保持する
+            prompt = (version, load_system_prompt(self.doc_dir, "{agent_identity}"))
+            with self._lock:
+                self._prompt = prompt
+        return prompt[1].replace("{agent_identity}", agent_identity)
+
+    def stats(self) -> Dict[str, int]:
+        """メモ化の統計（hits: 再利用 / loads: 初回の読み込み / reloads: ファイル変更による読み込み直し）を返します。"""
+        with self._lock:
+            return {**self.counters, "corpora": len(self._corpora)}
@@ -0,0 +1,186 @@
+# 高確信度の一致に対する最終応答の高速パス
+# 関連度評価の最大スコアが閾値（DIRECT_ANSWER_THRESHOLD、app.RELEVANCE_THRESHOLD より高い値）以上の場合、FAQの「回答例」は
+# そのままユーザーに返せる回答のため、generate_final_response で言い換えのためのLLM呼び出しを省略して回答を返します。
+#   off:       常にLLMで最終応答を生成します（既定）
+#   verbatim:  回答例をそのまま返します
+#   template:  回答例を定型文（DIRECT_ANSWER_TEMPLATE）に埋め込んで返します
+#   rephrased: オフラインのバッチで事前にLLMで言い換えておいた回答を参照表（RephrasedAnswers）から返します。
+#              参照表にない回答（FAQの変更後に言い換えていない回答など）はLLMで生成します。
+# 環境変数 DIRECT_ANSWER_POLICY / DIRECT_ANSWER_THRESHOLD / REPHRASED_ANSWERS_PATH で切り替えられます
+# （create_direct_answer_policy_from_env を参照）。
+#
+# 事前の言い換えCLI（LLM_PROVIDER のプロバイダーを使用）:
+#   python direct_answer.py rephrase doc/cafe_support_faq.py --output .cache/rephrased_answers.json
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+from instrumentation import default_metrics
+
+logger = logging.getLogger(__name__)
+
+DIRECT_ANSWER_POLICIES = ("off", "verbatim", "template", "rephrased")
+DIRECT_ANSWER_THRESHOLD = 90 # 高速パスを使う最大関連度スコアの下限
+DEFAULT_REPHRASED_ANSWERS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache",
+                                              "rephrased_answers.json")
+
+# template ポリシーで回答例を埋め込む定型文
+DIRECT_ANSWER_TEMPLATE = "お問い合わせありがとうございます。\n\n{answer}\n\n他にご不明な点がございましたら、お気軽にお尋ねください。"
+
+
+def rephrase_key(agent_identity: str, question: str, answer: str) -> str:
+    """言い換えた回答の参照表のキー（アイデンティティ・質問・回答例のハッシュ）を返します。
+    回答例やアイデンティティが変わるとキーも変わるため、古い言い換えが返されることはありません。
+    """
+    payload = json.dumps([agent_identity, question, answer], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class RephrasedAnswers:
+    """キー（rephrase_key）-> 事前に言い換えた回答 を保存するJSONファイル。複数のコーパスで1つのファイルを共有できます。"""
+
+    def __init__(self, path: str = DEFAULT_REPHRASED_ANSWERS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, agent_identity: str, question: str, answer: str) -> Optional[str]:
+        with self._lock:
+            return self.entries.get(rephrase_key(agent_identity, question, answer))
+
+    def update(self, entries: Dict[str, str]) -> None:
+        """言い換えた回答をまとめて追加し、ファイルに保存します。"""
+        with self._lock:
+            self.entries.update(entries)
+            self._save()
+
+    def _save(self) -> None:
+        # 途中で中断されても壊れたファイルが残らないよう、一時ファイルに書き込んでから置き換える
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
+
+
+class DirectAnswerPolicy:
+    """最終応答の高速パスのポリシー（mode: DIRECT_ANSWER_POLICIES のいずれか）。
+    検索結果の最上位の候補の関連度スコアが threshold 以上で、検索結果がその候補の回答例である場合にだけ高速パスを使います。
+    """
+
+    def __init__(self, mode: str = "off", threshold: float = DIRECT_ANSWER_THRESHOLD,
+                 rephrased: Optional[RephrasedAnswers] = None):
+        if mode not in DIRECT_ANSWER_POLICIES:
+            raise ValueError(f"未対応の高速パスのポリシーです: {mode}（利用可能: {', '.join(DIRECT_ANSWER_POLICIES)}）")
+        self.mode = mode
+        self.threshold = threshold
+        if mode == "rephrased":
+            rephrased = rephrased if rephrased is not None else RephrasedAnswers()
+            if not len(rephrased):
+                logger.warning("言い換えた回答の参照表が空です: %s（python direct_answer.py rephrase で作成してください）",
+                               rephrased.path)
+        self.rephrased = rephrased
+
+    def answer(self, agent_identity: str, candidate: Optional[dict], tool_result: str) -> Optional[str]:
+        """LLMを呼ばずに返す最終応答を返します。高速パスを使わない場合は None を返します。
+        candidate は検索ツールが返した関連度の高い順の候補（app.candidate_summary）の先頭です。
+        """
+        if self.mode == "off" or not candidate:
+            return None
+        score, answer = candidate.get("score"), candidate.get("回答例")
+        if not isinstance(score, (int, float)) or score < self.threshold or not answer or answer != tool_result:
+            return None
+        if self.mode == "verbatim":
+            return answer
+        if self.mode == "template":
+            return DIRECT_ANSWER_TEMPLATE.format(answer=answer)
+        rephrased = self.rephrased.get(agent_identity, candidate.get("質問") or "", answer)
+        # 参照表にない回答はLLMで生成するため、言い換えの作り直しが必要かどうかを参照結果のメトリクスで確認できるようにする
+        default_metrics.inc("faq_rephrased_answer_lookups", {"result": "hit" if rephrased is not None else "miss"})
+        if rephrased is None:
+            logger.debug("言い換えた回答が参照表にないため、LLMで最終応答を生成します: %s", candidate.get("質問"))
+        return rephrased
+
+
+def create_direct_answer_policy_from_env() -> DirectAnswerPolicy:
+    """環境変数 DIRECT_ANSWER_POLICY（既定 off）/ DIRECT_ANSWER_THRESHOLD / REPHRASED_ANSWERS_PATH からポリシーを作成します。"""
+    mode = os.getenv("DIRECT_ANSWER_POLICY", "off")
+    return DirectAnswerPolicy(
+        mode, float(os.getenv("DIRECT_ANSWER_THRESHOLD", str(DIRECT_ANSWER_THRESHOLD))),
+        RephrasedAnswers(os.getenv("REPHRASED_ANSWERS_PATH", DEFAULT_REPHRASED_ANSWERS_PATH)) if mode == "rephrased" else None,
+    )
+
+
+def rephrase_corpus(qa_data: List[dict], agent_identity: str, answers: RephrasedAnswers, llm_provider=None,
+                    max_concurrency: int = 8, force: bool = False) -> int:
+    """コーパスのすべての回答例を、最終応答と同じプロンプト（会話の文脈なし）でLLMに言い換えさせ、参照表に保存します。
+    参照表にすでにある回答は、force=True の場合を除いて言い換えません。言い換えた回答の数を返します。
+    """
+    from llm_provider import create_llm_provider_from_env
+    from prompt_templates import CorpusPrompts
+
+    provider = llm_provider or create_llm_provider_from_env()
+    answer_template = CorpusPrompts("", agent_identity, []).answer
+    pending = {}
+    for row in qa_data:
+        question, answer = row.get("質問"), row.get("回答例")
+        if not question or not answer:
+            continue
+        key = rephrase_key(agent_identity, question, answer)
+        if force or key not in answers.entries:
+            pending[key] = answer_template.render(conversation="", query=question, tool_result=answer)
+    if not pending:
+        return 0
+    responses = provider.chat_model("response").batch(list(pending.values()), config={"max_concurrency": max_concurrency},
+                                                       return_exceptions=True)
+    rephrased = {}
+    for key, response in zip(pending, responses):
+        if isinstance(response, Exception):
+            logger.warning("回答の言い換えに失敗しました: %s", response)
+            continue
+        text = response.content if isinstance(response.content, str) else str(response.content)
+        if text.strip():
+            rephrased[key] = text.strip()
+    answers.update(rephrased)
+    return len(rephrased)
+
+
+def main() -> None:
+    from faq_loader import load_faq_data
+    from logging_setup import configure_logging
+
+    parser = argparse.ArgumentParser(description="最終応答の高速パス（rephrased ポリシー）の参照表の作成ツール")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rephrase_parser = subparsers.add_parser("rephrase", help="FAQファイルの回答例をLLMで言い換えて参照表に保存します")
+    rephrase_parser.add_argument("sources", nargs="+", help="FAQファイル（例: doc/*.py）")
+    rephrase_parser.add_argument("--output", default=DEFAULT_REPHRASED_ANSWERS_PATH)
+    rephrase_parser.add_argument("--max-concurrency", type=int, default=8)
+    rephrase_parser.add_argument("--force", action="store_true", help="参照表にある回答も言い換え直す")
+    args = parser.parse_args()
+    configure_logging()
+
+    answers = RephrasedAnswers(args.output)
+    for source_path in args.sources:
+        faq_data = load_faq_data(source_path)
+        if faq_data is None:
+            continue
+        identity = faq_data["metadata"].get("description", "AIアシスタント")
+        count = rephrase_corpus(faq_data["data"], identity, answers, max_concurrency=args.max_concurrency,
+                                force=args.force)
+        print(f"{source_path}: {count}件の回答を言い換えました（参照表: {args.output}、{len(answers)}件）")
+
+
+if __name__ == "__main__":
+    main()
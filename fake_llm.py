@@ -0,0 +1,201 @@
+# ネットワークを使わないテスト・ベンチマーク用のチャットモデル
+# app.py が発行するプロンプト（分類・関連度評価・ツール呼び出し・最終応答）を判別し、
+# それらしい応答を決定的に返します。呼び出しごとに任意の遅延を挿入できます。
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+def _char_overlap(a: str, b: str) -> int:
+    # 文字bigramの重なり数（日本語の簡易的な類似度）
+    return len({a[i:i + 2] for i in range(len(a) - 1)} & {b[i:i + 2] for i in range(len(b) - 1)})
+
+
+def _scored_qa_pairs(query: str, prompt: str) -> List[tuple]:
+    # (インデックス, カテゴリー, 関連度スコア) を関連度の高い順に返す
+    pairs = re.findall(r"QA_PAIR_(\d+): (?:\[(.*?)\] )?質問: (.*)", prompt)
+    query_size = max(1, _char_overlap(query, query))
+    # 質問の文字bigramのうち、候補と重なる割合を関連度スコア（0〜100）とする
+    scored = [(int(index), category or None, round(100 * _char_overlap(query, question) / query_size))
+              for index, category, question in pairs]
+    return sorted(scored, key=lambda pair: -pair[2])
+
+
+def _best_qa_pair(query: str, prompt: str) -> tuple:
+    scored = _scored_qa_pairs(query, prompt)
+    return scored[0] if scored else (None, None, 0)
+
+
+def default_responder(prompt: str) -> str:
+    """app.py のプロンプトの種類に応じた決定的な応答テキストを返します。"""
+    # 質問はプロンプトの後半（静的なプレフィックスの後ろ）にある。分類のプロンプトでは最後の「質問: 」の行
+    query_match = re.search(r'ユーザーの質問: "(.*?)"\n', prompt, re.S)
+    question_lines = re.findall(r"^質問: (.*)$", prompt, re.MULTILINE)
+    query = query_match.group(1) if query_match else (question_lines[-1] if question_lines else "")
+
+    if "会話履歴の要約を更新" in prompt:
+        # これまでの要約の末尾に、追い出されたターンのユーザーの質問を書き足す（長さはプロンプトの上限で切り詰める）
+        previous = re.search(r"これまでの要約: (.*)\n", prompt).group(1)
+        limit = int(re.search(r"要約を(\d+)文字以内", prompt).group(1))
+        questions = " / ".join(re.findall(r"^ユーザー: (.*)$", prompt, re.MULTILINE))
+        summary = f"{'' if previous == '（なし）' else previous + ' '}ユーザーが尋ねた内容: {questions}"
+        return summary[-limit:]
+    if "一括関連度評価" in prompt:
+        queries = re.findall(r"QUERY_(\d+): (.*)", prompt)
+        results = []
+        for query_number, batch_query in queries:
+            index, _, score = _best_qa_pair(batch_query, prompt)
+            results.append({"query": int(query_number), "index": index, "score": score})
+        return json.dumps({"results": results})
+    if "分類と関連度評価" in prompt:
+        index, category, score = _best_qa_pair(query, prompt)
+        return json.dumps({"category": category or "その他", "index": index, "score": score}, ensure_ascii=False)
+    if "社内ドキュメントの質問リスト" in prompt:
+        index, _, score = _best_qa_pair(query, prompt)
+        return json.dumps({"index": index, "score": score})
+    if "利用可能なカテゴリー:" in prompt:
+        categories = re.findall(r"'([^']+)'", prompt.split("利用可能なカテゴリー:", 1)[1].split("\n", 1)[0])
+        return max(categories, key=lambda category: _char_overlap(query, category)) if categories else "その他"
+    result_match = re.search(r"^検索結果: (.*)$", prompt, re.MULTILINE)
+    if result_match:
+        return f"お問い合わせありがとうございます。{result_match.group(1)[:80]}"
+    return f"お問い合わせありがとうございます。{prompt.strip().splitlines()[-1][:80]}"
+
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "normal", "lognormal")
+
+
+def latency_distribution(kind: str, mean: float, spread: float = 0.0, seed: int = 0) -> Callable[[], float]:
+    """呼び出しごとの遅延（秒）を返す関数を作成します。同じ seed なら同じ遅延の列を返します。
+    constant: 常に mean / uniform: mean±spread の一様分布 / normal: 平均 mean・標準偏差 spread の正規分布
+    lognormal: 中央値 mean・対数標準偏差 spread の対数正規分布（テールの長いLLM APIの遅延を模擬）
+    """
+    if kind not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"未対応の遅延分布です: {kind}（利用可能: {', '.join(LATENCY_DISTRIBUTIONS)}）")
+    rng = random.Random(seed)
+    if kind == "uniform":
+        return lambda: max(0.0, rng.uniform(mean - spread, mean + spread))
+    if kind == "normal":
+        return lambda: max(0.0, rng.gauss(mean, spread))
+    if kind == "lognormal":
+        return lambda: mean * rng.lognormvariate(0.0, spread) if mean > 0 else 0.0
+    return lambda: mean
+
+
+class FakeChatModel(BaseChatModel):
+    """プロンプトに応じた応答を返すオフライン用チャットモデル。
+    latency 秒（latency_sampler を指定した場合はその戻り値）の遅延を呼び出しごとに挿入し、LLM呼び出しの待ち時間を再現します。
+    tokens_per_second を指定すると、応答の文字数をトークン数とみなして生成時間も再現します。
+    input_tokens_per_second を指定すると、プロンプトの文字数に比例する処理時間（プロンプトの読み込み）も再現します。
+    """
+
+    latency: float = 0.0
+    latency_sampler: Optional[Callable[[], float]] = None # 呼び出しごとの遅延（秒）を返す関数（latency_distribution を参照）
+    tokens_per_second: float = 0.0 # 0の場合は生成時間を挿入しない
+    input_tokens_per_second: float = 0.0 # 0の場合はプロンプトの処理時間を挿入しない
+    stream_chunk_size: int = 4 # ストリーミング時に1チャンクあたりに含める文字数
+    responder: Callable[[str], str] = default_responder
+    call_count: int = 0
+    # キー -> プレフィックス（LLMProvider.register_prompt_prefix で登録）。一致した部分をキャッシュから読み込んだトークンとして報告する
+    prompt_prefixes: Dict[str, str] = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools: List[Any], **kwargs: Any):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _respond(self, messages: List[BaseMessage], tools: Optional[list]) -> AIMessage:
+        self.call_count += 1
+        prompt = "\n".join(str(message.content) for message in messages)
+        usage = {"input_tokens": len(prompt), "output_tokens": 0, "total_tokens": len(prompt)}
+        cached = max((len(prefix) for prefix in self.prompt_prefixes.values() if prompt.startswith(prefix)), default=0)
+        if cached:
+            usage["input_token_details"] = {"cache_read": cached}
+        if tools:
+            # call_search_tool ノードのプロンプトから質問とカテゴリーを取り出してツール呼び出しを返す
+            match = re.search(r"ユーザーの質問「(.*?)」\n予測されたカテゴリー「(.*?)」", prompt, re.S)
+            if match:
+                tool_call = {"name": tools[0]["function"]["name"], "id": f"call_{uuid.uuid4().hex[:12]}",
+                             "args": {"query": match.group(1), "category": match.group(2)}}
+                return AIMessage(content="", tool_calls=[tool_call], usage_metadata=usage)
+        content = self.responder(prompt)
+        usage.update(output_tokens=len(content), total_tokens=len(prompt) + len(content))
+        return AIMessage(content=content, usage_metadata=usage)
+
+    def _first_token_delay(self, messages: List[BaseMessage]) -> float:
+        delay = self.latency_sampler() if self.latency_sampler is not None else self.latency
+        if self.input_tokens_per_second > 0:
+            delay += sum(len(str(message.content)) for message in messages) / self.input_tokens_per_second
+        return delay
+
+    def _generation_delay(self, text: str) -> float:
+        return len(text) / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, kwargs.get("tools"))
+        delay = self._first_token_delay(messages) + self._generation_delay(message.content)
+        if delay:
+            time.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, kwargs.get("tools"))
+        delay = self._first_token_delay(messages) + self._generation_delay(message.content)
+        if delay:
+            await asyncio.sleep(delay)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, message: AIMessage) -> Iterator[ChatGenerationChunk]:
+        if message.tool_calls:
+            # ツール呼び出しは分割せず1チャンクで返す
+            tool_call_chunks = [{"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False),
+                                 "id": call["id"], "index": position}
+                                for position, call in enumerate(message.tool_calls)]
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=tool_call_chunks,
+                                                             usage_metadata=message.usage_metadata))
+            return
+        text = message.content
+        for start in range(0, max(len(text), 1), self.stream_chunk_size):
+            # トークン使用量は最初のチャンクにだけ付ける（チャンクを結合すると合計される）
+            usage = message.usage_metadata if start == 0 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[start:start + self.stream_chunk_size],
+                                                             usage_metadata=usage))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        delay = self._first_token_delay(messages)
+        if delay:
+            time.sleep(delay)
+        for chunk in self._chunks(self._respond(messages, kwargs.get("tools"))):
+            if self.tokens_per_second > 0:
+                time.sleep(self._generation_delay(chunk.text))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        delay = self._first_token_delay(messages)
+        if delay:
+            await asyncio.sleep(delay)
+        for chunk in self._chunks(self._respond(messages, kwargs.get("tools"))):
+            if self.tokens_per_second > 0:
+                await asyncio.sleep(self._generation_delay(chunk.text))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
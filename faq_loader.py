@@ -0,0 +1,270 @@
+# FAQデータファイルの読み込み
+# 拡張子ごとのローダーを登録し、.json / .jsonl / .parquet / .arrow を宣言的に読み込みます。
+# 従来の .py 形式（'_JSON'で終わる辞書変数を含むファイル）はレガシー形式として引き続き読み込めます。
+# 辞書がリテラルで書かれていない .py ファイルをコードとして実行して読み込むのは、環境変数 FAQ_ALLOW_PY_EXEC=1 の場合だけです。
+#
+# 変換CLI:
+#   python faq_loader.py convert doc/*.py --format json jsonl parquet
+import argparse
+import ast
+import glob
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# FAQの行データとして扱う標準的なフィールド
+FAQ_FIELDS = ("カテゴリー", "質問", "回答例")
+
+# Parquet / Arrow ファイルのスキーマメタデータに metadata を保存する際のキー
+ARROW_METADATA_KEY = b"faq_metadata"
+
+
+class FaqFormatError(ValueError):
+    """FAQデータファイルの形式が不正な場合に送出される例外。"""
+
+
+# 拡張子 -> ローダー関数
+FAQ_LOADERS: Dict[str, Callable[[str], dict]] = {}
+
+# 同じ名前のファイルが複数形式で存在する場合に優先する順（読み込みが速い順）
+FORMAT_PREFERENCE = (".arrow", ".parquet", ".jsonl", ".json", ".py")
+
+
+def register_loader(*extensions: str):
+    """指定した拡張子のローダーとして関数を登録するデコレーター。"""
+    def decorator(func: Callable[[str], dict]) -> Callable[[str], dict]:
+        for extension in extensions:
+            FAQ_LOADERS[extension.lower()] = func
+        return func
+    return decorator
+
+
+def supported_extensions() -> List[str]:
+    """読み込み可能な拡張子のリストを返します。"""
+    return list(FAQ_LOADERS)
+
+
+def validate_faq_data(faq_data) -> dict:
+    """'metadata'/'data' スキーマを検証し、問題がなければそのまま返します。"""
+    if not isinstance(faq_data, dict):
+        raise FaqFormatError("FAQデータは辞書である必要があります")
+    if not isinstance(faq_data.get("metadata"), dict):
+        raise FaqFormatError("'metadata' キー（辞書）が見つかりません")
+    rows = faq_data.get("data")
+    if not isinstance(rows, list):
+        raise FaqFormatError("'data' キー（リスト）が見つかりません")
+    for position, row in enumerate(rows):
+        if not isinstance(row, dict):
+            raise FaqFormatError(f"data[{position}] が辞書ではありません")
+        for field in FAQ_FIELDS:
+            if field in row and not isinstance(row[field], str):
+                raise FaqFormatError(f"data[{position}]['{field}'] が文字列ではありません")
+    return faq_data
+
+
+@register_loader(".json")
+def load_json(file_path: str) -> dict:
+    """{"metadata": {...}, "data": [...]} 形式のJSONファイルを読み込みます。"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_jsonl_rows(file_path: str) -> Iterator[dict]:
+    """JSONLファイルのFAQ行を1行ずつ読み込みます（1行目のメタデータ行は除く）。"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        next(f, None)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+@register_loader(".jsonl")
+def load_jsonl(file_path: str) -> dict:
+    """1行目が {"metadata": {...}}、2行目以降が各FAQ行のJSONLファイルを読み込みます。"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+    if "metadata" not in header:
+        raise FaqFormatError("JSONLファイルの1行目に 'metadata' がありません")
+    return {"metadata": header["metadata"], "data": list(iter_jsonl_rows(file_path))}
+
+
+def _table_to_faq_data(table) -> dict:
+    schema_metadata = table.schema.metadata or {}
+    metadata = json.loads(schema_metadata.get(ARROW_METADATA_KEY, b"{}"))
+    # 列に存在しないフィールドは None になるため、行ごとに取り除く
+    rows = [{key: value for key, value in row.items() if value is not None} for row in table.to_pylist()]
+    return {"metadata": metadata, "data": rows}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise FaqFormatError("Parquet/Arrow形式の読み書きには pyarrow が必要です（pip install pyarrow）") from e
+    return pyarrow
+
+
+@register_loader(".parquet")
+def load_parquet(file_path: str) -> dict:
+    """列指向のParquetファイルを読み込みます。metadata はスキーマメタデータから復元します。"""
+    _require_pyarrow()
+    import pyarrow.parquet as pq
+    return _table_to_faq_data(pq.read_table(file_path))
+
+
+@register_loader(".arrow")
+def load_arrow(file_path: str) -> dict:
+    """Arrow IPCファイルをメモリマップで読み込みます。"""
+    pa = _require_pyarrow()
+    with pa.memory_map(file_path, "r") as source:
+        return _table_to_faq_data(pa.ipc.open_file(source).read_all())
+
+
+@register_loader(".py")
+def load_legacy_py(file_path: str, allow_exec: Optional[bool] = None) -> dict:
+    """'_JSON'で終わる辞書変数を含むPythonファイルを読み込みます（レガシー形式）。
+    辞書はコードを実行せずに、構文解析だけでリテラルとして取り出します。
+    リテラルとして取り出せないファイルは、allow_exec=True（省略時は環境変数 FAQ_ALLOW_PY_EXEC=1）の場合だけ
+    独立した名前空間で実行して読み込みます（sys.path / sys.modules は変更しません）。それ以外は FaqFormatError を送出します。
+    """
+    if allow_exec is None:
+        allow_exec = os.getenv("FAQ_ALLOW_PY_EXEC") == "1"
+    with open(file_path, "r", encoding="utf-8") as f:
+        source = f.read()
+    tree = ast.parse(source, filename=file_path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id.endswith("_JSON") for target in node.targets
+        ):
+            try:
+                value = ast.literal_eval(node.value)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                break # リテラルでない（または深すぎて評価できない）場合
+            if isinstance(value, dict):
+                return value
+
+    if not allow_exec:
+        raise FaqFormatError("'_JSON'で終わるリテラルの辞書変数が見つかりません"
+                             "（コードとして実行して読み込むには FAQ_ALLOW_PY_EXEC=1 を設定してください）")
+    namespace = {"__file__": file_path, "__name__": os.path.splitext(os.path.basename(file_path))[0]}
+    exec(compile(tree, file_path, "exec"), namespace)
+    for var_name in sorted(namespace):
+        if var_name.endswith("_JSON") and isinstance(namespace[var_name], dict):
+            return namespace[var_name]
+    raise FaqFormatError("'_JSON'で終わる辞書変数が見つかりません")
+
+
+def load_faq_data(file_path: str) -> Optional[dict]:
+    """拡張子に対応するローダーでFAQデータを読み込み、スキーマを検証して返します。
+    読み込みに失敗した場合は None を返します。
+    """
+    logger.debug("load_faq_dataが呼び出されました: %s", file_path)
+    if not os.path.exists(file_path):
+        logger.error("ドキュメントファイルが見つかりません: %s", file_path)
+        return None
+
+    extension = os.path.splitext(file_path)[1].lower()
+    loader = FAQ_LOADERS.get(extension)
+    if loader is None:
+        logger.error("未対応のファイル形式です: %s（対応形式: %s）", extension, ", ".join(FAQ_LOADERS))
+        return None
+
+    try:
+        faq_data = validate_faq_data(loader(file_path))
+    except Exception as e:
+        logger.error("ドキュメント '%s' の読み込み中にエラーが発生しました: %s", file_path, e)
+        return None
+    logger.debug("ドキュメント '%s' を正常に読み込みました（%d件）", file_path, len(faq_data["data"]))
+    return faq_data
+
+
+def discover_faq_files(directory: str) -> List[str]:
+    """ディレクトリ内の読み込み可能なFAQファイルを返します。
+    同じ名前のファイルが複数形式で存在する場合は、読み込みの速い形式を1つだけ返します。
+    """
+    rank = {extension: position for position, extension in enumerate(FORMAT_PREFERENCE)}
+    best_by_stem: Dict[str, str] = {}
+    for extension in FAQ_LOADERS:
+        for file_path in glob.glob(os.path.join(directory, f"*{extension}")):
+            stem = os.path.splitext(os.path.basename(file_path))[0]
+            current = best_by_stem.get(stem)
+            if current is None or rank.get(extension, len(rank)) < rank.get(os.path.splitext(current)[1], len(rank)):
+                best_by_stem[stem] = file_path
+    return sorted(best_by_stem.values())
+
+
+# 変換先の形式ごとの書き込み関数
+def write_json(faq_data: dict, file_path: str) -> None:
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump(faq_data, f, ensure_ascii=False, indent=2)
+
+
+def write_jsonl(faq_data: dict, file_path: str) -> None:
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"metadata": faq_data["metadata"]}, ensure_ascii=False) + "\n")
+        for row in faq_data["data"]:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def _faq_data_to_table(faq_data: dict):
+    pa = _require_pyarrow()
+    columns = list(FAQ_FIELDS) + sorted({key for row in faq_data["data"] for key in row} - set(FAQ_FIELDS))
+    arrays = {column: [row.get(column) for row in faq_data["data"]] for column in columns}
+    table = pa.table({column: pa.array(values, type=pa.string()) for column, values in arrays.items()})
+    metadata = json.dumps(faq_data["metadata"], ensure_ascii=False).encode("utf-8")
+    return table.replace_schema_metadata({ARROW_METADATA_KEY: metadata})
+
+
+def write_parquet(faq_data: dict, file_path: str) -> None:
+    import pyarrow.parquet as pq
+    pq.write_table(_faq_data_to_table(faq_data), file_path)
+
+
+def write_arrow(faq_data: dict, file_path: str) -> None:
+    pa = _require_pyarrow()
+    table = _faq_data_to_table(faq_data)
+    with pa.OSFile(file_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+FAQ_WRITERS: Dict[str, Callable[[dict, str], None]] = {
+    "json": write_json,
+    "jsonl": write_jsonl,
+    "parquet": write_parquet,
+    "arrow": write_arrow,
+}
+
+
+def convert_faq_file(source_path: str, output_format: str, output_dir: Optional[str] = None) -> str:
+    """FAQファイルを指定形式に変換し、出力先のパスを返します。"""
+    faq_data = load_faq_data(source_path)
+    if faq_data is None:
+        raise FaqFormatError(f"変換元のファイルを読み込めませんでした: {source_path}")
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    output_path = os.path.join(output_dir or os.path.dirname(source_path), f"{stem}.{output_format}")
+    FAQ_WRITERS[output_format](faq_data, output_path)
+    return output_path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FAQデータファイルの変換ツール")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="FAQファイルを高速に読み込める形式に変換します")
+    convert_parser.add_argument("sources", nargs="+", help="変換元のファイル（例: doc/*.py）")
+    convert_parser.add_argument("--format", nargs="+", choices=sorted(FAQ_WRITERS), default=["json"],
+                                dest="formats")
+    convert_parser.add_argument("--out-dir", default=None, help="出力先ディレクトリ（省略時は変換元と同じ場所）")
+    args = parser.parse_args()
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    for source_path in args.sources:
+        for output_format in args.formats:
+            print(convert_faq_file(source_path, output_format, args.out_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# 大規模コーパス向けの列指向のFAQストア
+# 行ごとの辞書の代わりに、テキスト列をUTF-8のバイト列を連結したバッファ + 行ごとのオフセット、
+# カテゴリーを小さな整数コードとして保持します。行へのアクセスは __slots__ の軽量なビュー（FaqRow）を通して行い、
+# ビューは辞書と同じ row.get('質問') / row['回答例'] の形で読めるため、create_agent_app にそのまま渡せます。
+# save で保存したストアは load でメモリマップとして開くため、読み込み時にデータをコピーしません。
+#
+# 使い方:
+#   store = FaqStore.from_faq_data(load_faq_data_from_py(path))
+#   create_agent_app(store, store.categories, ...)
+#   store = load_faq_store(path)  # インデックスと同じディスクキャッシュに保存し、次回以降はメモリマップで開く
+import json
+import logging
+import os
+import sys
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from faq_loader import FAQ_FIELDS, FaqFormatError, load_faq_data
+from index_cache import IndexCache, default_index_cache
+from retrieval import CategoryPartition
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_FIELD = "カテゴリー"
+# UTF-8バッファとして保持するテキスト列
+TEXT_FIELDS = tuple(field for field in FAQ_FIELDS if field != CATEGORY_FIELD)
+
+
+class FaqRow(Mapping):
+    """FaqStore の1行を辞書と同じように読み取るビュー。値はアクセスのたびにバッファからデコードします。"""
+
+    __slots__ = ("store", "index")
+
+    def __init__(self, store: "FaqStore", index: int):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key: str) -> str:
+        return self.store.value(self.index, key)
+
+    def __iter__(self):
+        return iter(self.store.fields(self.index))
+
+    def __len__(self) -> int:
+        return len(self.store.fields(self.index))
+
+    def __repr__(self) -> str:
+        return f"FaqRow({self.index}, {dict(self)!r})"
+
+
+class FaqRows(Sequence):
+    """FaqStore の行番号の配列に対する読み取り専用のシーケンス（カテゴリーごとの行など）。"""
+
+    __slots__ = ("store", "row_ids")
+
+    def __init__(self, store: "FaqStore", row_ids: np.ndarray):
+        self.store = store
+        self.row_ids = row_ids
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return FaqRows(self.store, self.row_ids[position])
+        return FaqRow(self.store, int(self.row_ids[position]))
+
+    def __iter__(self):
+        return (FaqRow(self.store, int(index)) for index in self.row_ids)
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
+
+
+class FaqStore(Sequence):
+    """列指向で保持したFAQデータ。行は FaqRow として取り出せます。
+    テキスト列は <列名>: (UTF-8バッファ, オフセット) で、i行目の値は buffer[offsets[i]:offsets[i+1]] です。
+    カテゴリーは category_names のインデックス（カテゴリーがない行は -1）として保持します。
+    """
+
+    def __init__(self, metadata: dict, category_names: List[str], category_codes: np.ndarray,
+                 buffers: Dict[str, np.ndarray], offsets: Dict[str, np.ndarray],
+                 missing: Optional[Dict[str, np.ndarray]] = None, extras: Optional[Dict[int, dict]] = None):
+        self.metadata = metadata
+        self.category_names = [sys.intern(name) for name in category_names]
+        self.category_codes = category_codes
+        self.buffers = buffers
+        self.offsets = offsets
+        # 値が存在しない（キー自体がない）行の番号の昇順配列。空文字列の値とは区別する
+        self.missing = missing or {}
+        # FAQ_FIELDS 以外のフィールドを持つ行の {行番号: {フィールド: 値}}
+        self.extras = extras or {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict], metadata: Optional[dict] = None) -> "FaqStore":
+        """行の辞書のリストからストアを構築します。"""
+        rows = list(rows)
+        category_ids: Dict[str, int] = {}
+        category_codes = np.full(len(rows), -1, dtype=np.int32)
+        encoded: Dict[str, List[bytes]] = {field: [] for field in TEXT_FIELDS}
+        missing: Dict[str, List[int]] = {field: [] for field in FAQ_FIELDS}
+        extras: Dict[int, dict] = {}
+        for position, row in enumerate(rows):
+            category = row.get(CATEGORY_FIELD)
+            if category is not None:
+                category_codes[position] = category_ids.setdefault(category, len(category_ids))
+            elif CATEGORY_FIELD not in row:
+                missing[CATEGORY_FIELD].append(position)
+            for field in TEXT_FIELDS:
+                value = row.get(field)
+                if value is None:
+                    missing[field].append(position)
+                encoded[field].append((value or "").encode("utf-8"))
+            extra = {key: value for key, value in row.items() if key not in FAQ_FIELDS}
+            if extra:
+                extras[position] = extra
+
+        buffers, offsets = {}, {}
+        for field, values in encoded.items():
+            field_offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in values], out=field_offsets[1:])
+            buffers[field] = np.frombuffer(b"".join(values), dtype=np.uint8)
+            offsets[field] = field_offsets
+        return cls(metadata or {}, list(category_ids), category_codes, buffers, offsets,
+                   {field: np.asarray(ids, dtype=np.int64) for field, ids in missing.items() if ids}, extras)
+
+    @classmethod
+    def from_faq_data(cls, faq_data: dict) -> "FaqStore":
+        """load_faq_data_from_py / load_faq_data の戻り値（'metadata'/'data'）からストアを構築します。"""
+        return cls.from_rows(faq_data.get("data", []), faq_data.get("metadata", {}))
+
+    def __len__(self) -> int:
+        return len(self.category_codes)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return FaqRows(self, np.arange(len(self))[position])
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return FaqRow(self, position)
+
+    def __iter__(self):
+        return (FaqRow(self, index) for index in range(len(self)))
+
+    @property
+    def categories(self) -> List[str]:
+        """空でないカテゴリー名を名前順に返します。"""
+        return sorted(name for name in self.category_names if name)
+
+    def _is_missing(self, field: str, index: int) -> bool:
+        ids = self.missing.get(field)
+        if ids is None:
+            return False
+        position = np.searchsorted(ids, index)
+        return bool(position < len(ids) and ids[position] == index)
+
+    def value(self, index: int, field: str) -> str:
+        """index 行目の field の値を返します。値がない場合は KeyError を送出します。"""
+        if field in self.buffers:
+            if self._is_missing(field, index):
+                raise KeyError(field)
+            offsets = self.offsets[field]
+            return self.buffers[field][offsets[index]:offsets[index + 1]].tobytes().decode("utf-8")
+        if field == CATEGORY_FIELD:
+            code = self.category_codes[index]
+            if code < 0:
+                if self._is_missing(field, index):
+                    raise KeyError(field)
+                return None
+            return self.category_names[code]
+        return self.extras.get(index, {})[field]
+
+    def fields(self, index: int) -> List[str]:
+        """index 行目が持つフィールド名のリストを返します。"""
+        names = [field for field in FAQ_FIELDS if not self._is_missing(field, index)]
+        return names + list(self.extras.get(index, {}))
+
+    def partition_by_category(self) -> CategoryPartition:
+        """質問文を持つ行をカテゴリーごとに分割します（retrieval.partition_by_category から呼ばれます）。
+        各カテゴリーの行は行番号の配列に対するビュー（FaqRows）で、行の辞書は作成しません。
+        """
+        question_lengths = np.diff(self.offsets["質問"])
+        codes = np.where(question_lengths > 0, self.category_codes, -2)
+        order = np.argsort(codes, kind="stable").astype(np.int32)
+        sorted_codes = codes[order]
+        partition = CategoryPartition()
+        for code, category in enumerate(self.category_names):
+            start, end = np.searchsorted(sorted_codes, [code, code + 1])
+            if end > start:
+                partition[category] = FaqRows(self, order[start:end])
+                partition.row_ids[category] = order[start:end]
+        # カテゴリーを持たない行（-1）は None のカテゴリーとしてまとめる
+        start, end = np.searchsorted(sorted_codes, [-1, 0])
+        if end > start:
+            partition[None] = FaqRows(self, order[start:end])
+            partition.row_ids[None] = order[start:end]
+        return partition
+
+    def to_rows(self) -> List[dict]:
+        """行の辞書のリストに戻します。"""
+        return [dict(FaqRow(self, index)) for index in range(len(self))]
+
+    def save(self, directory: str) -> None:
+        for field in TEXT_FIELDS:
+            np.save(os.path.join(directory, f"{field}_buffer.npy"), self.buffers[field])
+            np.save(os.path.join(directory, f"{field}_offsets.npy"), self.offsets[field])
+        np.save(os.path.join(directory, "category_codes.npy"), self.category_codes)
+        with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"metadata": self.metadata, "category_names": self.category_names,
+                       "missing": {field: ids.tolist() for field, ids in self.missing.items()},
+                       "extras": {str(index): extra for index, extra in self.extras.items()}}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "FaqStore":
+        """save で保存したストアを開きます。列の配列はメモリマップで開き、アクセスした部分だけがページインされます。"""
+        with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        buffers = {field: np.load(os.path.join(directory, f"{field}_buffer.npy"), mmap_mode="r") for field in TEXT_FIELDS}
+        offsets = {field: np.load(os.path.join(directory, f"{field}_offsets.npy"), mmap_mode="r") for field in TEXT_FIELDS}
+        return cls(manifest["metadata"], manifest["category_names"],
+                   np.load(os.path.join(directory, "category_codes.npy"), mmap_mode="r"), buffers, offsets,
+                   {field: np.asarray(ids, dtype=np.int64) for field, ids in manifest["missing"].items()},
+                   {int(index): extra for index, extra in manifest["extras"].items()})
+
+
+def load_faq_store(file_path: str, cache: Optional[IndexCache] = None) -> Optional[FaqStore]:
+    """FAQファイルを FaqStore として読み込みます。
+    構築したストアは検索インデックスと同じディスクキャッシュに保存し、次回以降はメモリマップで開きます。
+    読み込みに失敗した場合は None を返します。
+    """
+    cache = cache or default_index_cache
+
+    def build() -> FaqStore:
+        faq_data = load_faq_data(file_path)
+        if faq_data is None:
+            raise FaqFormatError(f"FAQファイルを読み込めませんでした: {file_path}")
+        return FaqStore.from_faq_data(faq_data)
+
+    try:
+        return cache.get_or_build(cache.key_for_source(file_path), "faq_store", loader=FaqStore.load, builder=build,
+                                  writer=lambda store, directory: store.save(directory))
+    except (OSError, FaqFormatError) as e:
+        logger.error("FAQストアの読み込み中にエラーが発生しました: %s", e)
+        return None
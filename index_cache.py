@@ -0,0 +1,140 @@
+# FAQコーパスから構築した検索インデックスのディスクキャッシュ
+# キャッシュはFAQソースファイルのSHA-256とインデックススキーマのバージョンをキーとし、
+# プロセスの再起動やStreamlitの再実行をまたいで再利用されます。
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# インデックスの保存形式を変更したら値を上げる（古いキャッシュは自動的に使われなくなる）
+INDEX_SCHEMA_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.getenv(
+    "FAQ_INDEX_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "faq_index"),
+)
+
+# ファイルのハッシュ値を (パス, 更新時刻, サイズ) でメモ化し、再実行ごとの再計算を避ける
+_hash_memo: Dict[str, Tuple[float, int, str]] = {}
+_hash_memo_lock = threading.Lock()
+
+
+def file_sha256(file_path: str) -> str:
+    """ファイル内容のSHA-256（16進数）を返します。"""
+    stat = os.stat(file_path)
+    with _hash_memo_lock:
+        memo = _hash_memo.get(file_path)
+    if memo and memo[:2] == (stat.st_mtime, stat.st_size):
+        return memo[2]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    sha = digest.hexdigest()
+    with _hash_memo_lock:
+        _hash_memo[file_path] = (stat.st_mtime, stat.st_size, sha)
+    return sha
+
+
+def corpus_cache_key(file_path: str) -> str:
+    """FAQソースファイルに対応するキャッシュキー（内容のハッシュ + スキーマバージョン）を返します。"""
+    return f"{file_sha256(file_path)}-v{INDEX_SCHEMA_VERSION}"
+
+
+class IndexCache:
+    """キャッシュキーごとのディレクトリにインデックス成果物を保存・読み込みします。
+    書き込みは一時ディレクトリに行ってからリネームするため、複数プロセスから同時に使用できます。
+    """
+
+    SOURCES_MANIFEST = "sources.json"
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+    def entry_dir(self, key: str, name: str) -> str:
+        """キャッシュキーと成果物名に対応するディレクトリのパスを返します。"""
+        return os.path.join(self.cache_dir, key, name)
+
+    def load(self, key: str, name: str, loader: Callable[[str], T]) -> Optional[T]:
+        """キャッシュが存在すれば loader(ディレクトリ) の結果を返し、なければ None を返します。"""
+        directory = self.entry_dir(key, name)
+        if not os.path.isdir(directory):
+            return None
+        try:
+            return loader(directory)
+        except Exception as e:
+            # 壊れたキャッシュは削除して再構築させる
+            logger.warning("キャッシュの読み込みに失敗したため破棄します: %s (%s)", directory, e)
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+
+    def store(self, key: str, name: str, writer: Callable[[str], None]) -> None:
+        """writer(一時ディレクトリ) で成果物を書き込み、完成後にキャッシュへ配置します。"""
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{name}-", dir=os.path.join(self.cache_dir, key))
+        try:
+            writer(tmp_dir)
+            os.rename(tmp_dir, self.entry_dir(key, name))
+        except OSError:
+            # 他のプロセスが先に同じ成果物を配置した場合はそちらを使う
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def get_or_build(self, key: str, name: str, loader: Callable[[str], T], builder: Callable[[], T],
+                     writer: Callable[[T, str], None]) -> T:
+        """キャッシュがあれば読み込み、なければ builder() で構築してキャッシュに保存します。"""
+        cached = self.load(key, name, loader)
+        if cached is not None:
+            logger.debug("キャッシュからインデックスを読み込みました: %s/%s", key, name)
+            return cached
+        built = builder()
+        try:
+            self.store(key, name, lambda directory: writer(built, directory))
+            logger.debug("インデックスをキャッシュに保存しました: %s/%s", key, name)
+        except Exception as e:
+            # キャッシュへの保存に失敗しても、構築済みのインデックスはそのまま使える
+            logger.warning("インデックスのキャッシュ保存に失敗しました: %s", e)
+        return built
+
+    def key_for_source(self, file_path: str) -> str:
+        """ソースファイルのキャッシュキーを返し、同じファイルの古いキャッシュを削除します。"""
+        key = corpus_cache_key(file_path)
+        manifest_path = os.path.join(self.cache_dir, self.SOURCES_MANIFEST)
+        source = os.path.abspath(file_path)
+        with self._lock:
+            try:
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    sources = json.load(f)
+            except (OSError, ValueError):
+                sources = {}
+            previous_key = sources.get(source)
+            if previous_key == key:
+                return key
+
+            sources[source] = key
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sources, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+            # ファイルが変更された場合、他のソースから参照されていない古いキャッシュを削除
+            if previous_key and previous_key not in sources.values():
+                shutil.rmtree(os.path.join(self.cache_dir, previous_key), ignore_errors=True)
+                logger.debug("変更前のキャッシュを削除しました: %s", previous_key)
+        return key
+
+
+default_index_cache = IndexCache()
@@ -0,0 +1,271 @@
+# グラフの実行計測
+# LangChainのコールバックとして各ノードと各LLM呼び出しの所要時間・トークン数・プロンプト文字数・リトライ回数・
+# 応答キャッシュのヒットを記録し、リクエストごとのJSONトレース（スパンのリスト）と
+# Prometheus（OpenMetrics）テキスト形式のメトリクスとして出力します。
+#
+# 使い方:
+#   trace = RequestTrace()
+#   agent_app.invoke(inputs, {"callbacks": [trace]})
+#   trace.finish()  # -> {"trace_id": ..., "duration_ms": ..., "spans": [...]}
+#   default_metrics.render()  # -> Prometheus テキスト
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Prometheus のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# メトリクス名 -> (種類, 説明)
+METRICS = {
+    "faq_requests": ("counter", "処理したリクエスト数"),
+    "faq_request_duration_seconds": ("histogram", "リクエスト全体の所要時間"),
+    "faq_node_duration_seconds": ("histogram", "グラフノードの所要時間"),
+    "faq_node_errors": ("counter", "エラーで終了したグラフノードの数"),
+    "faq_llm_call_duration_seconds": ("histogram", "LLM呼び出しの所要時間"),
+    "faq_llm_prompt_tokens": ("counter", "LLMに送信したプロンプトのトークン数"),
+    "faq_llm_completion_tokens": ("counter", "LLMが生成したトークン数"),
+    "faq_llm_cached_prompt_tokens": ("counter", "プロンプトのうちプロバイダーのコンテキストキャッシュから読み込まれたトークン数"),
+    "faq_llm_prompt_chars": ("counter", "LLMに送信したプロンプトの文字数"),
+    "faq_llm_errors": ("counter", "エラーで終了したLLM呼び出しの数"),
+    "faq_llm_retries": ("counter", "LLM呼び出しなどのリトライ回数"),
+    "faq_response_cache_lookups": ("counter", "応答キャッシュの参照回数（result: exact / similar / miss / bypass）"),
+    "faq_relevance_responses": ("counter", "関連度評価の応答の読み取り結果（result: parsed / salvaged / failed）"),
+    "faq_final_responses": ("counter", "最終応答の生成方法（path: llm / verbatim / template / rephrased）"),
+    "faq_rephrased_answer_lookups": ("counter", "rephrased ポリシーでの言い換えた回答の参照表の参照結果（result: hit / miss）"),
+}
+
+# 環境変数 TRACE_LOG_PATH を設定すると、リクエストごとのトレースをJSONL形式で追記する
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH")
+
+
+class MetricsRegistry:
+    """カウンターとヒストグラムを保持し、Prometheus テキスト形式で出力するスレッドセーフなレジストリ。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {} # バケットごとの件数 + [合計, 件数]
+
+    def inc(self, name: str, labels: Optional[dict] = None, value: float = 1.0) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: Optional[dict], seconds: float) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            values = self._histograms.setdefault(key, [0.0] * (len(LATENCY_BUCKETS) + 2))
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    values[position] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def render(self) -> str:
+        """Prometheus / OpenMetrics のテキスト形式でメトリクスを返します。"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}_total{_format_labels(labels)} {_format_value(value)}")
+            else:
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, values):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {_format_value(count)}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {_format_value(values[-1])}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]:.6f}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {_format_value(values[-1])}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+
+# プロセス全体で共有するメトリクス
+default_metrics = MetricsRegistry()
+
+
+@dataclass
+class Span:
+    """トレース内の1区間。start_ms はリクエスト開始からの経過時間です。"""
+    name: str
+    kind: str # "node" / "llm" / "cache"
+    start_ms: float
+    duration_ms: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+def _prompt_chars(messages: List[list]) -> int:
+    total = 0
+    for batch in messages:
+        for message in batch:
+            content = message.content
+            total += len(content) if isinstance(content, str) else sum(
+                len(part if isinstance(part, str) else part.get("text", "")) for part in content)
+    return total
+
+
+def _model_name(serialized: Optional[dict], kwargs: dict) -> str:
+    params = kwargs.get("invocation_params") or {}
+    return str(params.get("model") or params.get("model_name") or params.get("_type")
+               or (serialized or {}).get("name") or "unknown")
+
+
+class RequestTrace(BaseCallbackHandler):
+    """1リクエスト分のノード・LLM呼び出しのスパンを記録するコールバック。
+    スパンの終了時に metrics へメトリクスを記録し、finish() でトレース全体を辞書として返します。
+    """
+
+    def __init__(self, metrics: Optional[MetricsRegistry] = default_metrics, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._open: Dict[Any, Tuple[Span, float]] = {}
+        self._finished: Optional[dict] = None
+
+    def _elapsed_ms(self, now: Optional[float] = None) -> float:
+        return ((now or time.perf_counter()) - self.start) * 1000
+
+    def _open_span(self, run_id, span: Span) -> None:
+        with self._lock:
+            self._open[run_id] = (span, time.perf_counter())
+
+    def _close_span(self, run_id) -> Optional[Span]:
+        now = time.perf_counter()
+        with self._lock:
+            opened = self._open.pop(run_id, None)
+            if opened is None:
+                return None
+            span, started = opened
+            span.duration_ms = round((now - started) * 1000, 3)
+            span.start_ms = round(span.start_ms, 3)
+            self.spans.append(span)
+        return span
+
+    # グラフノード
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # ノード内部の子チェーン（ToolNode内の処理など）は除き、ノード本体だけを計測する
+        if node and kwargs.get("name") == node:
+            self._open_span(run_id, Span(node, "node", self._elapsed_ms(), attributes={"node": node}))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        span = self._close_span(run_id)
+        if span is not None and self.metrics is not None:
+            self.metrics.observe("faq_node_duration_seconds", {"node": span.name}, span.duration_ms / 1000)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        span = self._close_span(run_id)
+        if span is not None:
+            span.attributes["error"] = repr(error)
+            if self.metrics is not None:
+                self.metrics.inc("faq_node_errors", {"node": span.name})
+
+    # LLM呼び出し
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node", "unknown")
+        model = _model_name(serialized, kwargs)
+        self._open_span(run_id, Span(f"llm:{node}", "llm", self._elapsed_ms(), attributes={
+            "node": node, "model": model, "prompt_chars": _prompt_chars(messages),
+        }))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        span = self._close_span(run_id)
+        if span is None:
+            return
+        prompt_tokens = completion_tokens = cached_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0)
+        span.attributes.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                               cached_prompt_tokens=cached_tokens)
+        if self.metrics is not None:
+            labels = {"node": span.attributes["node"], "model": span.attributes["model"]}
+            self.metrics.observe("faq_llm_call_duration_seconds", labels, span.duration_ms / 1000)
+            self.metrics.inc("faq_llm_prompt_tokens", labels, prompt_tokens)
+            self.metrics.inc("faq_llm_completion_tokens", labels, completion_tokens)
+            self.metrics.inc("faq_llm_cached_prompt_tokens", labels, cached_tokens)
+            self.metrics.inc("faq_llm_prompt_chars", labels, span.attributes["prompt_chars"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        span = self._close_span(run_id)
+        if span is not None:
+            span.attributes["error"] = repr(error)
+            if self.metrics is not None:
+                self.metrics.inc("faq_llm_errors", {"node": span.attributes["node"], "model": span.attributes["model"]})
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        with self._lock:
+            self.retries += 1
+        if self.metrics is not None:
+            self.metrics.inc("faq_llm_retries")
+
+    # 応答キャッシュ
+    def record_cache_lookup(self, result: str) -> None:
+        """応答キャッシュの参照結果（"exact" / "similar" / "miss"、会話の文脈があり参照しなかった場合は "bypass"）を記録します。"""
+        with self._lock:
+            self.spans.append(Span("response_cache", "cache", round(self._elapsed_ms(), 3),
+                                   attributes={"result": result}))
+        if self.metrics is not None:
+            self.metrics.inc("faq_response_cache_lookups", {"result": result})
+
+    def finish(self) -> dict:
+        """トレースを終了し、リクエスト全体のメトリクスを記録して、JSONに変換できる辞書を返します。
+        TRACE_LOG_PATH が設定されている場合は、トレースをJSONLファイルに追記します。
+        """
+        if self._finished is not None:
+            return self._finished
+        duration_ms = self._elapsed_ms()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ms)
+        self._finished = {
+            "trace_id": self.trace_id,
+            "duration_ms": round(duration_ms, 3),
+            "retries": self.retries,
+            "spans": [asdict(span) for span in spans],
+        }
+        if self.metrics is not None:
+            self.metrics.inc("faq_requests")
+            self.metrics.observe("faq_request_duration_seconds", None, duration_ms / 1000)
+        if TRACE_LOG_PATH:
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self._finished, ensure_ascii=False) + "\n")
+        return self._finished
+
+
+def record_cache_lookup(config: Optional[dict], result: str) -> None:
+    """config の callbacks に含まれる RequestTrace に、応答キャッシュの参照結果を記録します。"""
+    callbacks = (config or {}).get("callbacks") or []
+    for handler in getattr(callbacks, "handlers", callbacks):
+        if isinstance(handler, RequestTrace):
+            handler.record_cache_lookup(result)
@@ -0,0 +1,306 @@
+# LLMプロバイダー層
+# エージェントが使うチャットモデルを、役割（LLM_ROLES）ごとに提供します。
+#   gemini:   Google Gemini（本番用）
+#   fake:     ネットワークを使わない決定的な偽LLM（遅延分布・トークン生成速度を設定可能）
+#   cassette: 記録済みの応答をカセットファイルから再生します。記録モードでは下位のプロバイダーを呼び出して応答を保存します。
+# 環境変数 LLM_PROVIDER で切り替えられます（create_llm_provider_from_env を参照）。
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# 役割 -> 温度
+LLM_ROLES = {
+    "response": 0.2, # 最終応答の生成とツール選択
+    "relevance": 0.0, # 関連度評価
+    "classifier": 0.0, # カテゴリー分類
+    "summary": 0.0, # 古い会話ターンの要約
+}
+DEFAULT_GEMINI_MODEL = "gemini-1.5-flash"
+DEFAULT_CASSETTE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "llm_cassette.json")
+CASSETTE_MODES = ("replay", "record", "auto")
+
+
+class LLMProvider:
+    """役割ごとのチャットモデルを返すプロバイダーの共通インターフェース。"""
+
+    name = "base"
+
+    def chat_model(self, role: str) -> BaseChatModel:
+        raise NotImplementedError
+
+    def json_model(self, role: str, schema: Dict[str, Any]) -> Runnable:
+        """応答を JSON スキーマ schema に従うJSONに制約したモデルを返します。
+        構造化出力に対応しないプロバイダーでは chat_model と同じモデルを返すため、出力形式はプロンプトでも指示してください。
+        """
+        return self.chat_model(role)
+
+    def register_prompt_prefix(self, template: Any) -> None:
+        """静的なプレフィックスを持つプロンプトテンプレート（prompt_templates.PromptTemplate）を登録します。
+        create_agent_app がコーパスごとに1回、すべてのテンプレートについて呼び出します。
+        プロバイダー側のコンテキストキャッシュを明示的に作成する場合は、ここで template.prefix をキャッシュします。
+        既定では何もしません（Gemini は先頭が一致するプロンプトを暗黙的にキャッシュするため、プレフィックスを固定するだけで効きます）。
+        """
+
+
+def _check_role(role: str) -> None:
+    if role not in LLM_ROLES:
+        raise ValueError(f"未対応のLLMの役割です: {role}（利用可能: {', '.join(LLM_ROLES)}）")
+
+
+class LLMClientPool:
+    """(モデル, 温度) ごとに長寿命の Gemini チャットモデルを保持し、セッション・ノード間で共有するプール。
+    同じモデルのチャットモデルは1つの google-genai クライアント（HTTP接続プール、keep-alive）を共有します。
+    base_url / google_api_key はテスト用のエンドポイントなどを使う場合に指定します。
+    """
+
+    def __init__(self, base_url: Optional[str] = None, google_api_key: Optional[str] = None):
+        self.base_url = base_url
+        self.google_api_key = google_api_key
+        self._lock = threading.Lock()
+        self._models: Dict[tuple, BaseChatModel] = {}
+        self._http_clients: Dict[str, Any] = {} # モデル名 -> google.genai.Client
+        self.counters = {"lookups": 0, "created": 0}
+
+    def get(self, model: str, temperature: float) -> BaseChatModel:
+        """(model, temperature) のチャットモデルを返します。初回だけ作成します。"""
+        key = (model, temperature)
+        with self._lock:
+            self.counters["lookups"] += 1
+            if key not in self._models:
+                self._models[key] = self._create(model, temperature)
+                self.counters["created"] += 1
+            return self._models[key]
+
+    def _create(self, model: str, temperature: float) -> BaseChatModel:
+        # GOOGLE_API_KEY環境変数が設定されていない場合、ここでエラーが発生する可能性があります。
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        options = {}
+        if self.base_url:
+            options["base_url"] = self.base_url
+        if self.google_api_key:
+            options["google_api_key"] = self.google_api_key
+        chat_model = ChatGoogleGenerativeAI(model=model, temperature=temperature, **options)
+        # 温度は呼び出しごとのパラメーターなので、同じモデルのクライアント（接続プール）は共有できる
+        shared_client = self._http_clients.setdefault(model, chat_model.client)
+        chat_model.client = shared_client
+        return chat_model
+
+    def stats(self) -> Dict[str, Any]:
+        """保持しているチャットモデル数・HTTPクライアント数・参照回数・作成回数・開いているHTTP接続数を返します。"""
+        with self._lock:
+            http_clients = list(self._http_clients.values())
+            stats = {**self.counters, "models": len(self._models), "http_clients": len(http_clients)}
+        stats["reused"] = stats["lookups"] - stats["created"]
+        stats["open_connections"] = sum(_open_connections(client) for client in http_clients)
+        return stats
+
+
+def _open_connections(client: Any) -> int:
+    # google-genai の同期HTTPクライアント（httpx）の接続プール内の接続数。内部構造が変わった場合は0を返す
+    try:
+        return len(client._api_client._httpx_client._transport._pool.connections)
+    except AttributeError:
+        return 0
+
+
+# プロセス全体で共有する Gemini クライアントのプール
+default_client_pool = LLMClientPool()
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini のチャットモデルを役割の温度ごとにクライアントプールから返します。"""
+
+    name = "gemini"
+
+    def __init__(self, model: str = DEFAULT_GEMINI_MODEL, pool: Optional[LLMClientPool] = None):
+        self.model = model
+        self.pool = pool or default_client_pool
+
+    def chat_model(self, role: str) -> BaseChatModel:
+        _check_role(role)
+        return self.pool.get(self.model, LLM_ROLES[role])
+
+    def json_model(self, role: str, schema: Dict[str, Any]) -> Runnable:
+        # クライアントはプールのものを共有し、呼び出しごとの生成設定としてスキーマを渡す
+        return self.chat_model(role).bind(response_mime_type="application/json", response_schema=schema)
+
+
+class FakeProvider(LLMProvider):
+    """すべての役割に同じ偽LLM（fake_llm.FakeChatModel）を返します。
+    latency_distribution / latency_spread / seed で呼び出しごとの遅延の分布を、tokens_per_second で生成速度を指定します。
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0, latency_distribution: str = "constant", latency_spread: float = 0.0,
+                 tokens_per_second: float = 0.0, seed: int = 0, model: Optional[BaseChatModel] = None):
+        from fake_llm import FakeChatModel, latency_distribution as make_sampler
+
+        self.model = model or FakeChatModel(
+            latency=latency, tokens_per_second=tokens_per_second,
+            latency_sampler=make_sampler(latency_distribution, latency, latency_spread, seed)
+            if latency_distribution != "constant" else None,
+        )
+
+    def chat_model(self, role: str) -> BaseChatModel:
+        _check_role(role)
+        return self.model
+
+    def register_prompt_prefix(self, template: Any) -> None:
+        # 登録されたプレフィックスで始まるプロンプトは、その部分をキャッシュから読み込んだトークンとして報告する
+        if hasattr(self.model, "prompt_prefixes"):
+            self.model.prompt_prefixes[template.key] = template.prefix
+
+
+class CassetteMissError(KeyError):
+    """再生モードで、カセットに記録されていないリクエストが送られた場合に送出される例外。"""
+
+
+class Cassette:
+    """リクエストのハッシュ -> 応答メッセージ を保存するJSONファイル。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def request_key(role: str, messages: List[BaseMessage], tools: Optional[list]) -> str:
+        payload = json.dumps({"role": role, "messages": [message_to_dict(message) for message in messages],
+                              "tools": tools or []}, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[AIMessage]:
+        with self._lock:
+            entry = self.entries.get(key)
+        return messages_from_dict([entry])[0] if entry is not None else None
+
+    def put(self, key: str, message: AIMessage) -> None:
+        with self._lock:
+            self.entries[key] = message_to_dict(message)
+            self._save()
+
+    def _save(self) -> None:
+        # 途中で中断されても壊れたファイルが残らないよう、一時ファイルに書き込んでから置き換える
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def _message_chunk(message: AIMessage) -> AIMessageChunk:
+    tool_call_chunks = [{"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False),
+                         "id": call["id"], "index": position} for position, call in enumerate(message.tool_calls)]
+    return AIMessageChunk(content=message.content, tool_call_chunks=tool_call_chunks,
+                          usage_metadata=message.usage_metadata)
+
+
+class CassetteChatModel(BaseChatModel):
+    """カセットから応答を再生するチャットモデル。
+    mode="replay": 記録済みの応答だけを返し、未記録なら CassetteMissError を送出します。
+    mode="record": 常に inner を呼び出し、応答を記録します。
+    mode="auto": 記録済みなら再生し、未記録なら inner を呼び出して記録します。
+    """
+
+    cassette: Any
+    role: str
+    inner: Optional[Runnable] = None # chat_model または json_model のモデル
+    mode: str = "replay"
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette-chat-model"
+
+    def bind_tools(self, tools: List[Any], **kwargs: Any):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _respond(self, messages: List[BaseMessage], tools: Optional[list]) -> AIMessage:
+        key = Cassette.request_key(self.role, messages, tools)
+        if self.mode != "record":
+            recorded = self.cassette.get(key)
+            if recorded is not None:
+                return recorded
+            if self.mode == "replay" or self.inner is None:
+                raise CassetteMissError(f"カセットに記録されていないリクエストです（役割: {self.role}, キー: {key[:12]}）")
+        model = self.inner.bind_tools(tools) if tools else self.inner
+        message = model.invoke(messages)
+        response = AIMessage(content=message.content, tool_calls=message.tool_calls,
+                             usage_metadata=message.usage_metadata)
+        self.cassette.put(key, response)
+        return response
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages, kwargs.get("tools")))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        chunk = ChatGenerationChunk(message=_message_chunk(self._respond(messages, kwargs.get("tools"))))
+        if run_manager:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        yield chunk
+
+
+class CassetteProvider(LLMProvider):
+    """役割ごとに CassetteChatModel を返します。inner を指定すると、未記録のリクエストを inner で記録できます。"""
+
+    name = "cassette"
+
+    def __init__(self, path: str = DEFAULT_CASSETTE_PATH, inner: Optional[LLMProvider] = None, mode: str = "auto"):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"未対応のカセットモードです: {mode}（利用可能: {', '.join(CASSETTE_MODES)}）")
+        self.cassette = Cassette(path)
+        self.inner = inner
+        self.mode = mode if inner is not None else "replay"
+        self._models: Dict[str, BaseChatModel] = {}
+
+    def chat_model(self, role: str) -> BaseChatModel:
+        _check_role(role)
+        if role not in self._models:
+            self._models[role] = CassetteChatModel(cassette=self.cassette, role=role, mode=self.mode,
+                                                   inner=self.inner.chat_model(role) if self.inner else None)
+        return self._models[role]
+
+    def json_model(self, role: str, schema: Dict[str, Any]) -> Runnable:
+        # 記録時は下位のプロバイダーの構造化出力で応答を得る（再生時のキーは chat_model と同じ）
+        _check_role(role)
+        return CassetteChatModel(cassette=self.cassette, role=role, mode=self.mode,
+                                 inner=self.inner.json_model(role, schema) if self.inner else None)
+
+    def register_prompt_prefix(self, template: Any) -> None:
+        if self.inner is not None:
+            self.inner.register_prompt_prefix(template)
+
+
+def create_llm_provider_from_env() -> LLMProvider:
+    """環境変数からLLMプロバイダーを作成します。
+    LLM_PROVIDER: gemini（既定）/ fake / cassette
+    LLM_FAKE_LATENCY: fake の1回あたりの遅延（秒）
+    LLM_CASSETTE_PATH / LLM_CASSETTE_MODE: cassette のファイルとモード（replay / record / auto、記録時は Gemini を使用）
+    """
+    provider_name = os.getenv("LLM_PROVIDER", "gemini")
+    if provider_name == "fake":
+        return FakeProvider(latency=float(os.getenv("LLM_FAKE_LATENCY", "0")))
+    if provider_name == "cassette":
+        mode = os.getenv("LLM_CASSETTE_MODE", "replay")
+        return CassetteProvider(os.getenv("LLM_CASSETTE_PATH", DEFAULT_CASSETTE_PATH),
+                                inner=GeminiProvider() if mode != "replay" else None, mode=mode)
+    if provider_name != "gemini":
+        raise ValueError(f"未対応のLLMプロバイダーです: {provider_name}（利用可能: gemini, fake, cassette）")
+    return GeminiProvider(os.getenv("GEMINI_MODEL", DEFAULT_GEMINI_MODEL))
@@ -0,0 +1,93 @@
+# ログ出力の設定
+# 各モジュールは logging.getLogger(__name__) で取得したロガーに、%形式の引数付きで出力します
+# （例: logger.debug("分類結果: %s", category)）。レベルが無効な呼び出しは文字列を組み立てずに即座に戻ります。
+# 出力はキュー経由でバックグラウンドスレッドに渡され、書式化と標準エラー出力への書き込みはそのスレッドで行われます。
+#
+# 環境変数:
+#   LOG_LEVEL: ログレベル（DEBUG / INFO / WARNING / ERROR、既定は INFO）
+#   LOG_PAYLOAD_SAMPLE_RATE: 状態全体・プロンプト・LLMの生の応答などの大きなペイロードのログを出力する割合（0〜1、既定は1）
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+DEFAULT_LOG_LEVEL = "INFO"
+
+
+# 書式化をリスナーのスレッドに任せてよい（呼び出し後に値が変わらない）引数の型
+_IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+def _is_immutable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(map(_is_immutable, value))
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """レコードを書式化せずにキューへ渡す QueueHandler。
+    標準の QueueHandler は呼び出し元のスレッドでメッセージを書式化するため、書式化もリスナーのスレッドに任せます。
+    ただし、引数に変更可能なオブジェクト（状態の辞書やメッセージのリストなど）を含むレコードは、
+    出力までの間に呼び出し元で値が変わらないよう、呼び出し元のスレッドで書式化してからキューへ渡します。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if not isinstance(record.msg, str) or (record.args and not _is_immutable(record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """レコードを rate の割合だけ通すフィルター。"""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1.0 or random.random() < self.rate
+
+
+_payload_filter = SamplingFilter(float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1")))
+_lock = threading.Lock()
+_listener: Optional[QueueListener] = None
+
+
+def payload_logger(name: str) -> logging.Logger:
+    """大きなペイロード用のロガー（<name>.payload）を返します。
+    DEBUGレベルで、LOG_PAYLOAD_SAMPLE_RATE の割合だけ出力されます。
+    """
+    logger = logging.getLogger(f"{name}.payload")
+    if _payload_filter not in logger.filters:
+        logger.addFilter(_payload_filter)
+    return logger
+
+
+def configure_logging(level: Optional[str] = None, payload_sample_rate: Optional[float] = None,
+                      stream=None) -> None:
+    """ルートロガーにキュー経由のハンドラーを設定します。2回目以降の呼び出しではレベルとサンプリング率だけを変更します。
+    level を省略すると環境変数 LOG_LEVEL を使用します。
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel((level or os.getenv("LOG_LEVEL", DEFAULT_LOG_LEVEL)).upper())
+    if payload_sample_rate is not None:
+        _payload_filter.rate = payload_sample_rate
+    with _lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_queue = queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        # 終了時にキューに残ったログを書き出す
+        atexit.register(_listener.stop)
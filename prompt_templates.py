@@ -0,0 +1,138 @@
+# エージェントが発行するプロンプトのテンプレート
+# 各プロンプトを、コーパスごとに変わらない前半（プレフィックス: システムプロンプト・指示・カテゴリー一覧・事前に整形した
+# カテゴリーの質問リスト）と、リクエストごとに変わる後半（サフィックス: 会話の文脈・ユーザーの質問・検索結果）に分けます。
+# プレフィックスは create_agent_app の実行時にコーパスごとに1回だけ組み立て、すべてのリクエストで同じ文字列をそのまま先頭に置くため、
+# プロバイダーのプレフィックス（コンテキスト）キャッシュが効きます（LLMProvider.register_prompt_prefix を参照）。
+#
+# 使い方:
+#   prompts = CorpusPrompts(system_prompt, agent_identity, categories, category_blocks)
+#   prompts.classifier.render(conversation="", question="営業時間は？")
+#   prompts.category_relevance[category].render(query=query)  # 質問リストを事前に整形したカテゴリーの関連度評価
+#   prompts.relevance.render(category=category, qa_block=qa_block, query=query)  # 候補をクエリごとに整形する関連度評価
+import hashlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """静的なプレフィックスと、str.format で埋めるサフィックスからなるプロンプト。
+    key はプレフィックスのハッシュで、同じ key のプロンプトは先頭の prefix がバイト単位で一致します。
+    """
+    name: str
+    role: str # このテンプレートのプロンプトを送るLLMの役割（llm_provider.LLM_ROLES）
+    prefix: str
+    suffix: str
+    key: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "key", hashlib.sha256(self.prefix.encode("utf-8")).hexdigest()[:16])
+
+    def render(self, **fields) -> str:
+        return self.prefix + self.suffix.format(**fields)
+
+
+# 関連度評価の指示（全コーパス・全カテゴリーで共通。応答は relevance_parsing.RELEVANCE_RESPONSE_SCHEMA の最小限のJSON）
+RELEVANCE_INSTRUCTIONS = """
+以下の社内ドキュメントの質問リストについて、それぞれの質問が、最後に示すユーザーの質問と意味的にどの程度関連しているかを評価してください。
+関連度を0から100の整数で評価し、最も関連性の高いQAペアのインデックス（QA_PAIR_NのN）と、その関連度スコアを特定してください。
+
+評価結果は、次の形式のJSONのみで出力してください（各QAペアの評価は出力しないでください）。
+{"index": N, "score": S}
+- "index": 関連度が最も高いQAペアのNです。
+- "score": その関連度スコア（0-100の整数）です。
+"""
+
+_QA_LIST = """
+---
+社内ドキュメントの質問リスト（カテゴリー: {category}）:
+{qa_block}
+---
+"""
+
+_QUERY_TAIL = """ユーザーの質問: "{query}"
+評価結果:
+"""
+
+
+class CorpusPrompts:
+    """1つのコーパス（システムプロンプト・アイデンティティ・カテゴリー）のプロンプトテンプレート一式。
+    category_blocks には、毎回全件を評価するカテゴリーの整形済みの質問リスト（app.format_qa_block）を渡します。
+    これらのカテゴリーの関連度評価は、質問リストまでをプレフィックスに含むカテゴリー専用のテンプレートで組み立てます。
+    """
+
+    def __init__(self, system_prompt: str, agent_identity: str, categories: List[str],
+                 category_blocks: Optional[Dict[str, str]] = None):
+        category_list = ", ".join(f"'{category}'" for category in categories)
+
+        self.classifier = PromptTemplate("classifier", "classifier", f"""
+{system_prompt}
+
+ユーザーからの質問が、以下のカテゴリーのどれに最も当てはまるかを判断してください。
+
+利用可能なカテゴリー: {category_list}
+
+もし質問が上記のカテゴリーのどれにも当てはまらない、または非常に一般的な質問や個人的な質問の場合は、「その他」と回答してください。
+（「その他」というカテゴリーも上記のリストに含まれています）
+
+回答は、上記のカテゴリー名（例: 'ファンクラブ・会員サービス', 'チケット・イベント' など）のいずれか、または「その他」という単語のみを返してください。
+余計な文字は含めないでください。
+""", """{conversation}
+質問: {question}
+分類:
+""")
+
+        # 候補をクエリごとに整形する関連度評価（大きなカテゴリーの上位K件・分割評価・カテゴリー横断の評価）
+        self.relevance = PromptTemplate("relevance", "relevance", RELEVANCE_INSTRUCTIONS, _QA_LIST + _QUERY_TAIL)
+        self.category_relevance = {
+            category: PromptTemplate(f"relevance:{category}", "relevance",
+                                     RELEVANCE_INSTRUCTIONS + _QA_LIST.format(category=category, qa_block=qa_block),
+                                     _QUERY_TAIL)
+            for category, qa_block in (category_blocks or {}).items()
+        }
+
+        self.fused = PromptTemplate("fused", "relevance", f"""
+{system_prompt}
+
+最後に示すユーザーの質問について、カテゴリーの分類と関連度評価を同時に行ってください。
+
+1. 質問が以下のカテゴリーのどれに最も当てはまるかを判断してください。どれにも当てはまらない場合は「その他」としてください。
+利用可能なカテゴリー: {category_list}
+2. 社内ドキュメントの質問リストから、ユーザーの質問と意味的に最も関連するQAペアのインデックス（QA_PAIR_NのN）と、その関連度スコア（0から100の整数）を特定してください。
+
+評価結果は、次の形式のJSONのみで出力してください。
+{{"category": "カテゴリー名", "index": N, "score": S}}
+""", _QA_LIST.replace("{category}", "全カテゴリー") + _QUERY_TAIL)
+
+        # ツール選択のプロンプト（ツールの定義はモデルにバインドされているため、指示だけをプレフィックスにする）
+        self.tool_request = PromptTemplate("tool_request", "response", """
+社内ドキュメント検索ツール `search_qa_by_category` を使用して、最後に示すユーザーの質問に関する情報を検索してください。
+検索クエリはユーザーの質問内容そのままを、カテゴリーには予測されたカテゴリーを渡してください。
+""", """ユーザーの質問「{query}」
+予測されたカテゴリー「{category}」
+""")
+
+        self.answer = PromptTemplate("answer", "response", f"""
+あなたは{agent_identity}です。
+ユーザーの質問に対する社内ドキュメントの検索結果をもとに、{agent_identity}として、ユーザーに分かりやすく、丁寧かつ親しみやすい言葉で回答を生成してください。
+もし検索結果が「申し訳ございません、お探しの情報が見つかりませんでした。」または「指定されたカテゴリーには関連情報がありませんでした。」という内容であった場合、ユーザーの質問を理解できなかったことを丁寧に伝え、他に何かお手伝いできることがないか尋ねるようにしてください。
+""", """{conversation}
+ユーザーの質問「{query}」に対する社内ドキュメントの検索結果は以下の通りです。
+---
+検索結果: {tool_result}
+---
+""")
+
+        # ツール呼び出しが行われなかった場合（例: ツール選択のLLMがツールを選ばなかった場合など）
+        self.direct_answer = PromptTemplate("direct_answer", "response", f"""
+あなたは{agent_identity}です。
+ユーザーからの質問に、丁寧かつ親しみやすい言葉で回答してください。
+もし回答できない内容であれば、その旨を伝え、他に何かお手伝いできることがないか尋ねてください。
+""", """{conversation}
+ユーザーからの質問: 「{query}」
+""")
+
+    def templates(self) -> List[PromptTemplate]:
+        """プレフィックスを持つすべてのテンプレート（プロバイダーのコンテキストキャッシュへの登録用）を返します。"""
+        return [self.classifier, self.relevance, *self.category_relevance.values(), self.fused, self.tool_request,
+                self.answer, self.direct_answer]
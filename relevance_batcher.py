@@ -0,0 +1,184 @@
+# 関連度評価のマイクロバッチ処理
+# 同じカテゴリーに対して同時に届いた複数の関連度評価リクエストを短時間だけ待ち合わせ、
+# 1回のLLM呼び出しでまとめて評価します（HTTPサーバーなど、多数の会話を並行して処理する場合に使用）。
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from faq_store import FaqRow
+from relevance_parsing import parse_relevance_response
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _ScoringRequest:
+    query: str
+    candidate_rows: List[dict]
+    evaluation_prompt: str
+    future: Future = field(default_factory=Future)
+
+
+class RelevanceBatcher:
+    """カテゴリーごとに関連度評価リクエストをまとめてLLMに渡すバッチャー。
+    最初に届いたリクエストのスレッドが max_wait_ms だけ待ち合わせ、
+    その間に届いた同じカテゴリーのリクエスト（おおよそ max_batch_size 件まで）を1回の呼び出しで評価します。
+    まとめた候補（各リクエストの候補の和集合）は max_candidates 件以下に抑え（app.RELEVANCE_CHUNK_SIZE と同じ既定値）、
+    超える場合はリクエストを複数の呼び出しに分けて並列に評価します。
+    """
+
+    def __init__(self, model, max_batch_size: int = 8, max_wait_ms: float = 10.0, max_candidates: int = 20):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_candidates = max_candidates
+        self.max_wait = max_wait_ms / 1000
+        self._condition = threading.Condition()
+        self._pending: Dict[str, List[_ScoringRequest]] = {}
+        self.counters = {"requests": 0, "llm_calls": 0, "batched_requests": 0}
+
+    def score(self, query: str, category: str, candidate_rows: List[dict],
+              evaluation_prompt: str) -> Tuple[str, List[dict]]:
+        """関連度を評価し、(評価応答のJSONテキスト, 応答のインデックスが指す候補リスト) を返します。
+        1件だけで実行された場合は evaluation_prompt をそのまま使用します。
+        """
+        request = _ScoringRequest(query, candidate_rows, evaluation_prompt)
+        with self._condition:
+            self.counters["requests"] += 1
+            batch = self._pending.setdefault(category, [])
+            batch.append(request)
+            is_leader = len(batch) == 1
+            if len(batch) >= self.max_batch_size:
+                self._condition.notify_all()
+            if is_leader:
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending[category]) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending.pop(category)
+        if is_leader:
+            self._run(category, batch)
+        return request.future.result()
+
+    def _run(self, category: str, batch: List[_ScoringRequest]) -> None:
+        groups = _group_requests(batch, self.max_candidates)
+        with self._condition:
+            self.counters["llm_calls"] += len(groups)
+            self.counters["batched_requests"] += sum(len(requests) for requests, _ in groups if len(requests) > 1)
+        try:
+            if len(batch) > 1:
+                logger.debug("カテゴリー '%s' の関連度評価%d件を%d回の呼び出しで実行します", category, len(batch), len(groups))
+            # 1件だけのグループは単独評価のプロンプトを、複数件のグループは一括評価のプロンプトを使う
+            prompts = [requests[0].evaluation_prompt if len(requests) == 1 else build_batch_prompt(category, requests, rows)
+                       for requests, rows in groups]
+            responses = self.model.batch(prompts) if len(prompts) > 1 else [self.model.invoke(prompts[0])]
+            for (requests, rows), response in zip(groups, responses):
+                response_text = response.content.strip()
+                if len(requests) == 1:
+                    requests[0].future.set_result((response_text, requests[0].candidate_rows))
+                    continue
+                for request, result in zip(requests, split_batch_response(response_text, len(requests))):
+                    request.future.set_result((result, rows))
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+    def stats(self) -> Dict[str, float]:
+        """リクエスト数・LLM呼び出し回数・1回の呼び出しあたりの平均リクエスト数を返します。"""
+        with self._condition:
+            calls = self.counters["llm_calls"]
+            return {**self.counters, "requests_per_call": round(self.counters["requests"] / calls, 2) if calls else 0.0}
+
+
+def _row_key(row: dict):
+    # 行はカテゴリー別インデックスの同じ辞書オブジェクト（FaqStore の行はアクセスごとに作られるビューのため、ストアと行番号で判定する）
+    return (id(row.store), row.index) if isinstance(row, FaqRow) else id(row)
+
+
+def _group_requests(batch: List[_ScoringRequest], max_candidates: int) -> List[Tuple[List[_ScoringRequest], List[dict]]]:
+    """リクエストを到着順に、候補の和集合が max_candidates 件以下になるグループに分け、(リクエスト, 重複なく連結した候補) のリストを返します。
+    1件だけで max_candidates 件を超えるリクエストは、単独のグループにします。
+    """
+    groups: List[Tuple[List[_ScoringRequest], List[dict]]] = []
+    seen = set()
+    for request in batch:
+        new_rows = []
+        for row in request.candidate_rows:
+            key = _row_key(row)
+            if key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+        if groups and len(groups[-1][1]) + len(new_rows) <= max_candidates:
+            groups[-1][0].append(request)
+            groups[-1][1].extend(new_rows)
+        else:
+            groups.append(([request], list(request.candidate_rows)))
+            seen = {_row_key(row) for row in request.candidate_rows}
+    return groups
+
+
+# 一括評価の指示（静的な部分をプロンプトの先頭に置き、プロバイダーのプレフィックスキャッシュが効くようにする）
+BATCH_INSTRUCTIONS = """
+最後に示す複数のユーザーの質問それぞれについて、質問リストの中から意味的に最も関連するQAペアを選んでください（一括関連度評価）。
+関連度は0から100の整数で評価し、質問ごとに最も関連性の高いQAペアのインデックス（QA_PAIR_NのN）と、その関連度スコアを特定してください。
+
+評価結果は、次の形式のJSONのみで出力してください（"query" は QUERY_N のNです）。
+{"results": [{"query": 1, "index": N, "score": S}, ...]}
+"""
+
+# 一括評価の応答の各結果の先頭（途中で途切れた応答は、この位置で区切って質問ごとに読み取る）
+_QUERY_FIELD_PATTERN = re.compile(r'"query"\s*:\s*(\d+)')
+
+
+def build_batch_prompt(category: str, batch: List[_ScoringRequest], candidate_rows: List[dict]) -> str:
+    """複数の質問を1つの候補リストに対してまとめて評価させるプロンプトを返します。"""
+    query_block = "\n".join(f"QUERY_{idx+1}: {request.query}" for idx, request in enumerate(batch))
+    qa_block = "\n".join(f"QA_PAIR_{idx+1}: 質問: {row['質問']}" for idx, row in enumerate(candidate_rows))
+    return f"""{BATCH_INSTRUCTIONS}
+---
+質問リスト（カテゴリー: {category}）:
+{qa_block}
+---
+ユーザーの質問:
+{query_block}
+評価結果:
+"""
+
+
+def split_batch_response(response_text: str, batch_size: int) -> List[str]:
+    """一括評価の応答を、質問ごとの単独評価と同じ形式（{"index": N, "score": S}）のJSONテキストに分割します。
+    質問ごとの結果は relevance_parsing.parse_relevance_response で読み取るため、応答が途中で途切れていても、完結している質問の結果は使えます。
+    結果を読み取れなかった質問には、応答のうちその質問の部分（ない場合は空文字列）を返します
+    （応答全体を返すと他の質問の結果が読み取られてしまうため。呼び出し側で読み取れない応答として扱われ、単独で再評価されます）。
+    """
+    segments: Dict[int, str] = {}
+    start = response_text.find("{")
+    try:
+        parsed, _ = json.JSONDecoder().raw_decode(response_text, start) if start != -1 else (None, 0)
+    except json.JSONDecodeError:
+        parsed = None
+    results = parsed.get("results") if isinstance(parsed, dict) else None
+    if isinstance(results, list):
+        for result in results:
+            if isinstance(result, dict) and type(result.get("query")) is int:
+                segments.setdefault(result["query"], json.dumps(result))
+    else:
+        # JSONとして読めない応答は、各結果の "query" の位置で区切って読み取る
+        marks = [(int(match.group(1)), match.start()) for match in _QUERY_FIELD_PATTERN.finditer(response_text)]
+        for position, (query_number, mark) in enumerate(marks):
+            end = marks[position + 1][1] if position + 1 < len(marks) else len(response_text)
+            segments.setdefault(query_number, response_text[mark:end])
+
+    split = []
+    for idx in range(batch_size):
+        segment = segments.get(idx + 1, "")
+        result, _ = parse_relevance_response(segment)
+        split.append(json.dumps(result) if result is not None else segment)
+    return split
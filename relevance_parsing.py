@@ -0,0 +1,89 @@
+# 関連度評価の応答の読み取り
+# 関連度評価（app.py）と一括評価（relevance_batcher.py）の応答を、同じ方法で読み取ります。
+import json
+import re
+
+# 関連度評価の応答のJSONスキーマ（最も関連性の高いQAペアのインデックスとその関連度スコアのみを出力させる）
+# 構造化出力に対応したモデル（Gemini）では、応答をこのスキーマに制約します（LLMProvider.json_model を参照）。
+RELEVANCE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"index": {"type": "integer"}, "score": {"type": "integer"}},
+    "required": ["index", "score"],
+}
+
+# 分類と関連度評価の統合（fuse_classification=True）の応答のスキーマ（関連度評価の結果に予測カテゴリーを加えたもの）
+FUSED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"category": {"type": "string"}, **RELEVANCE_RESPONSE_SCHEMA["properties"]},
+    "required": ["category", "index", "score"],
+}
+
+
+# 途中で途切れた応答からも読み取れるよう、値の後ろに区切り文字が続く（数値が完結している）項目だけを拾う
+_RELEVANCE_FIELD_PATTERN = re.compile(r'"(index|most_relevant_index|score|max_score)"\s*:\s*(-?\d+(?:\.\d+)?)(?=\s*[,}\]])')
+
+
+def _relevance_pair(parsed) -> dict | None:
+    # {"index", "score"} のほか、旧形式（most_relevant_index / max_score、evaluations の配列）も読む
+    if not isinstance(parsed, dict):
+        return None
+    for index_key, score_key in (("index", "score"), ("most_relevant_index", "max_score")):
+        index, score = parsed.get(index_key), parsed.get(score_key)
+        if type(index) is int and isinstance(score, (int, float)) and not isinstance(score, bool):
+            return {"index": index, "score": score}
+    evaluations = parsed.get("evaluations")
+    pairs = [pair for pair in map(_relevance_pair, evaluations if isinstance(evaluations, list) else []) if pair]
+    return max(pairs, key=lambda pair: pair["score"]) if pairs else None
+
+
+def parse_relevance_response(response_text: str) -> tuple[dict | None, str]:
+    """関連度評価の応答から {"index": N, "score": S}（最も関連性の高いQAペアとその関連度スコア）を取り出し、
+    (結果, 読み取り方) を返します。読み取り方は次のいずれかです。
+    parsed: 応答中の最初のJSONオブジェクトとして読めた（コードブロック記号や前後の文章は無視）
+    salvaged: JSONとしては読めないが（途中で途切れた応答など）、完結している index と score の組を拾えた
+    failed: 結果を取り出せなかった（結果は None）
+    """
+    decoder = json.JSONDecoder()
+    start = response_text.find("{")
+    while start != -1:
+        try:
+            parsed, _ = decoder.raw_decode(response_text, start)
+        except json.JSONDecodeError:
+            break
+        pair = _relevance_pair(parsed)
+        if pair is not None:
+            return pair, "parsed"
+        start = response_text.find("{", start + 1)
+
+    # 先頭から index と score の組を順に拾い、最も関連度の高い組を採用する
+    pairs = []
+    index = None
+    for key, value in _RELEVANCE_FIELD_PATTERN.findall(response_text):
+        if key in ("index", "most_relevant_index"):
+            index = int(float(value))
+        elif index is not None:
+            pairs.append({"index": index, "score": int(float(value)) if float(value).is_integer() else float(value)})
+            index = None
+    if pairs:
+        return max(pairs, key=lambda pair: pair["score"]), "salvaged"
+    return None, "failed"
+
+
+# 統合評価の応答の予測カテゴリー（途中で途切れた応答からも、値が完結していれば拾う）
+_FUSED_CATEGORY_PATTERN = re.compile(r'"category"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+
+def parse_fused_response(response_text: str) -> tuple[dict | None, str]:
+    """分類と関連度評価の統合の応答から {"category": C, "index": N, "score": S} を取り出し、(結果, 読み取り方) を返します。
+    index と score は parse_relevance_response と同じ方法で読み取ります（読み取り方も同じ）。
+    予測カテゴリーを読み取れなかった場合、結果の category は None です。
+    """
+    result, outcome = parse_relevance_response(response_text)
+    if result is None:
+        return None, outcome
+    category_match = _FUSED_CATEGORY_PATTERN.search(response_text)
+    try:
+        category = json.loads(category_match.group(1)) if category_match else None
+    except json.JSONDecodeError:
+        category = None
+    return {"category": category, **result}, outcome
@@ -0,0 +1,465 @@
+# コンパイル済みLangGraphアプリの前段に置く応答キャッシュ
+# 1. 完全一致: 正規化したクエリ（NFKC・幅の統一・記号除去）が一致すれば、キャッシュ済みの応答を返す
+# 2. 類似一致: 文字n-gram埋め込みのコサイン類似度が閾値以上の過去のクエリがあれば、その応答を返す
+# エントリはコーパスごとの名前空間に分けて保存し、LRU/TTL/メモリ上限で追い出します。
+# 保存するのは、FAQの回答例に基づいて回答できたターンの応答だけです（answered_from_faq を参照）。
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+
+from instrumentation import record_cache_lookup
+from retrieval import HashingNgramEmbedder
+
+# キャッシュヒット時に応答を返すノード名（app.STREAMED_NODE と同じ）
+CACHED_RESPONSE_NODE = "generate_final_response"
+
+
+def normalize_query(text: str) -> str:
+    """キャッシュキー用にクエリを正規化します。
+    NFKC正規化で全角英数字・半角カナの幅を統一し、小文字化したうえで、句読点・記号・空白を取り除きます。
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in ("P", "S", "Z", "C"))
+
+
+@dataclass
+class CacheEntry:
+    """キャッシュされた1件の応答。"""
+    key: str
+    query: str
+    answer: str
+    vector: np.ndarray
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def size(self) -> int:
+        # メモリ上限の計算に使う概算サイズ（バイト）
+        return len(self.query.encode("utf-8")) + len(self.answer.encode("utf-8")) + self.vector.nbytes + 200
+
+
+class CacheBackend:
+    """応答キャッシュの保存先の共通インターフェース。"""
+
+    def get(self, namespace: str, key: str) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    def put(self, namespace: str, entry: CacheEntry) -> None:
+        raise NotImplementedError
+
+    def most_similar(self, namespace: str, vector: np.ndarray) -> Tuple[Optional[CacheEntry], float]:
+        """名前空間内で最も類似度の高いエントリと、そのコサイン類似度を返します。"""
+        raise NotImplementedError
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """プロセス内のLRUキャッシュ。エントリ数・合計サイズ・TTLで追い出します。"""
+
+    def __init__(self, max_entries: int = 10_000, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        # 名前空間ごとの類似検索用行列（エントリの追加・削除時に無効化する）
+        self._matrices: Dict[str, Tuple[List[CacheEntry], np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, entry_key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(entry_key)
+        self._bytes -= entry.size
+        self._matrices.pop(entry_key[0], None)
+
+    def _expired(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.created_at > self.ttl_seconds
+
+    def get(self, namespace: str, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            if self._expired(entry):
+                self._remove((namespace, key))
+                return None
+            self._entries.move_to_end((namespace, key))
+            return entry
+
+    def put(self, namespace: str, entry: CacheEntry) -> None:
+        with self._lock:
+            if (namespace, entry.key) in self._entries:
+                self._remove((namespace, entry.key))
+            self._entries[(namespace, entry.key)] = entry
+            self._bytes += entry.size
+            self._matrices.pop(namespace, None)
+            # 最も長く使われていないエントリから追い出す
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def most_similar(self, namespace: str, vector: np.ndarray) -> Tuple[Optional[CacheEntry], float]:
+        with self._lock:
+            while True:
+                cached = self._matrices.get(namespace)
+                if cached is None:
+                    entries = [entry for (ns, _), entry in self._entries.items() if ns == namespace and not self._expired(entry)]
+                    matrix = np.stack([entry.vector for entry in entries]) if entries else np.empty((0, vector.size), np.float32)
+                    cached = self._matrices[namespace] = (entries, matrix)
+                entries, matrix = cached
+                if not entries:
+                    return None, 0.0
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                entry = entries[best]
+                if self._expired(entry):
+                    # 行列の作成後に期限切れになったエントリ。削除して行列を作り直す
+                    if (namespace, entry.key) in self._entries:
+                        self._remove((namespace, entry.key))
+                    else:
+                        self._matrices.pop(namespace, None)
+                    continue
+                if (namespace, entry.key) in self._entries:
+                    self._entries.move_to_end((namespace, entry.key))
+                return entry, float(scores[best])
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        with self._lock:
+            for entry_key in [k for k in self._entries if namespace is None or k[0] == namespace]:
+                self._remove(entry_key)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """SQLiteファイルに保存する応答キャッシュ。プロセス間・再起動後も共有されます。"""
+
+    def __init__(self, path: str, max_entries: int = 100_000, ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, query TEXT NOT NULL, answer TEXT NOT NULL,"
+            " vector BLOB NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_lru ON response_cache (last_access)")
+        self._conn.commit()
+
+    def _row_to_entry(self, row) -> CacheEntry:
+        key, query, answer, vector, created_at = row
+        return CacheEntry(key, query, answer, np.frombuffer(vector, dtype=np.float32), created_at)
+
+    def get(self, namespace: str, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, query, answer, vector, created_at FROM response_cache"
+                " WHERE namespace = ? AND key = ? AND created_at >= ?",
+                (namespace, key, time.time() - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE response_cache SET last_access = ? WHERE namespace = ? AND key = ?",
+                               (time.time(), namespace, key))
+            self._conn.commit()
+            return self._row_to_entry(row)
+
+    def put(self, namespace: str, entry: CacheEntry) -> None:
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, entry.key, entry.query, entry.answer,
+                 np.ascontiguousarray(entry.vector, dtype=np.float32).tobytes(), entry.created_at, now),
+            )
+            # 期限切れのエントリを削除し、上限を超えた分は最終アクセスの古い順に削除する
+            self._conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE rowid IN"
+                    " (SELECT rowid FROM response_cache ORDER BY last_access LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self.evictions += count - self.max_entries
+            self._conn.commit()
+
+    def most_similar(self, namespace: str, vector: np.ndarray) -> Tuple[Optional[CacheEntry], float]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, query, answer, vector, created_at FROM response_cache"
+                " WHERE namespace = ? AND created_at >= ?",
+                (namespace, time.time() - self.ttl_seconds),
+            ).fetchall()
+        if not rows:
+            return None, 0.0
+        matrix = np.frombuffer(b"".join(row[3] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        return self._row_to_entry(rows[best]), float(scores[best])
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        with self._lock:
+            if namespace is None:
+                self._conn.execute("DELETE FROM response_cache")
+            else:
+                self._conn.execute("DELETE FROM response_cache WHERE namespace = ?", (namespace,))
+            self._conn.commit()
+
+
+class ResponseCache:
+    """完全一致と類似一致の2段階で応答を再利用するキャッシュ。"""
+
+    def __init__(self, backend: Optional[CacheBackend] = None, similarity_threshold: float = 0.92,
+                 embedder=None):
+        self.backend = backend or InMemoryCacheBackend()
+        self.similarity_threshold = similarity_threshold
+        # IDFを学習しない決定的な埋め込み器を使い、プロセスをまたいでもベクトルが一致するようにする
+        self.embedder = embedder or HashingNgramEmbedder(dim=256)
+        self.counters = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    @staticmethod
+    def _key(normalized_query: str) -> str:
+        return hashlib.sha256(normalized_query.encode("utf-8")).hexdigest()
+
+    def lookup(self, namespace: str, query: str) -> Optional[Tuple[str, str]]:
+        """キャッシュ済みの応答があれば (応答, "exact" | "similar") を返します。"""
+        normalized = normalize_query(query)
+        if not normalized:
+            return None
+        entry = self.backend.get(namespace, self._key(normalized))
+        if entry is not None:
+            self._count("exact_hits")
+            return entry.answer, "exact"
+        if self.similarity_threshold < 1.0:
+            entry, similarity = self.backend.most_similar(namespace, self.embedder.embed([normalized])[0])
+            if entry is not None and similarity >= self.similarity_threshold:
+                self._count("similar_hits")
+                return entry.answer, "similar"
+        self._count("misses")
+        return None
+
+    def store(self, namespace: str, query: str, answer: str) -> None:
+        """クエリに対する応答をキャッシュに保存します。"""
+        normalized = normalize_query(query)
+        if not normalized or not answer:
+            return
+        vector = self.embedder.embed([normalized])[0]
+        self.backend.put(namespace, CacheEntry(self._key(normalized), normalized, answer, vector))
+        self._count("stores")
+
+    def stats(self) -> Dict[str, float]:
+        """ヒット・ミスの回数とヒット率を返します。"""
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["similar_hits"]) / lookups if lookups else 0.0
+        stats["evictions"] = getattr(self.backend, "evictions", 0)
+        return stats
+
+
+def answered_from_faq(messages: List[BaseMessage]) -> bool:
+    """ターンのメッセージから、最終応答がFAQの回答例に基づくか（キャッシュに保存してよい応答か）を返します。
+    検索ツールの結果（ToolMessage）が、関連度の高い順の候補（artifact、app.candidate_summary）の先頭の回答例である場合だけ True です。
+    検索・評価・ツール呼び出しのエラーや、関連する回答が見つからなかった場合の応答は、次の質問で結果が変わりうるため保存しません。
+    """
+    tool_message = next((message for message in reversed(messages) if isinstance(message, ToolMessage)), None)
+    if tool_message is None or not tool_message.artifact:
+        return False
+    answer = tool_message.artifact[0].get("回答例")
+    return bool(answer) and answer == tool_message.content
+
+
+def corpus_namespace(corpus_key: str, system_prompt: str) -> str:
+    """コーパスとシステムプロンプトの組み合わせごとのキャッシュ名前空間を返します。"""
+    return f"{corpus_key}:{hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:16]}"
+
+
+class CachedAgentApp:
+    """コンパイル済みのLangGraphアプリを包み、応答キャッシュを前段に挟むラッパー。
+    invoke / stream は元のアプリと同じ形式の結果を返すため、呼び出し側はそのまま置き換えられます。
+    """
+
+    def __init__(self, agent_app, cache: ResponseCache, namespace: str):
+        self.agent_app = agent_app
+        self.cache = cache
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        return getattr(self.agent_app, name)
+
+    @staticmethod
+    def _query(inputs: dict) -> Optional[str]:
+        messages = inputs.get("messages") or []
+        if messages and isinstance(messages[-1], HumanMessage) and isinstance(messages[-1].content, str):
+            return messages[-1].content
+        return None
+
+    def invoke(self, inputs: dict, config: Optional[dict] = None, **kwargs):
+        if self._has_context(config):
+            return self.agent_app.invoke(inputs, config, **kwargs)
+        query = self._query(inputs)
+        cached = self._lookup(query, config)
+        if cached:
+            self._remember_cached_turn(inputs, config, cached[0])
+            return self._cached_result(inputs, cached)
+        result = self.agent_app.invoke(inputs, config, **kwargs)
+        self._store_result(query, result)
+        return result
+
+    async def ainvoke(self, inputs: dict, config: Optional[dict] = None, **kwargs):
+        if await self._ahas_context(config):
+            return await self.agent_app.ainvoke(inputs, config, **kwargs)
+        query = self._query(inputs)
+        cached = self._lookup(query, config)
+        if cached:
+            await self._aremember_cached_turn(inputs, config, cached[0])
+            return self._cached_result(inputs, cached)
+        result = await self.agent_app.ainvoke(inputs, config, **kwargs)
+        self._store_result(query, result)
+        return result
+
+    def stream(self, inputs: dict, config: Optional[dict] = None, stream_mode=None, **kwargs) -> Iterator:
+        if self._has_context(config):
+            yield from self.agent_app.stream(inputs, config, stream_mode=stream_mode, **kwargs)
+            return
+        query = self._query(inputs)
+        modes = stream_mode if isinstance(stream_mode, list) else None
+        cached = self._lookup(query, config) if modes else None
+        if cached:
+            yield from self._cached_chunks(modes, cached)
+            self._remember_cached_turn(inputs, config, cached[0])
+            return
+
+        final_answer, turn_messages = None, []
+        for chunk in self.agent_app.stream(inputs, config, stream_mode=stream_mode, **kwargs):
+            final_answer = self._final_answer(modes, chunk) or final_answer
+            turn_messages.extend(self._update_messages(modes, chunk))
+            yield chunk
+        if query and final_answer and answered_from_faq(turn_messages):
+            self.cache.store(self.namespace, query, final_answer)
+
+    async def astream(self, inputs: dict, config: Optional[dict] = None, stream_mode=None,
+                      **kwargs) -> AsyncIterator:
+        if await self._ahas_context(config):
+            async for chunk in self.agent_app.astream(inputs, config, stream_mode=stream_mode, **kwargs):
+                yield chunk
+            return
+        query = self._query(inputs)
+        modes = stream_mode if isinstance(stream_mode, list) else None
+        cached = self._lookup(query, config) if modes else None
+        if cached:
+            for chunk in self._cached_chunks(modes, cached):
+                yield chunk
+            await self._aremember_cached_turn(inputs, config, cached[0])
+            return
+
+        final_answer, turn_messages = None, []
+        async for chunk in self.agent_app.astream(inputs, config, stream_mode=stream_mode, **kwargs):
+            final_answer = self._final_answer(modes, chunk) or final_answer
+            turn_messages.extend(self._update_messages(modes, chunk))
+            yield chunk
+        if query and final_answer and answered_from_faq(turn_messages):
+            self.cache.store(self.namespace, query, final_answer)
+
+    def _lookup(self, query: Optional[str], config: Optional[dict]) -> Optional[Tuple[str, str]]:
+        if not query:
+            return None
+        cached = self.cache.lookup(self.namespace, query)
+        # リクエストのトレース（instrumentation.RequestTrace）があればヒット/ミスを記録する
+        record_cache_lookup(config, cached[1] if cached else "miss")
+        return cached
+
+    def _has_conversation(self, config: Optional[dict]) -> bool:
+        return (getattr(self.agent_app, "checkpointer", None) is not None
+                and bool((config or {}).get("configurable", {}).get("thread_id")))
+
+    def _has_context(self, config: Optional[dict]) -> bool:
+        # 会話の履歴や要約がある会話では、同じ質問でも文脈（「それは何時まで？」の「それ」など）によって回答が変わるため、
+        # キャッシュを参照も保存もせずにグラフを実行する（キャッシュのキーはクエリだけで、文脈を含まない）
+        return self._has_conversation(config) and self._bypass(config, self.agent_app.get_state(config).values)
+
+    async def _ahas_context(self, config: Optional[dict]) -> bool:
+        return self._has_conversation(config) and self._bypass(config, (await self.agent_app.aget_state(config)).values)
+
+    @staticmethod
+    def _bypass(config: Optional[dict], values: dict) -> bool:
+        if values.get("history") or values.get("summary"):
+            record_cache_lookup(config, "bypass")
+            return True
+        return False
+
+    def _remember_cached_turn(self, inputs: dict, config: Optional[dict], answer: str) -> None:
+        # チェックポインターで会話を保存しているアプリでは、キャッシュから返したターンも最終応答ノードの出力として記録し、
+        # 残りのノード（会話の履歴への追加と要約）だけを実行する
+        if self._has_conversation(config):
+            self.agent_app.update_state(config, {"messages": [*inputs["messages"], AIMessage(content=answer)]},
+                                        as_node=CACHED_RESPONSE_NODE)
+            self.agent_app.invoke(None, config)
+
+    async def _aremember_cached_turn(self, inputs: dict, config: Optional[dict], answer: str) -> None:
+        if self._has_conversation(config):
+            await self.agent_app.aupdate_state(config, {"messages": [*inputs["messages"], AIMessage(content=answer)]},
+                                               as_node=CACHED_RESPONSE_NODE)
+            await self.agent_app.ainvoke(None, config)
+
+    @staticmethod
+    def _cached_result(inputs: dict, cached: Tuple[str, str]) -> dict:
+        return {**inputs, "messages": [*inputs["messages"], AIMessage(content=cached[0])]}
+
+    def _store_result(self, query: Optional[str], result: dict) -> None:
+        if query and result.get("messages") and answered_from_faq(result["messages"]):
+            self.cache.store(self.namespace, query, result["messages"][-1].content)
+
+    @staticmethod
+    def _cached_chunks(modes: list, cached: Tuple[str, str]) -> List[tuple]:
+        # グラフを実行した場合と同じ形式で、キャッシュ済みの応答を最終応答ノードの出力として返す
+        metadata = {"langgraph_node": CACHED_RESPONSE_NODE, "response_cache": cached[1]}
+        chunks = []
+        if "messages" in modes:
+            chunks.append(("messages", (AIMessageChunk(content=cached[0]), metadata)))
+        if "updates" in modes:
+            chunks.append(("updates", {CACHED_RESPONSE_NODE: {"messages": [AIMessage(content=cached[0])]}}))
+        return chunks
+
+    @staticmethod
+    def _final_answer(modes: Optional[list], chunk) -> Optional[str]:
+        if modes and chunk[0] == "updates":
+            update = chunk[1].get(CACHED_RESPONSE_NODE)
+            if isinstance(update, dict) and update.get("messages"):
+                return update["messages"][-1].content
+        return None
+
+    @staticmethod
+    def _update_messages(modes: Optional[list], chunk) -> List[BaseMessage]:
+        # updates ストリームの各ノードの出力から、ターンのメッセージ（検索ツールの ToolMessage を含む）を集める
+        if not modes or chunk[0] != "updates":
+            return []
+        return [message for update in chunk[1].values() if isinstance(update, dict)
+                for message in update.get("messages") or []]
@@ -0,0 +1,456 @@
+# FAQ検索用のローカル検索インデックス
+# LLMによる関連度評価の前段で候補を絞り込むために使用します。
+import json
+import os
+import sys
+import unicodedata
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from index_cache import IndexCache, default_index_cache
+
+# 文字n-gramの既定範囲（日本語は空白で分かち書きされないため文字単位で扱う）
+DEFAULT_NGRAM_RANGE = (2, 3)
+
+
+def normalize_text(text: str) -> str:
+    """検索用にテキストを正規化します（NFKC正規化・小文字化・空白除去）。"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(ch for ch in text if not ch.isspace())
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE) -> List[str]:
+    """正規化済みテキストから文字n-gramのリストを生成します。
+    テキストが最小n-gram長より短い場合は、テキスト全体を1つのトークンとして扱います。
+    """
+    min_n, max_n = ngram_range
+    tokens = []
+    for n in range(min_n, max_n + 1):
+        tokens.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    if not tokens and text:
+        tokens.append(text)
+    return tokens
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """argpartitionでスコア上位top_k件のインデックスを降順で返します。"""
+    if top_k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.intp)
+    if top_k < scores.size:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class BM25Index:
+    """文字n-gramとBM25による転置インデックス。
+    コーパスごとに一度だけ構築し、クエリごとの検索は転置リストの走査のみで行います。
+    転置リストはCSR形式のNumPy配列で保持するため、ディスクからメモリマップで読み込めます。
+    """
+
+    def __init__(self, vocabulary: List[str], offsets: np.ndarray, doc_ids: np.ndarray, term_freqs: np.ndarray,
+                 doc_lengths: np.ndarray, ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE,
+                 k1: float = 1.5, b: float = 0.75):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: term_id for term_id, term in enumerate(vocabulary)}
+        self.offsets = offsets # 語彙iの転置リストは doc_ids[offsets[i]:offsets[i+1]]
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.ngram_range = ngram_range
+        self.k1 = k1
+        self.b = b
+        self.doc_count = len(doc_lengths)
+
+        avg_doc_length = float(doc_lengths.mean()) if self.doc_count else 1.0
+        # 文書長による正規化項とIDF（BM25+の非負IDF）は構築時に計算しておく
+        self.length_norms = (k1 * (1 - b + b * doc_lengths / (avg_doc_length or 1.0))).astype(np.float32)
+        doc_freqs = np.diff(offsets).astype(np.float64)
+        self.idf = np.log(1 + (self.doc_count - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+
+    @classmethod
+    def build(cls, documents: Sequence[str], ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE,
+              **kwargs) -> "BM25Index":
+        """文書リストから転置インデックスを構築します。"""
+        # n-gram -> [(文書インデックス, 出現回数), ...]
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_idx, document in enumerate(documents):
+            term_counts = Counter(char_ngrams(normalize_text(document), ngram_range))
+            doc_lengths[doc_idx] = sum(term_counts.values())
+            for term, count in term_counts.items():
+                postings.setdefault(term, []).append((doc_idx, count))
+
+        vocabulary = list(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+        doc_ids = np.fromiter((doc_idx for term in vocabulary for doc_idx, _ in postings[term]),
+                              dtype=np.int32, count=int(offsets[-1]))
+        term_freqs = np.fromiter((count for term in vocabulary for _, count in postings[term]),
+                                 dtype=np.float32, count=int(offsets[-1]))
+        return cls(vocabulary, offsets, doc_ids, term_freqs, doc_lengths, ngram_range, **kwargs)
+
+    def __len__(self) -> int:
+        return self.doc_count
+
+    def _query_terms(self, query: str) -> Counter:
+        return Counter(char_ngrams(normalize_text(query), self.ngram_range))
+
+    def score_all(self, query: str) -> np.ndarray:
+        """全文書に対するクエリのBM25スコアを返します（一致しない文書は0）。"""
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        k1 = self.k1
+        for term, query_count in self._query_terms(query).items():
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            posting = slice(self.offsets[term_id], self.offsets[term_id + 1])
+            doc_ids, term_freqs = self.doc_ids[posting], self.term_freqs[posting]
+            # 1つの転置リスト内で文書は重複しないため、ファンシーインデックスで加算できる
+            scores[doc_ids] += (query_count * self.idf[term_id] * term_freqs * (k1 + 1)
+                                / (term_freqs + self.length_norms[doc_ids]))
+        return scores
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """スコアの高い順に最大top_k件の (文書インデックス, スコア) を返します。"""
+        scores = self.score_all(query)
+        return [(int(idx), float(scores[idx])) for idx in top_k_indices(scores, top_k) if scores[idx] > 0]
+
+    def coverage(self, query: str, doc_idx: int) -> float:
+        """クエリのn-gramのうち、指定文書に含まれる割合（0.0〜1.0）を返します。"""
+        query_terms = set(self._query_terms(query))
+        if not query_terms:
+            return 0.0
+        matched = 0
+        for term in query_terms:
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            # 転置リストは文書インデックスの昇順に並んでいるため二分探索で判定する
+            doc_ids = self.doc_ids[self.offsets[term_id]:self.offsets[term_id + 1]]
+            position = np.searchsorted(doc_ids, doc_idx)
+            matched += bool(position < len(doc_ids) and doc_ids[position] == doc_idx)
+        return matched / len(query_terms)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """キャッシュ保存用に、転置インデックスを配列の辞書として返します（語彙は別途保存）。"""
+        return {"offsets": self.offsets, "doc_ids": self.doc_ids,
+                "term_freqs": self.term_freqs, "doc_lengths": self.doc_lengths}
+
+
+class CategoryPartition(dict):
+    """カテゴリー -> そのカテゴリーの行のリスト の辞書。
+    コーパスごとに一度だけ構築し、クエリごとのカテゴリーの絞り込みは辞書参照のみで行います。
+    row_ids[カテゴリー] は各行の元のQAデータでの行番号（int32配列）です。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.row_ids: Dict[str, np.ndarray] = {}
+
+    def rows(self, category: str) -> List[dict]:
+        return self.get(category, [])
+
+
+def partition_by_category(qa_data: Iterable[dict]) -> CategoryPartition:
+    """質問文を持つQAデータをカテゴリーごとに分割します。
+    分割のキーのカテゴリー名は sys.intern で1つの文字列オブジェクトにまとめます（JSONから読み込んだ行はカテゴリー名を
+    行ごとに別の文字列として持つため）。渡された行は変更しません。
+    faq_store.FaqStore のように partition_by_category() を持つデータは、その実装に任せます。
+    """
+    if hasattr(qa_data, "partition_by_category"):
+        return qa_data.partition_by_category()
+    partition = CategoryPartition()
+    row_ids: Dict[str, List[int]] = {}
+    for position, item in enumerate(qa_data):
+        if not item.get('質問'):
+            continue
+        category = item.get('カテゴリー')
+        if isinstance(category, str):
+            category = sys.intern(category)
+        partition.setdefault(category, []).append(item)
+        row_ids.setdefault(category, []).append(position)
+    partition.row_ids = {category: np.asarray(ids, dtype=np.int32) for category, ids in row_ids.items()}
+    return partition
+
+
+class RetrievalEngine:
+    """カテゴリー内の候補検索エンジンの共通インターフェース。
+    search は rows(category) に対する (インデックス, スコア) をスコア降順で返します。
+    """
+
+    def rows(self, category: str) -> List[dict]:
+        raise NotImplementedError
+
+    def search(self, query: str, category: str, top_k: int) -> List[Tuple[int, float]]:
+        raise NotImplementedError
+
+    def is_decisive(self, query: str, category: str, hits: List[Tuple[int, float]]) -> bool:
+        """LLMによる評価を省略して1位の候補を回答としてよいかを判定します。"""
+        return False
+
+    def save(self, directory: str) -> None:
+        """構築済みのインデックスをディレクトリに保存します。"""
+        raise NotImplementedError
+
+    @classmethod
+    def load(cls, directory: str, qa_data: Iterable[dict]) -> "RetrievalEngine":
+        """save で保存したインデックスを、QAデータと組み合わせて読み込みます。"""
+        raise NotImplementedError
+
+
+def _write_manifest(directory: str, rows_by_category: Dict[str, List[dict]], **extra) -> None:
+    # カテゴリーの並び順と件数を保存し、読み込み時にQAデータとの整合性を確認する
+    manifest = {"categories": [[category, len(rows)] for category, rows in rows_by_category.items()], **extra}
+    with open(os.path.join(directory, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+
+def _read_manifest(directory: str, rows_by_category: Dict[str, List[dict]]) -> dict:
+    with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    expected = [[category, len(rows)] for category, rows in rows_by_category.items()]
+    if manifest["categories"] != expected:
+        raise ValueError("キャッシュされたインデックスとQAデータのカテゴリー構成が一致しません")
+    return manifest
+
+
+class BM25Engine(RetrievalEngine):
+    """カテゴリーごとのBM25インデックスによる検索エンジン。"""
+
+    def __init__(self, qa_data: Iterable[dict], min_coverage: float = 0.8, min_margin: float = 2.0,
+                 ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE):
+        self.min_coverage = min_coverage
+        self.min_margin = min_margin
+        self._rows = partition_by_category(qa_data)
+        self._indexes = {
+            category: BM25Index.build([row['質問'] for row in rows], ngram_range)
+            for category, rows in self._rows.items()
+        }
+
+    def rows(self, category: str) -> List[dict]:
+        return self._rows.get(category, [])
+
+    def search(self, query: str, category: str, top_k: int) -> List[Tuple[int, float]]:
+        index = self._indexes.get(category)
+        return index.search(query, top_k) if index else []
+
+    def is_decisive(self, query: str, category: str, hits: List[Tuple[int, float]]) -> bool:
+        if not hits or category not in self._indexes:
+            return False
+        if self._indexes[category].coverage(query, hits[0][0]) < self.min_coverage:
+            return False
+        if len(hits) == 1:
+            return True
+        top_score, second_score = hits[0][1], hits[1][1]
+        return second_score <= 0 or top_score / second_score >= self.min_margin
+
+    def save(self, directory: str) -> None:
+        vocabularies = []
+        for position, index in enumerate(self._indexes.values()):
+            for name, array in index.to_arrays().items():
+                np.save(os.path.join(directory, f"category_{position}_{name}.npy"), array)
+            vocabularies.append(index.vocabulary)
+        first_index = next(iter(self._indexes.values()), None)
+        _write_manifest(directory, self._rows, vocabularies=vocabularies,
+                        ngram_range=list(first_index.ngram_range) if first_index else list(DEFAULT_NGRAM_RANGE),
+                        min_coverage=self.min_coverage, min_margin=self.min_margin)
+
+    @classmethod
+    def load(cls, directory: str, qa_data: Iterable[dict]) -> "BM25Engine":
+        engine = cls.__new__(cls)
+        engine._rows = partition_by_category(qa_data)
+        manifest = _read_manifest(directory, engine._rows)
+        engine.min_coverage = manifest["min_coverage"]
+        engine.min_margin = manifest["min_margin"]
+        engine._indexes = {}
+        for position, category in enumerate(engine._rows):
+            # 転置リストの配列はメモリマップで開き、必要な部分だけがページインされるようにする
+            arrays = {
+                name: np.load(os.path.join(directory, f"category_{position}_{name}.npy"), mmap_mode="r")
+                for name in ("offsets", "doc_ids", "term_freqs", "doc_lengths")
+            }
+            engine._indexes[category] = BM25Index(manifest["vocabularies"][position], arrays["offsets"],
+                                                  arrays["doc_ids"], arrays["term_freqs"], arrays["doc_lengths"],
+                                                  tuple(manifest["ngram_range"]))
+        return engine
+
+
+class HashingNgramEmbedder:
+    """ハッシュ化した文字n-gramのTF-IDFを固定次元に射影する決定的な埋め込み器。
+    外部APIを使わずにオフラインで動作し、プロセスをまたいで同じベクトルを返します。
+    """
+
+    # 保存したインデックスのマニフェストに記録する埋め込み器の種類（EmbeddingEngine.load で照合する）
+    identity = "hashing"
+
+    def __init__(self, dim: int = 512, ngram_range: Tuple[int, int] = DEFAULT_NGRAM_RANGE):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        # Pythonのhash()はプロセスごとにソルトされるため、crc32で決定的にハッシュする
+        hashes = np.fromiter(
+            (zlib.crc32(term.encode("utf-8")) for term in char_ngrams(normalize_text(text), self.ngram_range)),
+            dtype=np.uint32,
+        )
+        buckets = (hashes % self.dim).astype(np.intp)
+        # 上位ビットで符号を決め、ハッシュ衝突による偏りを打ち消す
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        return buckets, signs
+
+    def fit(self, documents: Sequence[str]) -> "HashingNgramEmbedder":
+        """文書集合からバケットごとのIDFを計算します。"""
+        doc_freq = np.zeros(self.dim, dtype=np.float64)
+        for document in documents:
+            buckets, _ = self._features(document)
+            doc_freq[np.unique(buckets)] += 1
+        self.idf = (np.log((1 + len(documents)) / (1 + doc_freq)) + 1).astype(np.float32)
+        return self
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """テキストをL2正規化済みの (len(texts), dim) float32行列に変換します。"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        features = [self._features(text) for text in texts]
+        if features:
+            # 全行の特徴量を連結し、np.add.at 1回でまとめて加算する
+            rows = np.repeat(np.arange(len(features)), [len(buckets) for buckets, _ in features])
+            buckets = np.concatenate([buckets for buckets, _ in features])
+            signs = np.concatenate([signs for _, signs in features])
+            np.add.at(matrix, (rows, buckets), signs)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+class LangChainEmbedder:
+    """LangChainの Embeddings（例: GoogleGenerativeAIEmbeddings）を埋め込み器として利用するアダプター。"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    @property
+    def identity(self) -> str:
+        # 埋め込みモデルのクラスとモデル名（異なるモデルで作成した埋め込み行列を読み込まないようにする）
+        return f"langchain:{type(self.embeddings).__name__}:{getattr(self.embeddings, 'model', '')}"
+
+    def fit(self, documents: Sequence[str]) -> "LangChainEmbedder":
+        return self
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.asarray(self.embeddings.embed_documents(list(texts)), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+def _embedder_identity(embedder) -> str:
+    # identity を持たない独自の埋め込み器はクラス名で識別する
+    return getattr(embedder, "identity", None) or type(embedder).__qualname__
+
+
+class EmbeddingEngine(RetrievalEngine):
+    """質問文の埋め込みをカテゴリーごとの連続したfloat32行列に保持する検索エンジン。
+    クエリごとの処理は行列ベクトル積1回とargpartitionによる上位k件の抽出のみです。
+    """
+
+    def __init__(self, qa_data: Iterable[dict], embedder=None, min_similarity: float = 0.9,
+                 min_margin: float = 0.1):
+        self.embedder = embedder or HashingNgramEmbedder()
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self._rows = partition_by_category(qa_data)
+        self.embedder.fit([row['質問'] for rows in self._rows.values() for row in rows])
+        self._matrices: Dict[str, np.ndarray] = {
+            category: np.ascontiguousarray(self.embedder.embed([row['質問'] for row in rows]), dtype=np.float32)
+            for category, rows in self._rows.items()
+        }
+
+    def rows(self, category: str) -> List[dict]:
+        return self._rows.get(category, [])
+
+    def search(self, query: str, category: str, top_k: int) -> List[Tuple[int, float]]:
+        matrix = self._matrices.get(category)
+        if matrix is None or not len(matrix):
+            return []
+        scores = matrix @ self.embedder.embed([query])[0]
+        return [(int(idx), float(scores[idx])) for idx in top_k_indices(scores, top_k)]
+
+    def is_decisive(self, query: str, category: str, hits: List[Tuple[int, float]]) -> bool:
+        if not hits or hits[0][1] < self.min_similarity:
+            return False
+        return len(hits) == 1 or hits[0][1] - hits[1][1] >= self.min_margin
+
+    def save(self, directory: str) -> None:
+        for position, matrix in enumerate(self._matrices.values()):
+            np.save(os.path.join(directory, f"category_{position}_matrix.npy"), matrix)
+        extra = {"min_similarity": self.min_similarity, "min_margin": self.min_margin,
+                 "embedder": _embedder_identity(self.embedder)}
+        if isinstance(self.embedder, HashingNgramEmbedder):
+            np.save(os.path.join(directory, "embedder_idf.npy"), self.embedder.idf)
+            extra.update(embedder_dim=self.embedder.dim, embedder_ngram_range=list(self.embedder.ngram_range))
+        _write_manifest(directory, self._rows, **extra)
+
+    @classmethod
+    def load(cls, directory: str, qa_data: Iterable[dict], embedder=None) -> "EmbeddingEngine":
+        """save で保存したインデックスを読み込みます。
+        HashingNgramEmbedder 以外の埋め込み器で作成したインデックスは、同じ埋め込み器を embedder に指定してください
+        （省略した場合や、異なる埋め込み器を指定した場合は ValueError を送出します）。
+        """
+        engine = cls.__new__(cls)
+        engine._rows = partition_by_category(qa_data)
+        manifest = _read_manifest(directory, engine._rows)
+        engine.min_similarity = manifest["min_similarity"]
+        engine.min_margin = manifest["min_margin"]
+        # 種類を記録していない旧形式のマニフェストは、HashingNgramEmbedder の設定の有無で判別する
+        saved_embedder = manifest.get("embedder", "hashing" if "embedder_dim" in manifest else "unknown")
+        if embedder is None and saved_embedder != HashingNgramEmbedder.identity:
+            raise ValueError(f"キャッシュされた埋め込み行列は埋め込み器 {saved_embedder} で作成されています。"
+                             "load の embedder に同じ埋め込み器を指定してください")
+        if embedder is not None and _embedder_identity(embedder) != saved_embedder:
+            raise ValueError(f"キャッシュされた埋め込み行列の埋め込み器（{saved_embedder}）と"
+                             f"指定された埋め込み器（{_embedder_identity(embedder)}）が一致しません")
+        if embedder is None:
+            embedder = HashingNgramEmbedder(manifest["embedder_dim"], tuple(manifest["embedder_ngram_range"]))
+            embedder.idf = np.load(os.path.join(directory, "embedder_idf.npy"))
+        engine.embedder = embedder
+        # 埋め込み行列はメモリマップで開くため、読み込み時間は行数にほぼ依存しない
+        engine._matrices = {
+            category: np.load(os.path.join(directory, f"category_{position}_matrix.npy"), mmap_mode="r")
+            for position, category in enumerate(engine._rows)
+        }
+        return engine
+
+
+# create_agent_app で名前指定できる検索エンジン
+RETRIEVAL_ENGINES = {
+    "bm25": BM25Engine,
+    "embedding": EmbeddingEngine,
+}
+
+
+def create_retrieval_engine(engine, qa_data: List[dict], cache_key: Optional[str] = None,
+                            cache: Optional[IndexCache] = None) -> RetrievalEngine:
+    """名前（"bm25" / "embedding"）またはエンジンインスタンスから検索エンジンを用意します。
+    cache_key を指定した場合、構築済みのインデックスをディスクキャッシュから読み込み、
+    キャッシュがなければ構築して保存します。
+    """
+    if isinstance(engine, RetrievalEngine):
+        return engine
+    if engine not in RETRIEVAL_ENGINES:
+        raise ValueError(f"未対応の検索エンジンです: {engine}（利用可能: {', '.join(RETRIEVAL_ENGINES)}）")
+    engine_class = RETRIEVAL_ENGINES[engine]
+    if cache_key is None:
+        return engine_class(qa_data)
+    return (cache or default_index_cache).get_or_build(
+        cache_key, f"retrieval_{engine}",
+        loader=lambda directory: engine_class.load(directory, qa_data),
+        builder=lambda: engine_class(qa_data),
+        writer=lambda built, directory: built.save(directory),
+    )
@@ -0,0 +1,275 @@
+# FAQエージェントのヘッドレスHTTPサーバー
+# Streamlit UIを使わずに、HTTP経由でエージェントに質問できます（標準ライブラリのみで動作します）。
+#
+# 使い方:
+#   python server.py --port 8000 --workers 32
+#
+# エンドポイント:
+#   GET  /corpora      利用可能なコーパスの一覧
+#   GET  /stats        コーパスごとの関連度評価バッチの統計
+#   GET  /metrics      ノード・LLM呼び出しごとの所要時間やトークン数（Prometheus / OpenMetrics テキスト形式）
+#   POST /chat         {"corpus": "cafe_support_faq", "message": "..."} → {"answer": "...", "category": "...", ...}
+#   POST /chat/stream  /chat と同じリクエストで、進捗・トークン・最終応答を Server-Sent Events で返す
+#   リクエストに "trace": true を指定すると、応答（ストリーミングでは final イベント）にリクエストのトレースを含めます。
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+
+import app
+from app import PIPELINES, create_agent_app, message_text, stream_agent_events
+from corpus_catalog import load_system_prompt
+from direct_answer import DIRECT_ANSWER_POLICIES, DIRECT_ANSWER_THRESHOLD, DirectAnswerPolicy, RephrasedAnswers
+from faq_loader import discover_faq_files
+from faq_store import load_faq_store
+from index_cache import default_index_cache
+from instrumentation import RequestTrace, default_metrics
+from llm_provider import LLMProvider
+from logging_setup import configure_logging
+from relevance_batcher import RelevanceBatcher
+
+DEFAULT_DOC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Corpus:
+    """サーバーが提供する1つのFAQコーパスと、そのコンパイル済みエージェント。"""
+    name: str
+    path: str
+    identity: str
+    categories: List[str]
+    rows: int
+    app: object
+    batcher: Optional[RelevanceBatcher] = None
+
+
+def load_corpora(doc_dir: str = DEFAULT_DOC_DIR, pipeline: str = "fast", fuse_classification: bool = False,
+                 batching: bool = True, max_batch_size: int = 8, max_wait_ms: float = 10.0,
+                 llm_provider: Optional[LLMProvider] = None,
+                 direct_answer: Optional[DirectAnswerPolicy] = None,
+                 local_classifier_threshold: Optional[float] = None) -> Dict[str, Corpus]:
+    """ディレクトリ内のFAQファイルを読み込み、コーパス名（ファイル名の拡張子を除いた部分）ごとにエージェントを作成します。"""
+    provider = llm_provider or app.default_llm_provider
+    corpora = {}
+    for file_path in discover_faq_files(doc_dir):
+        # 行データは列指向のストアとしてメモリマップで開く（複数のサーバープロセスを起動してもページキャッシュを共有する）
+        qa_data = load_faq_store(file_path)
+        if qa_data is None:
+            continue
+        categories = qa_data.categories
+        identity = qa_data.metadata.get("description", "AIアシスタント")
+        # バッチはカテゴリー名をキーにまとめるため、コーパスごとに別のインスタンスを使う
+        batcher = RelevanceBatcher(provider.chat_model("relevance"), max_batch_size, max_wait_ms,
+                                   max_candidates=app.RELEVANCE_CHUNK_SIZE) if batching else None
+        agent_app = create_agent_app(qa_data, categories, identity, load_system_prompt(doc_dir, identity),
+                                     index_cache_key=default_index_cache.key_for_source(file_path),
+                                     pipeline=pipeline, fuse_classification=fuse_classification,
+                                     relevance_batcher=batcher, llm_provider=provider, direct_answer=direct_answer,
+                                     local_classifier_threshold=local_classifier_threshold)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        corpora[name] = Corpus(name, file_path, identity, categories, len(qa_data), agent_app, batcher)
+    return corpora
+
+
+class RequestError(Exception):
+    """クライアントに4xxで返すリクエストの誤り。"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FaqRequestHandler(BaseHTTPRequestHandler):
+    server: "FaqHTTPServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == "/corpora":
+            self._send_json(200, {"corpora": [
+                {"name": corpus.name, "identity": corpus.identity, "categories": corpus.categories, "rows": corpus.rows}
+                for corpus in self.server.corpora.values()
+            ]})
+        elif self.path == "/metrics":
+            body = default_metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/stats":
+            self._send_json(200, {name: corpus.batcher.stats() if corpus.batcher else None
+                                  for name, corpus in self.server.corpora.items()})
+        else:
+            self._send_json(404, {"error": f"見つかりません: {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ("/chat", "/chat/stream"):
+            self._send_json(404, {"error": f"見つかりません: {self.path}"})
+            return
+        try:
+            corpus, message, include_trace = self._parse_chat_request()
+        except RequestError as e:
+            self._send_json(e.status, {"error": str(e)})
+            return
+
+        start = time.perf_counter()
+        inputs = {"messages": [HumanMessage(content=message)]}
+        trace = RequestTrace()
+        config = {"callbacks": [trace], "metadata": {"corpus": corpus.name}}
+        if self.path == "/chat":
+            try:
+                result = corpus.app.invoke(inputs, config)
+            except Exception as e:
+                logger.exception("/chat の処理中にエラーが発生しました: %s", e)
+                trace.finish()
+                self._send_json(500, {"error": "応答の生成中にエラーが発生しました。"})
+                return
+            payload = {"corpus": corpus.name, "answer": message_text(result["messages"][-1]),
+                       "category": result.get("predicted_category"),
+                       "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)}
+            finished_trace = trace.finish()
+            if include_trace:
+                payload["trace"] = finished_trace
+            self._send_json(200, payload)
+        else:
+            self._stream_chat(corpus, inputs, config, trace, include_trace, start)
+
+    def _parse_chat_request(self) -> tuple:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            raise RequestError(400, "リクエストボディはJSONである必要があります。")
+        if not isinstance(body, dict):
+            raise RequestError(400, "リクエストボディはJSONオブジェクトである必要があります。")
+        message = body.get("message")
+        if not isinstance(message, str) or not message.strip():
+            raise RequestError(400, "'message' を指定してください。")
+
+        corpus_name = body.get("corpus")
+        if corpus_name is None and len(self.server.corpora) == 1:
+            corpus_name = next(iter(self.server.corpora))
+        corpus = self.server.corpora.get(corpus_name)
+        if corpus is None:
+            raise RequestError(404, f"コーパスが見つかりません: {corpus_name}（利用可能: {', '.join(self.server.corpora)}）")
+        return corpus, message, bool(body.get("trace"))
+
+    def _stream_chat(self, corpus: Corpus, inputs: dict, config: dict, trace: RequestTrace, include_trace: bool,
+                     start: float) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for kind, payload in stream_agent_events(corpus.app, inputs, config):
+                if kind == "progress":
+                    self._send_event("progress", {"node": payload})
+                elif kind == "token":
+                    self._send_event("token", {"text": payload})
+                elif kind == "final":
+                    final_event = {"corpus": corpus.name, "answer": message_text(payload) if payload is not None else "",
+                                   "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)}
+                    finished_trace = trace.finish()
+                    if include_trace:
+                        final_event["trace"] = finished_trace
+                    self._send_event("final", final_event)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("クライアントがストリーミング中に切断しました")
+        except Exception as e:
+            logger.exception("/chat/stream の処理中にエラーが発生しました: %s", e)
+            self._send_event("error", {"error": "応答の生成中にエラーが発生しました。"})
+        finally:
+            trace.finish()
+
+    def _send_event(self, event: str, data: dict) -> None:
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FaqHTTPServer(HTTPServer):
+    """接続ごとにスレッドを作らず、固定サイズのワーカープールでリクエストを処理するHTTPサーバー。"""
+
+    # 同時接続が多い場合に接続がリセットされないよう、listen のバックログを既定の5から増やす
+    request_queue_size = 256
+
+    def __init__(self, address: tuple, corpora: Dict[str, Corpus], workers: int = 32, verbose: bool = False):
+        super().__init__(address, FaqRequestHandler)
+        self.corpora = corpora
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="faq-worker")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="FAQエージェントのHTTPサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--doc-dir", default=DEFAULT_DOC_DIR)
+    parser.add_argument("--workers", type=int, default=32, help="リクエストを処理するワーカースレッド数")
+    parser.add_argument("--pipeline", choices=PIPELINES, default="fast")
+    parser.add_argument("--fuse-classification", action="store_true")
+    parser.add_argument("--no-batching", action="store_true", help="関連度評価のマイクロバッチを無効にする")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="バッチの待ち合わせ時間（ミリ秒）")
+    parser.add_argument("--direct-answer", choices=DIRECT_ANSWER_POLICIES, default="off",
+                        help="関連度スコアが高い場合にLLMを呼ばずに最終応答を返すポリシー（direct_answer.py を参照）")
+    parser.add_argument("--direct-answer-threshold", type=float, default=DIRECT_ANSWER_THRESHOLD)
+    parser.add_argument("--rephrased-answers", default=None, help="rephrased ポリシーの参照表（python direct_answer.py rephrase で作成）")
+    parser.add_argument("--local-classifier-threshold", type=float, default=None,
+                        help=f"ローカル分類器で分類する確信度の下限（推奨 {app.LOCAL_CLASSIFIER_THRESHOLD}、省略時はLLMで分類）")
+    parser.add_argument("--verbose", action="store_true", help="アクセスログを出力する")
+    args = parser.parse_args()
+    configure_logging()
+
+    direct_answer = DirectAnswerPolicy(args.direct_answer, args.direct_answer_threshold,
+                                       RephrasedAnswers(args.rephrased_answers) if args.rephrased_answers else None)
+    corpora = load_corpora(args.doc_dir, args.pipeline, args.fuse_classification, not args.no_batching,
+                           args.max_batch_size, args.max_wait_ms, direct_answer=direct_answer,
+                           local_classifier_threshold=args.local_classifier_threshold)
+    server = FaqHTTPServer((args.host, args.port), corpora, args.workers, args.verbose)
+    print(f"FAQエージェントサーバーを起動しました: http://{args.host}:{server.server_port}（コーパス: {', '.join(corpora)}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
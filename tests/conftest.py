@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def cafe_corpus():
+    """doc/cafe_support_faq.py を (QAデータ, カテゴリー, アイデンティティ) で返します。"""
+    from faq_loader import load_faq_data
+
+    faq_data = load_faq_data(os.path.join(ROOT, "doc", "cafe_support_faq.py"))
+    qa_data = faq_data["data"]
+    categories = sorted({item["カテゴリー"] for item in qa_data if item.get("カテゴリー")})
+    return qa_data, categories, faq_data["metadata"].get("description", "AIアシスタント")
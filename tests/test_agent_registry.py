@@ -0,0 +1,76 @@
+import gc
+import threading
+import time
+
+from agent_registry import AgentRegistry, agent_key
+
+
+class _Builder:
+    def __init__(self):
+        self.built = []
+
+    def __call__(self):
+        app = object()
+        self.built.append(app)
+        return app
+
+
+def test_agent_key_depends_on_prompt_and_options():
+    key = agent_key("corpus", "あなたはカフェです。", pipeline="fast")
+    assert key == agent_key("corpus", "あなたはカフェです。", pipeline="fast")
+    assert key != agent_key("corpus", "あなたはカフェです。", pipeline="classic")
+    assert key != agent_key("corpus", "あなたは書店です。", pipeline="fast")
+    assert key.startswith("corpus:")
+
+
+def test_leases_share_one_app_and_count_references():
+    registry, builder = AgentRegistry(), _Builder()
+    first, second = registry.lease("a", builder), registry.lease("a", builder)
+    assert first.app is second.app and len(builder.built) == 1
+    assert registry.stats()["leases"] == 2 and registry.counters["reuses"] == 1
+
+    first.release()
+    first.release()  # 2回目の返却は無視される
+    assert registry.stats()["leases"] == 1 and registry.stats()["idle"] == 0
+    second.release()
+    assert registry.stats() == {"apps": 1, "active": 0, "idle": 1, "leases": 0,
+                                "builds": 1, "reuses": 1, "evictions": 0}
+    # アイドル状態のアプリは再利用される
+    assert registry.lease("a", builder).app is builder.built[0]
+
+
+def test_idle_apps_beyond_max_idle_are_evicted_oldest_first():
+    registry, builder = AgentRegistry(max_idle=1), _Builder()
+    active = registry.lease("active", builder)
+    for key in ("a", "b"):
+        registry.lease(key, builder).release()
+    stats = registry.stats()
+    assert stats["apps"] == 2 and stats["idle"] == 1 and stats["evictions"] == 1
+    # 破棄された a は再構築され、使用中のアプリは破棄されない
+    assert registry.lease("a", builder).app is not builder.built[1]
+    assert registry.lease("active", builder).app is active.app
+
+
+def test_garbage_collected_lease_is_released():
+    registry = AgentRegistry()
+    lease = registry.lease("a", _Builder())
+    del lease
+    gc.collect()
+    assert registry.stats()["leases"] == 0 and registry.stats()["idle"] == 1
+
+
+def test_concurrent_leases_build_once():
+    registry, builder = AgentRegistry(), _Builder()
+
+    def slow_builder():
+        time.sleep(0.05)
+        return builder()
+
+    leases = []
+    threads = [threading.Thread(target=lambda: leases.append(registry.lease("a", slow_builder))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builder.built) == 1 and {id(lease.app) for lease in leases} == {id(builder.built[0])}
+    assert registry.stats()["leases"] == 4
@@ -0,0 +1,56 @@
+from langchain_core.messages import HumanMessage
+
+import app
+from category_classifier import NearestCentroidClassifier
+from checkpoint_store import LatestInMemorySaver
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+
+
+def _agent(cafe_corpus, **options):
+    qa_data, categories, identity = cafe_corpus
+    classifier_prompts = []
+
+    def recording_responder(prompt):
+        if "利用可能なカテゴリー:" in prompt and prompt.rstrip().endswith("分類:"):
+            classifier_prompts.append(prompt)
+        return default_responder(prompt)
+
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 llm_provider=FakeProvider(model=FakeChatModel(responder=recording_responder)),
+                                 **options)
+    return agent, classifier_prompts
+
+
+def test_classifier_predicts_category_of_corpus_questions(cafe_corpus):
+    qa_data = cafe_corpus[0]
+    classifier = NearestCentroidClassifier(qa_data)
+    correct = sum(classifier.predict(row["質問"])[0] == row["カテゴリー"] for row in qa_data)
+    assert correct / len(qa_data) >= 0.8
+    category, confidence = classifier.predict(qa_data[0]["質問"])
+    assert category in classifier.categories and 0.0 < confidence <= 1.0
+
+
+def test_local_classifier_is_opt_in(cafe_corpus):
+    agent, classifier_prompts = _agent(cafe_corpus)
+    agent.invoke({"messages": [HumanMessage(content=cafe_corpus[0][0]["質問"])]})
+    assert len(classifier_prompts) == 1
+
+
+def test_confident_local_prediction_skips_llm(cafe_corpus):
+    agent, classifier_prompts = _agent(cafe_corpus, local_classifier_threshold=0.0)
+    question = cafe_corpus[0][0]["質問"]
+    result = agent.invoke({"messages": [HumanMessage(content=question)]})
+    assert classifier_prompts == []
+    assert result["predicted_category"] == NearestCentroidClassifier(cafe_corpus[0]).predict(question)[0]
+
+
+def test_follow_up_turn_is_classified_by_llm_with_context(cafe_corpus):
+    agent, classifier_prompts = _agent(cafe_corpus, local_classifier_threshold=0.0, checkpointer=LatestInMemorySaver())
+    config = {"configurable": {"thread_id": "a"}}
+    first = cafe_corpus[0][0]["質問"]
+    agent.invoke({"messages": [HumanMessage(content=first)]}, config)
+    assert classifier_prompts == []
+    agent.invoke({"messages": [HumanMessage(content="週末はどうですか？")]}, config)
+    assert len(classifier_prompts) == 1
+    assert first in classifier_prompts[0]  # 直前の会話がLLMの分類プロンプトに含まれる
@@ -0,0 +1,127 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import app
+from checkpoint_store import LatestInMemorySaver, SQLiteCheckpointSaver
+from conversation_memory import append_turn, build_summary_prompt, estimate_tokens, split_history
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+
+
+def _history(*questions):
+    history = []
+    for question in questions:
+        history = append_turn(history, question, f"{question}への回答です。")
+    return history
+
+
+def test_split_history_keeps_history_within_budget():
+    history = _history("営業時間は？", "駐車場はありますか？")
+    assert split_history(history, 1000) == (history, [])
+    assert split_history(history, None) == (history, [])
+
+
+def test_split_history_evicts_oldest_turns_to_half_the_budget():
+    history = _history("営業時間は？", "駐車場はありますか？", "予約はできますか？", "Wi-Fiは使えますか？")
+    turn_tokens = sum(estimate_tokens(message.content) for message in history[-2:])
+    kept, evicted = split_history(history, 3 * turn_tokens)
+    assert evicted and evicted + kept == history and len(kept) % 2 == 0
+    assert sum(estimate_tokens(message.content) for message in kept) <= 3 * turn_tokens // 2
+    # 予算より長い最新のターンも残す
+    kept, evicted = split_history(history, 1)
+    assert kept == history[-2:] and evicted == history[:-2]
+
+
+def test_summary_prompt_contains_evicted_turns():
+    prompt = build_summary_prompt("", _history("営業時間は？"))
+    assert "これまでの要約: （なし）" in prompt and "ユーザー: 営業時間は？" in prompt
+
+
+def _checkpointers(tmp_path):
+    return {"memory": LatestInMemorySaver(), "sqlite": SQLiteCheckpointSaver(str(tmp_path / "conversations.sqlite3"))}
+
+
+def _agent(cafe_corpus, checkpointer, model=None, **options):
+    qa_data, categories, identity = cafe_corpus
+    return app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                llm_provider=FakeProvider(model=model or FakeChatModel()), checkpointer=checkpointer,
+                                **options)
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_two_turn_conversation_is_carried_over(store, cafe_corpus, tmp_path):
+    checkpointer = _checkpointers(tmp_path)[store]
+    prompts = []
+    model = FakeChatModel(responder=lambda prompt: prompts.append(prompt) or default_responder(prompt))
+    agent = _agent(cafe_corpus, checkpointer, model)
+    config = {"configurable": {"thread_id": "t1"}}
+    first, second = cafe_corpus[0][0]["質問"], cafe_corpus[0][1]["質問"]
+
+    agent.invoke({"messages": [HumanMessage(content=first)]}, config)
+    turn_start = len(prompts)
+    result = agent.invoke({"messages": [HumanMessage(content=second)]}, config)
+
+    # 2ターン目のプロンプトには1ターン目の会話が含まれ、messages は2ターン目の分だけを保持する
+    assert any(first in prompt for prompt in prompts[turn_start:])
+    assert isinstance(result["messages"][0], HumanMessage) and result["messages"][0].content == second
+    history = agent.get_state(config).values["history"]
+    assert [message.content for message in history[::2]] == [first, second]
+    assert all(isinstance(message, AIMessage) for message in history[1::2])
+    # 別のスレッドには引き継がれない
+    assert agent.get_state({"configurable": {"thread_id": "t2"}}).values == {}
+
+
+def test_sqlite_conversation_survives_restart(cafe_corpus, tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    config = {"configurable": {"thread_id": "t1"}}
+    _agent(cafe_corpus, SQLiteCheckpointSaver(path)).invoke(
+        {"messages": [HumanMessage(content=cafe_corpus[0][0]["質問"])]}, config)
+    restarted = _agent(cafe_corpus, SQLiteCheckpointSaver(path))
+    assert restarted.get_state(config).values["history"][0].content == cafe_corpus[0][0]["質問"]
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_old_turns_are_folded_into_summary(store, cafe_corpus, tmp_path):
+    agent = _agent(cafe_corpus, _checkpointers(tmp_path)[store], history_token_budget=60)
+    config = {"configurable": {"thread_id": "t1"}}
+    questions = [row["質問"] for row in cafe_corpus[0][:4]]
+    for question in questions:
+        agent.invoke({"messages": [HumanMessage(content=question)]}, config)
+    values = agent.get_state(config).values
+    assert values["summary"].startswith(f"ユーザーが尋ねた内容: {questions[0]}")
+    assert values["history"][-2].content == questions[-1]
+    assert len(values["history"]) < 2 * len(questions)
+
+
+def test_sqlite_saver_round_trip_put_writes_and_delete_thread(cafe_corpus, tmp_path):
+    saver = SQLiteCheckpointSaver(str(tmp_path / "conversations.sqlite3"))
+    agent = _agent(cafe_corpus, saver)
+    config = {"configurable": {"thread_id": "t1"}}
+    agent.invoke({"messages": [HumanMessage(content=cafe_corpus[0][0]["質問"])]}, config)
+
+    saved = saver.get_tuple(config)
+    assert saved.checkpoint["channel_values"]["history"] == agent.get_state(config).values["history"]
+    assert list(saver.list(config)) == [saved]
+
+    # 通常のチャネルの書き込みは最初の1回だけを保存する
+    saver.put_writes(saved.config, [("summary", "最初の書き込み")], "task-1")
+    saver.put_writes(saved.config, [("summary", "重複した書き込み")], "task-1")
+    assert saver.get_tuple(config).pending_writes == [("task-1", "summary", "最初の書き込み")]
+    assert saver.stored_bytes("t1") > 0
+
+    saver.delete_thread("t1")
+    assert saver.get_tuple(config) is None
+    assert saver.stored_bytes("t1") == 0
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_delete_thread_forgets_conversation(store, cafe_corpus, tmp_path):
+    checkpointer = _checkpointers(tmp_path)[store]
+    agent = _agent(cafe_corpus, checkpointer)
+    for thread_id in ("t1", "t2"):
+        agent.invoke({"messages": [HumanMessage(content=cafe_corpus[0][0]["質問"])]},
+                     {"configurable": {"thread_id": thread_id}})
+    checkpointer.delete_thread("t1")
+    assert agent.get_state({"configurable": {"thread_id": "t1"}}).values == {}
+    assert checkpointer.stored_bytes("t1") == 0
+    assert agent.get_state({"configurable": {"thread_id": "t2"}}).values["history"]
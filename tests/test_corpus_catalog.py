@@ -0,0 +1,61 @@
+import os
+import shutil
+
+from conftest import ROOT
+from corpus_catalog import CorpusCatalog
+from index_cache import IndexCache
+
+
+def _bump_mtime(path):
+    # 同じ時刻の更新でも変更として検出できるよう、更新時刻を1秒進める
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def _catalog(tmp_path):
+    doc_dir = tmp_path / "doc"
+    doc_dir.mkdir()
+    shutil.copy(os.path.join(ROOT, "doc", "cafe_support_faq.py"), doc_dir / "cafe_support_faq.py")
+    return CorpusCatalog(str(doc_dir), IndexCache(str(tmp_path / "cache"))), str(doc_dir / "cafe_support_faq.py")
+
+
+def test_unchanged_file_is_reused_and_changed_file_is_reloaded(tmp_path, cafe_corpus):
+    catalog, path = _catalog(tmp_path)
+    first = catalog.get(path)
+    assert catalog.get(path) is first
+    assert first.categories == cafe_corpus[1] and first.identity == cafe_corpus[2]
+    assert sum(len(rows) for rows in first.question_pools.values()) == len(cafe_corpus[0])
+    assert catalog.stats() == {"hits": 1, "loads": 1, "reloads": 0, "corpora": 1}
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n# 追記\n")
+    _bump_mtime(path)
+    reloaded = catalog.get(path)
+    assert reloaded is not first and reloaded.version != first.version and reloaded.cache_key != first.cache_key
+    assert catalog.stats()["reloads"] == 1
+
+    os.remove(path)
+    assert catalog.get(path) is None
+
+
+def test_files_are_rediscovered_when_directory_changes(tmp_path):
+    catalog, path = _catalog(tmp_path)
+    assert catalog.files() == [path]
+    added = os.path.join(catalog.doc_dir, "copy_faq.py")
+    shutil.copy(path, added)
+    _bump_mtime(catalog.doc_dir)
+    assert sorted(catalog.files()) == sorted([path, added])
+
+
+def test_system_prompt_is_reloaded_when_file_changes(tmp_path):
+    catalog, _ = _catalog(tmp_path)
+    assert catalog.system_prompt("カフェの店員") == "あなたはカフェの店員です。"
+    prompt_path = os.path.join(catalog.doc_dir, "prompts", "default.txt")
+    os.makedirs(os.path.dirname(prompt_path))
+    with open(prompt_path, "w", encoding="utf-8") as f:
+        f.write("{agent_identity}として丁寧に回答してください。\n")
+    assert catalog.system_prompt("カフェの店員") == "カフェの店員として丁寧に回答してください。"
+    with open(prompt_path, "w", encoding="utf-8") as f:
+        f.write("{agent_identity}として簡潔に回答してください。\n")
+    _bump_mtime(prompt_path)
+    assert catalog.system_prompt("書店員") == "書店員として簡潔に回答してください。"
@@ -0,0 +1,53 @@
+import pytest
+from langchain_core.messages import HumanMessage, ToolMessage
+
+import app
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+
+QUESTION = "カフェインレスのコーヒーはありますか？"
+
+
+def _search(cafe_corpus, predicted_category, **options):
+    # 分類だけを predicted_category に固定し、(検索ツールの結果, 関連度評価の呼び出し回数) を返す
+    qa_data, categories, identity = cafe_corpus
+    relevance_prompts = []
+
+    def responder(prompt):
+        if "社内ドキュメントの質問リスト" in prompt:
+            relevance_prompts.append(prompt)
+        elif "利用可能なカテゴリー:" in prompt:
+            return predicted_category
+        return default_responder(prompt)
+
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 llm_provider=FakeProvider(model=FakeChatModel(responder=responder)), **options)
+    messages = agent.invoke({"messages": [HumanMessage(content=QUESTION)]})["messages"]
+    return next(message for message in messages if isinstance(message, ToolMessage)), len(relevance_prompts)
+
+
+def _row(cafe_corpus):
+    return next(row for row in cafe_corpus[0] if row["質問"] == QUESTION)
+
+
+def test_misclassified_question_is_found_in_other_category(cafe_corpus):
+    tool_message, relevance_calls = _search(cafe_corpus, "支払い")
+    assert tool_message.content == _row(cafe_corpus)["回答例"]
+    assert tool_message.artifact[0]["カテゴリー"] == "メニュー・商品"
+    assert tool_message.artifact[0]["score"] >= app.RELEVANCE_THRESHOLD
+    # 他のカテゴリーの候補は1回の呼び出しでまとめて評価する
+    assert relevance_calls == 2
+
+
+def test_fallback_can_be_disabled(cafe_corpus):
+    tool_message, relevance_calls = _search(cafe_corpus, "支払い", cross_category_fallback=False)
+    assert tool_message.content != _row(cafe_corpus)["回答例"]
+    assert {candidate["カテゴリー"] for candidate in tool_message.artifact} <= {"支払い"}
+    assert relevance_calls == 1
+
+
+@pytest.mark.parametrize("fallback", [True, False])
+def test_correct_category_needs_no_fallback(cafe_corpus, fallback):
+    tool_message, relevance_calls = _search(cafe_corpus, "メニュー・商品", cross_category_fallback=fallback)
+    assert tool_message.content == _row(cafe_corpus)["回答例"]
+    assert relevance_calls == 1
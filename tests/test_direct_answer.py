@@ -0,0 +1,65 @@
+import pytest
+from langchain_core.messages import HumanMessage
+
+import app
+import direct_answer
+from direct_answer import DIRECT_ANSWER_TEMPLATE, DirectAnswerPolicy, RephrasedAnswers, rephrase_key
+from fake_llm import FakeChatModel
+from instrumentation import MetricsRegistry
+from llm_provider import FakeProvider
+
+IDENTITY = "カフェのサポート"
+CANDIDATE = {"カテゴリー": "営業", "質問": "営業時間は？", "回答例": "9時から18時までです。", "score": 95}
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(direct_answer, "default_metrics", registry)
+    return registry
+
+
+def _policy(mode, tmp_path):
+    answers = RephrasedAnswers(str(tmp_path / "rephrased.json"))
+    answers.update({rephrase_key(IDENTITY, CANDIDATE["質問"], CANDIDATE["回答例"]): "9時から18時まで営業しております。"})
+    return DirectAnswerPolicy(mode, rephrased=answers if mode == "rephrased" else None)
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("off", None),
+    ("verbatim", CANDIDATE["回答例"]),
+    ("template", DIRECT_ANSWER_TEMPLATE.format(answer=CANDIDATE["回答例"])),
+    ("rephrased", "9時から18時まで営業しております。"),
+])
+def test_each_policy_answers_confident_match(mode, expected, tmp_path, metrics):
+    assert _policy(mode, tmp_path).answer(IDENTITY, CANDIDATE, CANDIDATE["回答例"]) == expected
+
+
+@pytest.mark.parametrize("mode", ["verbatim", "template", "rephrased"])
+def test_low_score_or_other_tool_result_falls_back_to_llm(mode, tmp_path, metrics):
+    policy = _policy(mode, tmp_path)
+    assert policy.answer(IDENTITY, {**CANDIDATE, "score": 80}, CANDIDATE["回答例"]) is None
+    assert policy.answer(IDENTITY, CANDIDATE, "申し訳ございません、お探しの情報は見つかりませんでした。") is None
+
+
+def test_rephrased_lookup_records_hit_and_miss(tmp_path, metrics):
+    policy = _policy("rephrased", tmp_path)
+    policy.answer(IDENTITY, CANDIDATE, CANDIDATE["回答例"])
+    changed = {**CANDIDATE, "回答例": "10時から18時までです。"}  # FAQの変更後、言い換えていない回答
+    assert policy.answer(IDENTITY, changed, changed["回答例"]) is None
+    rendered = metrics.render()
+    assert 'faq_rephrased_answer_lookups_total{result="hit"} 1' in rendered
+    assert 'faq_rephrased_answer_lookups_total{result="miss"} 1' in rendered
+
+
+@pytest.mark.parametrize("mode", ["off", "verbatim"])
+def test_agent_skips_final_llm_call_only_with_policy(mode, cafe_corpus, metrics):
+    qa_data, categories, identity = cafe_corpus
+    model = FakeChatModel()
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 llm_provider=FakeProvider(model=model), local_classifier_threshold=None,
+                                 direct_answer=DirectAnswerPolicy(mode, threshold=0))
+    result = agent.invoke({"messages": [HumanMessage(content=qa_data[0]["質問"])]})
+    answer = app.message_text(result["messages"][-1])
+    assert (answer == qa_data[0]["回答例"]) == (mode == "verbatim")
+    assert model.call_count == (2 if mode == "verbatim" else 3)  # 分類・関連度評価（・最終応答）
@@ -0,0 +1,43 @@
+import pytest
+
+from faq_loader import FaqFormatError, load_faq_data, load_legacy_py
+
+FAQ_LITERAL = '{"metadata": {"description": "テスト"}, "data": [{"カテゴリー": "店舗", "質問": "営業時間は？", "回答例": "9時からです。"}]}'
+
+
+def _write(tmp_path, source):
+    path = tmp_path / "faq.py"
+    path.write_text(source, encoding="utf-8")
+    return str(path)
+
+
+def test_literal_dict_is_loaded_without_executing(tmp_path):
+    marker = tmp_path / "executed"
+    path = _write(tmp_path, f"open({str(marker)!r}, 'w').close()\nFAQ_JSON = {FAQ_LITERAL}\n")
+    assert load_legacy_py(path)["data"][0]["質問"] == "営業時間は？"
+    assert not marker.exists()
+
+
+def test_non_literal_file_is_not_executed_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv("FAQ_ALLOW_PY_EXEC", raising=False)
+    marker = tmp_path / "executed"
+    path = _write(tmp_path, f"open({str(marker)!r}, 'w').close()\nFAQ_JSON = dict({FAQ_LITERAL})\n")
+    with pytest.raises(FaqFormatError):
+        load_legacy_py(path)
+    assert load_faq_data(path) is None
+    assert not marker.exists()
+
+
+def test_non_literal_file_is_executed_when_opted_in(tmp_path, monkeypatch):
+    path = _write(tmp_path, f"FAQ_JSON = dict({FAQ_LITERAL})\n")
+    assert load_legacy_py(path, allow_exec=True)["metadata"]["description"] == "テスト"
+    monkeypatch.setenv("FAQ_ALLOW_PY_EXEC", "1")
+    assert load_faq_data(path)["metadata"]["description"] == "テスト"
+
+
+def test_unevaluable_literal_is_a_format_error(tmp_path):
+    # 辞書のキーにリストを使うと ast.literal_eval は TypeError を送出する
+    path = _write(tmp_path, "FAQ_JSON = {[1]: 2}\n")
+    with pytest.raises(FaqFormatError):
+        load_legacy_py(path, allow_exec=False)
+    assert load_faq_data(path) is None
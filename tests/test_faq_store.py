@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import ROOT
+from faq_store import FaqStore, load_faq_store
+from index_cache import IndexCache
+from retrieval import BM25Engine, partition_by_category
+
+ROWS = [
+    {"カテゴリー": "営業", "質問": "営業時間は？", "回答例": "9時からです。"},
+    {"カテゴリー": "支払い", "質問": "カードは使えますか？", "回答例": "使えます。", "担当": "会計"},
+    {"カテゴリー": None, "質問": "", "回答例": "空の質問"},
+    {"質問": "カテゴリーのない質問", "回答例": ""},
+]
+
+
+def test_round_trip_through_memory_map(tmp_path):
+    store = FaqStore.from_rows(ROWS, {"description": "テスト"})
+    store.save(str(tmp_path))
+    loaded = FaqStore.load(str(tmp_path))
+
+    assert loaded.to_rows() == store.to_rows() == ROWS
+    assert loaded.metadata == {"description": "テスト"}
+    assert all(isinstance(loaded.buffers[field], np.memmap) for field in loaded.buffers)
+    assert isinstance(loaded.category_codes, np.memmap)
+    # 行のビューは辞書と同じように読める（値のない項目は KeyError / get で None）
+    row = loaded[-1]
+    assert row["質問"] == "カテゴリーのない質問" and row.get("カテゴリー") is None and "カテゴリー" not in row
+    with pytest.raises(KeyError):
+        row["カテゴリー"]
+    assert loaded[1]["担当"] == "会計" and loaded.categories == ["営業", "支払い"]
+    assert [dict(row) for row in loaded[:2]] == ROWS[:2]
+
+
+def test_partition_matches_row_dicts(cafe_corpus):
+    store = FaqStore.from_rows(cafe_corpus[0])
+    partition, expected = partition_by_category(store), partition_by_category(cafe_corpus[0])
+    assert list(partition) == list(expected)
+    assert all([dict(row) for row in partition.rows(category)] == expected.rows(category) for category in expected)
+    engine = BM25Engine(store)
+    assert engine.search("貸切の料金", "予約・貸切", 3) == BM25Engine(cafe_corpus[0]).search("貸切の料金", "予約・貸切", 3)
+
+
+def test_load_faq_store_uses_disk_cache(tmp_path):
+    source = str(tmp_path / "faq.py")
+    shutil.copy(os.path.join(ROOT, "doc", "cafe_support_faq.py"), source)
+    cache = IndexCache(str(tmp_path / "cache"))
+    built = load_faq_store(source, cache)
+    assert os.path.isdir(cache.entry_dir(cache.key_for_source(source), "faq_store"))
+    loaded = load_faq_store(source, cache)
+    assert isinstance(loaded.category_codes, np.memmap) and loaded.to_rows() == built.to_rows()
+    assert load_faq_store(str(tmp_path / "missing.py"), cache) is None
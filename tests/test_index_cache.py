@@ -0,0 +1,70 @@
+import os
+import shutil
+
+from conftest import ROOT
+from index_cache import IndexCache, corpus_cache_key
+from retrieval import BM25Engine, create_retrieval_engine
+
+
+def _write_marker(built, directory):
+    with open(os.path.join(directory, "value.txt"), "w", encoding="utf-8") as f:
+        f.write(built)
+
+
+def _read_marker(directory):
+    with open(os.path.join(directory, "value.txt"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def test_get_or_build_builds_once_then_hits(tmp_path):
+    cache = IndexCache(str(tmp_path))
+    builds = []
+
+    def builder():
+        builds.append(1)
+        return "index"
+
+    assert cache.get_or_build("key", "index", _read_marker, builder, _write_marker) == "index"
+    assert cache.get_or_build("key", "index", _read_marker, builder, _write_marker) == "index"
+    assert len(builds) == 1
+    # 別の成果物名・別のキーはミスになる
+    cache.get_or_build("key", "other", _read_marker, builder, _write_marker)
+    cache.get_or_build("other-key", "index", _read_marker, builder, _write_marker)
+    assert len(builds) == 3
+
+
+def test_broken_cache_is_discarded_and_rebuilt(tmp_path):
+    cache = IndexCache(str(tmp_path))
+    cache.get_or_build("key", "index", _read_marker, lambda: "index", _write_marker)
+    os.remove(os.path.join(cache.entry_dir("key", "index"), "value.txt"))
+    assert cache.load("key", "index", _read_marker) is None
+    assert not os.path.exists(cache.entry_dir("key", "index"))
+    assert cache.get_or_build("key", "index", _read_marker, lambda: "rebuilt", _write_marker) == "rebuilt"
+
+
+def test_changed_source_file_gets_a_new_key_and_drops_old_cache(tmp_path):
+    source = str(tmp_path / "faq.py")
+    shutil.copy(os.path.join(ROOT, "doc", "cafe_support_faq.py"), source)
+    cache = IndexCache(str(tmp_path / "cache"))
+    key = cache.key_for_source(source)
+    assert key == cache.key_for_source(source) == corpus_cache_key(source)
+    cache.get_or_build(key, "index", _read_marker, lambda: "index", _write_marker)
+
+    with open(source, "a", encoding="utf-8") as f:
+        f.write("\n# 追記\n")
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    new_key = cache.key_for_source(source)
+    assert new_key != key
+    assert not os.path.exists(os.path.join(cache.cache_dir, key))
+    assert cache.load(new_key, "index", _read_marker) is None
+
+
+def test_retrieval_engine_is_loaded_from_cache(cafe_corpus, tmp_path):
+    cache = IndexCache(str(tmp_path))
+    built = create_retrieval_engine("bm25", cafe_corpus[0], cache_key="key", cache=cache)
+    loaded = create_retrieval_engine("bm25", cafe_corpus[0], cache_key="key", cache=cache)
+    assert isinstance(loaded, BM25Engine) and loaded is not built
+    # 読み込んだインデックスの配列はメモリマップ（構築し直していない）
+    assert all(hasattr(index.doc_ids, "filename") for index in loaded._indexes.values())
+    assert loaded.search("貸切の料金", "予約・貸切", 3) == built.search("貸切の料金", "予約・貸切", 3)
@@ -0,0 +1,53 @@
+from langchain_core.messages import HumanMessage
+
+import app
+from fake_llm import FakeChatModel
+from instrumentation import LATENCY_BUCKETS, METRICS, MetricsRegistry, RequestTrace, record_cache_lookup
+from llm_provider import FakeProvider
+
+
+def test_render_outputs_openmetrics_text():
+    metrics = MetricsRegistry()
+    metrics.inc("faq_llm_prompt_tokens", {"node": "classify_category", "model": 'fake"model'}, 10)
+    metrics.inc("faq_llm_prompt_tokens", {"model": 'fake"model', "node": "classify_category"}, 5)
+    metrics.observe("faq_request_duration_seconds", None, 0.03)
+    lines = metrics.render().splitlines()
+
+    assert lines[-1] == "# EOF"
+    for name, (metric_type, _) in METRICS.items():
+        assert f"# TYPE {name} {metric_type}" in lines
+    # ラベルは名前順に並べ、引用符はエスケープする（同じラベルの組は1つの系列にまとまる）
+    assert 'faq_llm_prompt_tokens_total{model="fake\\"model",node="classify_category"} 15' in lines
+    # ヒストグラムのバケットは累積
+    buckets = [line for line in lines if line.startswith("faq_request_duration_seconds_bucket")]
+    assert len(buckets) == len(LATENCY_BUCKETS) + 1
+    assert buckets[LATENCY_BUCKETS.index(0.025)].endswith(" 0")
+    assert buckets[LATENCY_BUCKETS.index(0.05)].endswith(" 1") and buckets[-1] == 'faq_request_duration_seconds_bucket{le="+Inf"} 1'
+    assert "faq_request_duration_seconds_sum 0.030000" in lines
+    assert "faq_request_duration_seconds_count 1" in lines
+
+
+def test_request_trace_records_node_and_llm_spans(cafe_corpus):
+    qa_data, categories, identity = cafe_corpus
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 llm_provider=FakeProvider(model=FakeChatModel()))
+    metrics = MetricsRegistry()
+    trace = RequestTrace(metrics=metrics)
+    config = {"callbacks": [trace]}
+    agent.invoke({"messages": [HumanMessage(content="貸切の料金")]}, config)
+    record_cache_lookup(config, "miss")
+    finished = trace.finish()
+
+    spans = {(span["name"], span["kind"]): span for span in finished["spans"]}
+    for node in ("classify_category", "search_directly", app.STREAMED_NODE):
+        assert (node, "node") in spans
+        llm_span = spans[(f"llm:{node}", "llm")]
+        assert llm_span["attributes"]["prompt_tokens"] > 0 and llm_span["attributes"]["completion_tokens"] > 0
+    assert spans[("response_cache", "cache")]["attributes"] == {"result": "miss"}
+    assert trace.finish() is finished
+
+    rendered = metrics.render()
+    assert "faq_requests_total 1" in rendered
+    assert 'faq_response_cache_lookups_total{result="miss"} 1' in rendered
+    assert 'faq_node_duration_seconds_count{node="classify_category"} 1' in rendered
+    assert 'faq_llm_prompt_tokens_total{model="fake-chat-model",node="search_directly"}' in rendered
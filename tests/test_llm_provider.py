@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+import app
+from llm_provider import (LLM_ROLES, CassetteMissError, CassetteProvider, FakeProvider, GeminiProvider,
+                          LLMClientPool)
+from relevance_parsing import RELEVANCE_RESPONSE_SCHEMA
+
+
+def _answers(cafe_corpus, provider, questions, pipeline="classic"):
+    qa_data, categories, identity = cafe_corpus
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline=pipeline,
+                                 local_classifier_threshold=None, llm_provider=provider)
+    return [[message.content for message in agent.invoke({"messages": [HumanMessage(content=question)]})["messages"]]
+            for question in questions]
+
+
+def _questions(cafe_corpus):
+    return [row["質問"] for row in cafe_corpus[0][:4]] + ["量子コンピューターについて教えてください"]
+
+
+def test_fake_provider_is_deterministic(cafe_corpus):
+    questions = _questions(cafe_corpus)
+    assert _answers(cafe_corpus, FakeProvider(), questions) == _answers(cafe_corpus, FakeProvider(), questions)
+
+
+def test_cassette_replays_recorded_run(cafe_corpus, tmp_path):
+    path = str(tmp_path / "cassette.json")
+    questions = _questions(cafe_corpus)
+    inner = FakeProvider()
+    recorded = _answers(cafe_corpus, CassetteProvider(path, inner=inner, mode="record"), questions)
+    recorded_calls = inner.model.call_count
+
+    replayed = _answers(cafe_corpus, CassetteProvider(path, mode="replay"), questions)
+    assert replayed == recorded
+    assert inner.model.call_count == recorded_calls
+
+    # auto モードでは記録済みのリクエストに下位のプロバイダーを呼ばない
+    assert _answers(cafe_corpus, CassetteProvider(path, inner=inner, mode="auto"), questions) == recorded
+    assert inner.model.call_count == recorded_calls
+
+
+def test_cassette_replay_miss_raises(tmp_path):
+    model = CassetteProvider(str(tmp_path / "empty.json"), mode="replay").chat_model("classifier")
+    with pytest.raises(CassetteMissError):
+        model.invoke("記録されていないプロンプト")
+
+
+def _stub_pool():
+    pytest.importorskip("langchain_google_genai")
+    # 接続しないスタブのエンドポイントとAPIキー（モデルの作成だけを確認し、呼び出しは行わない）
+    return LLMClientPool(base_url="http://127.0.0.1:9", google_api_key="test-key")
+
+
+def test_client_pool_reuses_models_and_http_client():
+    pool = _stub_pool()
+    model = pool.get("gemini-1.5-flash", 0.0)
+    assert pool.get("gemini-1.5-flash", 0.0) is model
+    warm = pool.get("gemini-1.5-flash", 0.2)
+    assert warm is not model and warm.client is model.client
+    stats = pool.stats()
+    assert (stats["lookups"], stats["created"], stats["reused"]) == (3, 2, 1)
+    assert (stats["models"], stats["http_clients"]) == (2, 1)
+
+
+def test_client_pool_is_shared_across_providers_and_threads():
+    pool = _stub_pool()
+    first, second = GeminiProvider(pool=pool), GeminiProvider(pool=pool)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        models = list(executor.map(lambda role: first.chat_model(role), ["relevance", "classifier", "summary"] * 8))
+    assert all(model is models[0] for model in models)
+    assert second.chat_model("response") is first.chat_model("response")
+    assert second.json_model("relevance", RELEVANCE_RESPONSE_SCHEMA).bound is models[0]
+    assert pool.stats()["created"] == len(set(LLM_ROLES.values()))
@@ -0,0 +1,25 @@
+import logging
+import queue
+
+from logging_setup import DeferredQueueHandler
+
+
+def _enqueue(*args, msg="状態: %s"):
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.handle(logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, None))
+    return log_queue.get_nowait()
+
+
+def test_mutable_args_are_snapshotted_before_enqueue():
+    state = {"messages": ["営業時間は？"]}
+    record = _enqueue(state)
+    state["messages"].append("変更後")
+    assert record.getMessage() == "状態: {'messages': ['営業時間は？']}"
+    assert record.args is None
+
+
+def test_immutable_args_are_formatted_by_the_listener():
+    record = _enqueue("カテゴリー", 3, msg="分類結果: %s (%d件)")
+    assert record.args == ("カテゴリー", 3)
+    assert record.getMessage() == "分類結果: カテゴリー (3件)"
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage, ToolMessage
+
+import app
+from fake_llm import FakeChatModel
+from llm_provider import FakeProvider
+
+QUESTIONS = ["アプリのクーポンが出ない", "貸切の料金", "ラーメンはありますか"]
+
+
+def _agent(cafe_corpus, model, **options):
+    qa_data, categories, identity = cafe_corpus
+    return app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。",
+                                llm_provider=FakeProvider(model=model), **options)
+
+
+def _run(cafe_corpus, **options):
+    # 質問ごとの (検索ツールの結果, 最終応答, LLM呼び出し回数) を返す
+    model = FakeChatModel()
+    agent = _agent(cafe_corpus, model, **options)
+    runs = []
+    for question in QUESTIONS:
+        calls = model.call_count
+        messages = agent.invoke({"messages": [HumanMessage(content=question)]})["messages"]
+        tool_message = next(message for message in messages if isinstance(message, ToolMessage))
+        runs.append((tool_message.content, app.message_text(messages[-1]), model.call_count - calls))
+    return runs
+
+
+def test_fast_pipeline_answers_like_classic_without_tool_selection_call(cafe_corpus):
+    classic, fast = _run(cafe_corpus, pipeline="classic"), _run(cafe_corpus, pipeline="fast")
+    assert [run[:2] for run in fast] == [run[:2] for run in classic]
+    assert [run[2] for run in fast] == [run[2] - 1 for run in classic]
+
+
+def test_fused_classification_saves_one_more_call(cafe_corpus):
+    fast, fused = _run(cafe_corpus, pipeline="fast"), _run(cafe_corpus, pipeline="fast", fuse_classification=True)
+    assert [run[:2] for run in fused] == [run[:2] for run in fast]
+    # 予測カテゴリーで見つかった質問は、分類と関連度評価を1回の呼び出しで行う
+    assert fused[0][2] == fast[0][2] - 1 == 2
+
+
+def test_unknown_pipeline_is_rejected(cafe_corpus):
+    with pytest.raises(ValueError, match="未対応のパイプライン"):
+        _agent(cafe_corpus, FakeChatModel(), pipeline="turbo")
+
+
+@pytest.mark.parametrize("pipeline", ["classic", "fast"])
+def test_async_graph_answers_like_sync_graph(pipeline, cafe_corpus):
+    sync_agent = _agent(cafe_corpus, FakeChatModel(), pipeline=pipeline)
+    async_agent = _agent(cafe_corpus, FakeChatModel(), pipeline=pipeline, async_nodes=True, prefetch_categories=0)
+
+    async def ask_all():
+        return await asyncio.gather(*(app.ainvoke_agent(async_agent, question) for question in QUESTIONS))
+
+    expected = [app.message_text(sync_agent.invoke({"messages": [HumanMessage(content=question)]})["messages"][-1])
+                for question in QUESTIONS]
+    assert asyncio.run(ask_all()) == expected
+
+
+def test_async_graph_runs_conversations_concurrently(cafe_corpus):
+    latency = 0.05
+    agent = _agent(cafe_corpus, FakeChatModel(latency=latency), pipeline="fast", async_nodes=True,
+                   prefetch_categories=0)
+
+    async def ask_all():
+        return await asyncio.gather(*(app.ainvoke_agent(agent, question) for question in QUESTIONS * 3))
+
+    started = time.perf_counter()
+    answers = asyncio.run(ask_all())
+    elapsed = time.perf_counter() - started
+    assert len(answers) == 3 * len(QUESTIONS)
+    # 1問あたり3回以上のLLM呼び出しを、9問分順番に待つよりも十分に短い時間で終わる
+    assert elapsed < 3 * latency * len(answers) / 2
+
+
+def test_prefetch_keeps_answers_unchanged(cafe_corpus):
+    plain = _agent(cafe_corpus, FakeChatModel(), pipeline="fast", async_nodes=True, prefetch_categories=0)
+    prefetching = _agent(cafe_corpus, FakeChatModel(), pipeline="fast", async_nodes=True, prefetch_categories=2)
+
+    async def ask_all(agent):
+        return [await app.ainvoke_agent(agent, question) for question in QUESTIONS]
+
+    assert asyncio.run(ask_all(prefetching)) == asyncio.run(ask_all(plain))
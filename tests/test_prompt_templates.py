@@ -0,0 +1,70 @@
+import os
+
+from langchain_core.messages import HumanMessage
+
+import app
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+from prompt_templates import RELEVANCE_INSTRUCTIONS, CorpusPrompts
+
+QUERIES = ["営業時間を教えてください", "Wi-Fiは使えますか"]
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a.encode("utf-8"), b.encode("utf-8")]))
+
+
+def _corpus_prompts(cafe_corpus) -> CorpusPrompts:
+    qa_data, categories, identity = cafe_corpus
+    category = categories[0]
+    rows = [row for row in qa_data if row.get("カテゴリー") == category]
+    return CorpusPrompts(f"あなたは{identity}です。", identity, categories, {category: app.format_qa_block(rows)})
+
+
+def test_static_prefix_is_identical_across_queries(cafe_corpus):
+    prompts = _corpus_prompts(cafe_corpus)
+    category = cafe_corpus[1][0]
+    qa_block = app.format_qa_block(cafe_corpus[0][:3])
+    rendered = {
+        prompts.classifier: [prompts.classifier.render(conversation="", question=query) for query in QUERIES],
+        prompts.relevance: [prompts.relevance.render(category=category, qa_block=qa_block, query=query) for query in QUERIES],
+        prompts.category_relevance[category]: [prompts.category_relevance[category].render(query=query) for query in QUERIES],
+        prompts.answer: [prompts.answer.render(conversation="", query=query, tool_result="回答") for query in QUERIES],
+    }
+    for template, (first, second) in rendered.items():
+        prefix = template.prefix.encode("utf-8")
+        assert first.encode("utf-8").startswith(prefix) and second.encode("utf-8").startswith(prefix), template.name
+        assert _common_prefix_length(first, second) >= len(prefix), template.name
+
+
+def test_prefix_is_stable_across_builds(cafe_corpus):
+    first, second = _corpus_prompts(cafe_corpus), _corpus_prompts(cafe_corpus)
+    assert [(template.key, template.prefix) for template in first.templates()] == \
+           [(template.key, template.prefix) for template in second.templates()]
+
+
+def test_agent_prompts_start_with_registered_prefix(cafe_corpus):
+    qa_data, categories, identity = cafe_corpus
+    sent = []
+
+    def recording_responder(prompt):
+        sent.append(prompt)
+        return default_responder(prompt)
+
+    provider = FakeProvider(model=FakeChatModel(responder=recording_responder, prompt_prefixes={}))
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 local_classifier_threshold=None, llm_provider=provider)
+    prefixes = provider.model.prompt_prefixes
+    used = {}
+    for query in QUERIES:
+        sent.clear()
+        agent.invoke({"messages": [HumanMessage(content=query)]})
+        for prompt in sent:
+            key = max((key for key, prefix in prefixes.items() if prompt.startswith(prefix)),
+                      key=lambda key: len(prefixes[key]), default=None)
+            assert key is not None, prompt[:80]
+            used.setdefault(key, []).append(prompt)
+    # 分類・関連度評価・最終応答のプロンプトが、2つの質問で同じプレフィックスで始まる
+    templates = CorpusPrompts(f"あなたは{identity}です。", identity, categories)
+    assert len(used[templates.classifier.key]) == len(used[templates.answer.key]) == 2
+    assert sum(len(prompts) for key, prompts in used.items() if prefixes[key].startswith(RELEVANCE_INSTRUCTIONS)) >= 2
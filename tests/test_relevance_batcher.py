@@ -0,0 +1,46 @@
+import json
+
+from fake_llm import FakeChatModel, default_responder
+from relevance_batcher import RelevanceBatcher, _ScoringRequest, _group_requests
+
+
+def _rows(start, count):
+    return [{"質問": f"質問{number}", "回答例": f"回答{number}"} for number in range(start, start + count)]
+
+
+def _request(query, rows):
+    qa_block = "\n".join(f"QA_PAIR_{idx+1}: 質問: {row['質問']}" for idx, row in enumerate(rows))
+    return _ScoringRequest(query, rows, f'社内ドキュメントの質問リスト\n{qa_block}\nユーザーの質問: "{query}"\n')
+
+
+def test_group_requests_caps_merged_candidates():
+    shared = _rows(0, 6)
+    batch = [_request("a", shared), _request("b", shared[:4] + _rows(6, 2)), _request("c", _rows(8, 6))]
+    groups = _group_requests(batch, max_candidates=10)
+    assert [[request.query for request in requests] for requests, _ in groups] == [["a", "b"], ["c"]]
+    assert all(len(rows) <= 10 for _, rows in groups)
+    assert [row["質問"] for row in groups[0][1]] == [f"質問{number}" for number in range(8)]
+
+
+def test_group_requests_keeps_oversized_request_alone():
+    batch = [_request("a", _rows(0, 3)), _request("b", _rows(3, 12)), _request("c", _rows(15, 3))]
+    groups = _group_requests(batch, max_candidates=10)
+    assert [len(requests) for requests, _ in groups] == [1, 1, 1]
+
+
+def test_batcher_splits_batch_over_candidate_cap():
+    prompts = []
+
+    def recording_responder(prompt):
+        prompts.append(prompt)
+        return default_responder(prompt)
+
+    batcher = RelevanceBatcher(FakeChatModel(responder=recording_responder), max_candidates=10)
+    batch = [_request("質問1", _rows(0, 6)), _request("質問7", _rows(6, 3)), _request("質問12", _rows(9, 6))]
+    batcher._run("カテゴリー", batch)
+    assert batcher.counters["llm_calls"] == 2
+    assert len(prompts) == 2 and all(prompt.count("QA_PAIR_") <= 10 for prompt in prompts)
+    results = [request.future.result() for request in batch]
+    assert [len(rows) for _, rows in results] == [9, 9, 6]
+    assert json.loads(results[1][0])["index"] == 8
+    assert results[2][1] is batch[2].candidate_rows
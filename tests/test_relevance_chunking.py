@@ -0,0 +1,57 @@
+import asyncio
+import json
+import re
+
+import pytest
+from langchain_core.messages import HumanMessage, ToolMessage
+
+import app
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+
+
+def test_merge_chunk_evaluations_renumbers_best_chunk():
+    responses = ['{"index": 2, "score": 60}', '```json\n{"index": 1, "score": 90}\n```', '{"index": 3, "score": 75}']
+    assert json.loads(app.merge_chunk_evaluations(responses, 5)) == {"index": 6, "score": 90}
+
+
+def test_merge_chunk_evaluations_skips_failed_chunks():
+    responses = [RuntimeError("timeout"), "読み取れない応答", '{"index": 2, "score": 80}']
+    assert json.loads(app.merge_chunk_evaluations(responses, 4)) == {"index": 10, "score": 80}
+    # すべて読み取れない場合は最初の応答を、すべて例外の場合は最初の例外を返す
+    assert app.merge_chunk_evaluations([RuntimeError("timeout"), "読み取れない応答"], 4) == "読み取れない応答"
+    with pytest.raises(RuntimeError, match="first"):
+        app.merge_chunk_evaluations([RuntimeError("first"), RuntimeError("second")], 4)
+
+
+def _search(cafe_corpus, **options):
+    # 分類を「店舗・サービス」（9件）に固定し、(検索ツールの結果, 関連度評価のプロンプトの候補番号のリスト) を返す
+    qa_data, categories, identity = cafe_corpus
+    relevance_prompts = []
+
+    def responder(prompt):
+        if "社内ドキュメントの質問リスト" in prompt:
+            relevance_prompts.append(re.findall(r"QA_PAIR_(\d+): 質問", prompt))
+        elif "利用可能なカテゴリー:" in prompt:
+            return "店舗・サービス"
+        return default_responder(prompt)
+
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 cross_category_fallback=False,
+                                 llm_provider=FakeProvider(model=FakeChatModel(responder=responder)), **options)
+    inputs = {"messages": [HumanMessage(content="駐車場はありますか？")]}
+    result = asyncio.run(agent.ainvoke(inputs)) if options.get("async_nodes") else agent.invoke(inputs)
+    return next(message for message in result["messages"] if isinstance(message, ToolMessage)), relevance_prompts
+
+
+@pytest.mark.parametrize("async_nodes", [False, True])
+def test_chunked_scoring_matches_single_call(cafe_corpus, async_nodes):
+    # 非同期のグラフでは、カテゴリーの先行評価（prefetch_categories）の呼び出しを除いて比べる
+    options = {"async_nodes": True, "prefetch_categories": 0} if async_nodes else {}
+    single, single_prompts = _search(cafe_corpus, **options)
+    chunked, chunked_prompts = _search(cafe_corpus, relevance_chunk_size=3, relevance_parallelism=2, **options)
+    assert single_prompts == [[str(index) for index in range(1, 10)]]
+    assert chunked_prompts == [["1", "2", "3"]] * 3
+    assert chunked.content == single.content == next(row["回答例"] for row in cafe_corpus[0]
+                                                      if row["質問"] == "駐車場はありますか？")
+    assert chunked.artifact == single.artifact
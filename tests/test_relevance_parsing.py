@@ -0,0 +1,57 @@
+import json
+
+from langchain_core.messages import HumanMessage
+
+import app
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+from relevance_batcher import split_batch_response
+from relevance_parsing import parse_fused_response, parse_relevance_response
+
+
+def test_parse_fused_response_reads_category_index_and_score():
+    result, outcome = parse_fused_response('```json\n{"category": "メニュー", "index": 3, "score": 85}\n```')
+    assert outcome == "parsed"
+    assert result == {"category": "メニュー", "index": 3, "score": 85}
+
+
+def test_parse_fused_response_salvages_truncated_response():
+    result, outcome = parse_fused_response('{"category": "メニュー", "index": 3, "score": 85, "reas')
+    assert outcome == "salvaged"
+    assert result == {"category": "メニュー", "index": 3, "score": 85}
+
+
+def test_split_batch_response_keeps_complete_results_of_truncated_response():
+    response = '{"results": [{"query": 1, "index": 2, "score": 90}, {"query": 2, "index": 5, "score": 40}, {"query": 3, "ind'
+    first, second, third = split_batch_response(response, 3)
+    assert json.loads(first) == {"index": 2, "score": 90}
+    assert json.loads(second) == {"index": 5, "score": 40}
+    assert parse_relevance_response(third)[1] == "failed"
+
+
+def test_split_batch_response_reads_legacy_keys():
+    response = json.dumps({"results": [{"query": 2, "most_relevant_index": 1, "max_score": 70}]})
+    first, second = split_batch_response(response, 2)
+    assert parse_relevance_response(first)[1] == "failed"
+    assert json.loads(second) == {"index": 1, "score": 70}
+
+
+def test_fused_pipeline_retries_unreadable_response(cafe_corpus):
+    qa_data, categories, identity = cafe_corpus
+    calls = {"fused": 0}
+
+    def flaky_fused(prompt):
+        if "分類と関連度評価" in prompt:
+            calls["fused"] += 1
+            if calls["fused"] == 1:
+                return "評価できませんでした"
+        return default_responder(prompt)
+
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 fuse_classification=True, local_classifier_threshold=None,
+                                 llm_provider=FakeProvider(model=FakeChatModel(responder=flaky_fused)))
+    result = agent.invoke({"messages": [HumanMessage(content=qa_data[0]["質問"])]})
+    tool_message = result["messages"][-2]
+    assert calls["fused"] == 2
+    assert tool_message.content == qa_data[0]["回答例"]
+    assert result["predicted_category"] == qa_data[0]["カテゴリー"]
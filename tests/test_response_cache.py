@@ -0,0 +1,100 @@
+import numpy as np
+from langchain_core.messages import HumanMessage
+
+import app
+from checkpoint_store import LatestInMemorySaver
+from fake_llm import FakeChatModel, default_responder
+from instrumentation import RequestTrace
+from llm_provider import FakeProvider
+import response_cache
+from response_cache import CacheEntry, CachedAgentApp, InMemoryCacheBackend, ResponseCache, answered_from_faq
+
+
+def _cached_app(cafe_corpus, cache):
+    qa_data, categories, identity = cafe_corpus
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", llm_provider=FakeProvider(),
+                                 checkpointer=LatestInMemorySaver())
+    return CachedAgentApp(agent, cache, "cafe")
+
+
+def _ask(cached_app, thread_id, question):
+    trace = RequestTrace(metrics=None)
+    config = {"callbacks": [trace], "configurable": {"thread_id": thread_id}}
+    result = cached_app.invoke({"messages": [HumanMessage(content=question)]}, config)
+    lookups = [span.attributes["result"] for span in trace.spans if span.name == "response_cache"]
+    return result["messages"][-1].content, lookups
+
+
+def test_first_turn_is_served_from_cache(cafe_corpus):
+    cached_app = _cached_app(cafe_corpus, ResponseCache())
+    question = cafe_corpus[0][0]["質問"]
+    answer, lookups = _ask(cached_app, "a", question)
+    assert lookups == ["miss"]
+    cached_answer, lookups = _ask(cached_app, "b", question)
+    assert lookups == ["exact"]
+    assert cached_answer == answer
+
+
+def test_follow_up_turn_is_not_served_from_cache(cafe_corpus):
+    cache = ResponseCache()
+    cached_app = _cached_app(cafe_corpus, cache)
+    qa_data = cafe_corpus[0]
+    first, follow_up = qa_data[0]["質問"], qa_data[1]["質問"]
+    _ask(cached_app, "a", follow_up)
+    stores = cache.counters["stores"]
+
+    _ask(cached_app, "b", first)
+    _, lookups = _ask(cached_app, "b", follow_up)
+    assert lookups == ["bypass"]
+    assert cache.counters["stores"] == stores + 1 # 1ターン目だけを保存し、文脈のあるターンは保存しない
+    history = cached_app.get_state({"configurable": {"thread_id": "b"}}).values["history"]
+    assert [message.content for message in history if isinstance(message, HumanMessage)] == [first, follow_up]
+
+
+def _unreadable_relevance(prompt):
+    if "社内ドキュメントの質問リスト" in prompt:
+        return "評価できませんでした"
+    return default_responder(prompt)
+
+
+def test_failed_turn_is_not_cached(cafe_corpus):
+    qa_data, categories, identity = cafe_corpus
+    cache = ResponseCache()
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。",
+                                 llm_provider=FakeProvider(model=FakeChatModel(responder=_unreadable_relevance)),
+                                 local_classifier_threshold=None, cross_category_fallback=False,
+                                 relevance_parse_retries=0)
+    result = CachedAgentApp(agent, cache, "cafe").invoke({"messages": [HumanMessage(content=qa_data[0]["質問"])]})
+    assert not answered_from_faq(result["messages"])
+    assert cache.counters["stores"] == 0
+
+
+def test_not_found_answer_is_not_cached(cafe_corpus):
+    cache = ResponseCache()
+    cached_app = _cached_app(cafe_corpus, cache)
+    answer, _ = _ask(cached_app, "a", "量子コンピューターの量子ビットは何個ありますか")
+    assert "見つかりませんでした" in answer
+    assert cache.counters["stores"] == 0
+
+
+def test_stream_stores_only_faq_answers(cafe_corpus):
+    cache = ResponseCache()
+    cached_app = _cached_app(cafe_corpus, cache)
+    for thread_id, question in [("a", "量子コンピューターの量子ビットは何個ありますか"), ("b", cafe_corpus[0][0]["質問"])]:
+        config = {"configurable": {"thread_id": thread_id}}
+        list(cached_app.stream({"messages": [HumanMessage(content=question)]}, config, stream_mode=["messages", "updates"]))
+    assert cache.counters["stores"] == 1
+    assert cache.lookup("cafe", cafe_corpus[0][0]["質問"]) is not None
+
+
+def test_similarity_tier_respects_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    backend = InMemoryCacheBackend(ttl_seconds=60)
+    vector = np.array([1.0, 0.0], dtype=np.float32)
+    backend.put("cafe", CacheEntry("a", "営業時間は？", "9時からです。", vector, created_at=now[0]))
+    entry, score = backend.most_similar("cafe", vector)  # ここで類似検索用の行列が作られる
+    assert entry.answer == "9時からです。" and score > 0.99
+    now[0] += 61
+    assert backend.most_similar("cafe", vector) == (None, 0.0)
+    assert len(backend) == 0
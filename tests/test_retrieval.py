@@ -0,0 +1,128 @@
+import copy
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from langchain_core.messages import HumanMessage
+
+import app
+from conftest import ROOT
+from fake_llm import FakeChatModel, default_responder
+from llm_provider import FakeProvider
+from retrieval import BM25Engine, EmbeddingEngine, HashingNgramEmbedder, LangChainEmbedder, partition_by_category
+
+
+def test_partition_by_category_does_not_modify_rows():
+    qa_data = [{"カテゴリー": "".join(["メ", "ニュー"]), "質問": "おすすめは？", "回答例": "ブレンドです。"},
+               {"カテゴリー": "".join(["メ", "ニュー"]), "質問": "辛いものは？", "回答例": "カレーです。"},
+               {"カテゴリー": "店舗", "質問": "", "回答例": "質問のない行"}]
+    categories_before = [row["カテゴリー"] for row in qa_data]
+    snapshot = copy.deepcopy(qa_data)
+
+    partition = partition_by_category(qa_data)
+
+    assert qa_data == snapshot
+    assert all(row["カテゴリー"] is before for row, before in zip(qa_data, categories_before))
+    assert list(partition) == ["メニュー"]
+    assert partition["メニュー"] == qa_data[:2]
+    assert partition.row_ids["メニュー"].tolist() == [0, 1]
+
+
+def test_hashing_embedder_is_normalized_and_deterministic_across_processes():
+    texts = ["営業時間を教えてください", "Ｗｉ－Ｆｉは使えますか", ""]
+    matrix = HashingNgramEmbedder(dim=256).embed(texts)
+    assert matrix.shape == (3, 256) and matrix.dtype == np.float32
+    assert np.allclose(np.linalg.norm(matrix[:2], axis=1), 1.0)
+    assert not matrix[2].any()
+    # hash() のソルトに依存しないこと（別プロセスでも同じベクトルになる）
+    script = ("import sys; sys.path.insert(0, sys.argv[1]); from retrieval import HashingNgramEmbedder; "
+              f"sys.stdout.write(HashingNgramEmbedder(dim=256).embed({texts!r}).tobytes().hex())")
+    output = subprocess.run([sys.executable, "-c", script, ROOT], capture_output=True, text=True, check=True,
+                            env={**os.environ, "PYTHONHASHSEED": "random"}).stdout
+    assert bytes.fromhex(output) == matrix.tobytes()
+
+
+def test_embedding_engine_finds_each_question_offline(cafe_corpus, tmp_path):
+    qa_data = cafe_corpus[0]
+    engine = EmbeddingEngine(qa_data)
+    for category in engine._rows:
+        for position, row in enumerate(engine.rows(category)):
+            hits = engine.search(row["質問"], category, 3)
+            assert hits[0][0] == position and hits[0][1] == pytest.approx(1.0, abs=1e-5)
+
+    engine.save(str(tmp_path))
+    loaded = EmbeddingEngine.load(str(tmp_path), qa_data)
+    query, category = "おすすめのメニューはありますか", next(iter(engine._rows))
+    assert loaded.search(query, category, 5) == engine.search(query, category, 5)
+
+
+class _HashingEmbeddings:
+    # LangChainの Embeddings の代わり（embed_documents だけを持つ）
+    model = "hashing-test"
+
+    def embed_documents(self, texts):
+        return HashingNgramEmbedder(dim=64).embed(texts).tolist()
+
+
+def test_embedding_engine_load_requires_the_same_embedder(cafe_corpus, tmp_path):
+    qa_data = cafe_corpus[0]
+    embedder = LangChainEmbedder(_HashingEmbeddings())
+    EmbeddingEngine(qa_data, embedder=embedder).save(str(tmp_path))
+
+    with pytest.raises(ValueError, match="langchain:_HashingEmbeddings:hashing-test"):
+        EmbeddingEngine.load(str(tmp_path), qa_data)
+    with pytest.raises(ValueError, match="一致しません"):
+        EmbeddingEngine.load(str(tmp_path), qa_data, embedder=HashingNgramEmbedder())
+    loaded = EmbeddingEngine.load(str(tmp_path), qa_data, embedder=embedder)
+    category = next(iter(loaded._rows))
+    assert loaded.search(loaded.rows(category)[0]["質問"], category, 1)[0][0] == 0
+
+
+@pytest.mark.parametrize("query, category, expected", [
+    ("営業時間は何時から？", "店舗・サービス", [0]),
+    ("貸切の料金", "予約・貸切", [2, 1]),
+    ("カフェインの入っていないコーヒー", "メニュー・商品", [6, 5, 2]),
+    ("アプリのクーポンが出ない", "モバイルオーダー・アプリ", [2, 3, 4]),
+    ("ラーメン", "店舗・サービス", []),
+])
+def test_bm25_shortlist_returns_expected_faq(cafe_corpus, query, category, expected):
+    engine = BM25Engine(cafe_corpus[0])
+    hits = engine.search(query, category, 3)
+    # 同点の候補の順序は決まっていないため、最上位以外は集合で比べる
+    assert [position for position, _ in hits[:1]] == expected[:1]
+    assert {position for position, _ in hits} == set(expected)
+    assert all(first[1] >= second[1] > 0 for first, second in zip(hits, hits[1:]))
+
+
+def test_bm25_finds_each_question_and_survives_cache(cafe_corpus, tmp_path):
+    engine = BM25Engine(cafe_corpus[0])
+    for category in engine._rows:
+        for position, row in enumerate(engine.rows(category)):
+            assert engine.search(row["質問"], category, 5)[0][0] == position
+    exact, paraphrase = "カフェインレスのコーヒーはありますか？", "カフェインの入っていないコーヒー"
+    assert engine.is_decisive(exact, "メニュー・商品", engine.search(exact, "メニュー・商品", 5))
+    assert not engine.is_decisive(paraphrase, "メニュー・商品", engine.search(paraphrase, "メニュー・商品", 5))
+
+    engine.save(str(tmp_path))
+    loaded = BM25Engine.load(str(tmp_path), cafe_corpus[0])
+    assert loaded.search("貸切の料金", "予約・貸切", 3) == engine.search("貸切の料金", "予約・貸切", 3)
+
+
+def test_agent_sends_only_the_shortlist_to_the_llm(cafe_corpus):
+    qa_data, categories, identity = cafe_corpus
+    relevance_prompts = []
+
+    def recording_responder(prompt):
+        if "社内ドキュメントの質問リスト" in prompt:
+            relevance_prompts.append(prompt)
+        return default_responder(prompt)
+
+    agent = app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。", pipeline="fast",
+                                 lexical_top_k=1, llm_provider=FakeProvider(model=FakeChatModel(responder=recording_responder)))
+    agent.invoke({"messages": [HumanMessage(content="アプリのクーポンが出ない")]})
+    # 最初の評価（予測カテゴリー内）には、検索スコア上位 lexical_top_k 件の候補だけを渡す
+    assert re.findall(r"QA_PAIR_\d+: 質問: (.*)", relevance_prompts[0]) == [
+        "アプリのクーポンが表示されません。"]
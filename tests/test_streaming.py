@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import app
+from fake_llm import FakeChatModel
+from llm_provider import FakeProvider
+
+
+def _agent(cafe_corpus, **options):
+    qa_data, categories, identity = cafe_corpus
+    return app.create_agent_app(qa_data, categories, identity, f"あなたは{identity}です。",
+                                llm_provider=FakeProvider(model=FakeChatModel(stream_chunk_size=4)), **options)
+
+
+def _check_events(events):
+    kinds = [kind for kind, _ in events]
+    tokens = [value for kind, value in events if kind == "token"]
+    final = events[-1][1]
+    # 最終応答だけがトークン単位で届き、連結すると最終応答のメッセージになる
+    assert kinds[-1] == "final" and kinds.count("final") == 1 and isinstance(final, AIMessage)
+    assert len(tokens) > 1 and "".join(tokens) == app.message_text(final)
+    assert ("progress", app.STREAMED_NODE) in events
+    assert kinds.index("token") > kinds.index("progress")
+    return final
+
+
+@pytest.mark.parametrize("pipeline", ["classic", "fast"])
+def test_stream_agent_events_streams_final_answer_tokens(pipeline, cafe_corpus):
+    agent = _agent(cafe_corpus, pipeline=pipeline)
+    question = {"messages": [HumanMessage(content="貸切の料金")]}
+    final = _check_events(list(app.stream_agent_events(agent, question)))
+    assert app.message_text(final) == app.message_text(agent.invoke(question)["messages"][-1])
+
+
+def test_astream_agent_events_streams_final_answer_tokens(cafe_corpus):
+    agent = _agent(cafe_corpus, pipeline="fast", async_nodes=True)
+
+    async def collect():
+        return [event async for event in app.astream_agent_events(agent, {"messages": [HumanMessage(content="貸切の料金")]})]
+
+    final = _check_events(asyncio.run(collect()))
+    assert "貸切" in app.message_text(final)
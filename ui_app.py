@@ -1,10 +1,11 @@
 import streamlit as st
 import sys
 import os
-import glob # ファイルリスト取得用
 import random # ランダム選択用
-import streamlit.components.v1 as components # HTML埋め込み用
-import json # クリップボードコピー用
+import time # 応答時間の計測用
+import uuid # 会話（チェックポインターのスレッド）のID用
+import altair as alt # 処理時間のウォーターフォール表示用
+import pandas as pd
 
 # st.set_page_config() はStreamlitコマンドの最初に配置する必要があります。
 st.set_page_config(page_title="カスタマーサポートAIデモ")
@@ -12,49 +13,165 @@ st.set_page_config(page_title="カスタマーサポートAIデモ")
 # app.pyからデータをロードする関数とエージェント作成関数をインポートします
 # プロジェクトのディレクトリ構造に合わせてimportパスを調整してください。
 try:
-    from app import load_faq_data_from_py, create_agent_app
+    from app import create_agent_app, stream_agent_events, STREAMED_NODE
+    from faq_loader import supported_extensions
+    from corpus_catalog import CorpusCatalog
+    from agent_registry import AgentRegistry, agent_key
+    from response_cache import CachedAgentApp, InMemoryCacheBackend, ResponseCache, SQLiteCacheBackend, corpus_namespace
+    from checkpoint_store import create_checkpointer_from_env
+    from direct_answer import create_direct_answer_policy_from_env
+    from instrumentation import RequestTrace
+    from logging_setup import configure_logging
 except ImportError as e:
     st.error(f"エラー: app.pyから必要な関数をインポートできませんでした。ファイルパスと関数名を確認してください。詳細: {e}")
     st.stop() # インポートに失敗した場合は処理を停止
 
+# ログレベルは環境変数 LOG_LEVEL で変更できます（再実行のたびに呼ばれても、ハンドラーは最初の1回だけ設定されます）
+configure_logging()
+
+# エージェントのグラフ構成（環境変数で切り替え可能）
+# AGENT_PIPELINE=fast でツール選択のLLM呼び出しを省略し、AGENT_FUSE_CLASSIFICATION=1 で分類と関連度評価を統合する
+agent_pipeline = os.getenv("AGENT_PIPELINE", "classic")
+agent_fuse_classification = os.getenv("AGENT_FUSE_CLASSIFICATION", "0") == "1"
+# AGENT_LOCAL_CLASSIFIER_THRESHOLD=0.7 などを指定すると、確信度がその値以上の質問はローカル分類器で分類する（既定は無効）
+agent_local_classifier_threshold = (float(os.environ["AGENT_LOCAL_CLASSIFIER_THRESHOLD"])
+                                    if os.getenv("AGENT_LOCAL_CLASSIFIER_THRESHOLD") else None)
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """全セッションで共有する応答キャッシュを作成します（プロセスごとに1つ）。
+    環境変数 RESPONSE_CACHE_BACKEND=sqlite でSQLiteファイル（RESPONSE_CACHE_PATH）に保存します。
+    """
+    if os.getenv("RESPONSE_CACHE_BACKEND", "memory") == "sqlite":
+        backend = SQLiteCacheBackend(os.getenv("RESPONSE_CACHE_PATH", os.path.join(os.path.dirname(__file__), ".cache", "response_cache.sqlite3")))
+    else:
+        backend = InMemoryCacheBackend()
+    return ResponseCache(backend, similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92")))
+
+@st.cache_resource
+def get_corpus_catalog(doc_dir: str) -> CorpusCatalog:
+    """全セッションで共有するFAQコーパスのカタログを作成します（ディレクトリごとに1つ）。
+    ファイルの一覧・読み込み結果・カテゴリーごとの質問は、ファイルが変更されるまで再実行をまたいで再利用されます。
+    """
+    return CorpusCatalog(doc_dir)
+
+@st.cache_resource
+def get_conversation_store():
+    """全セッションで共有する会話の保存先（LangGraph のチェックポインター）を作成します（プロセスごとに1つ）。
+    セッションごとの会話は thread_id で区別し、各会話は直近の履歴と古いターンの要約だけを保持します。
+    環境変数 CONVERSATION_STORE=sqlite でSQLiteファイル（CONVERSATION_STORE_PATH）に保存します。
+    """
+    return create_checkpointer_from_env()
+
+@st.cache_resource
+def get_direct_answer_policy():
+    """全セッションで共有する最終応答の高速パスのポリシーを作成します（プロセスごとに1つ）。
+    環境変数 DIRECT_ANSWER_POLICY（off / verbatim / template / rephrased）と DIRECT_ANSWER_THRESHOLD で設定します。
+    """
+    return create_direct_answer_policy_from_env()
+
+@st.cache_resource
+def get_agent_registry() -> AgentRegistry:
+    """全セッションで共有するコンパイル済みエージェントのレジストリを作成します（プロセスごとに1つ）。"""
+    return AgentRegistry(max_idle=int(os.getenv("AGENT_REGISTRY_MAX_IDLE", "2")))
+
+# ストリーミング実行中に表示するノードごとの進捗ラベル
+NODE_PROGRESS_LABELS = {
+    "classify_category": "カテゴリー分類",
+    "call_search_tool": "検索の準備",
+    "tool_executor": "FAQ検索",
+    "search_directly": "FAQ検索",
+    "classify_and_search": "カテゴリー分類・FAQ検索",
+    "generate_final_response": "回答生成",
+    "remember_turn": "会話履歴の更新",
+}
+
+# チャット欄に表示する直近のメッセージ数（これより古いメッセージは表示せず、エージェントは会話の要約として引き継ぐ）
+CHAT_DISPLAY_MESSAGES = 40
+
+def render_latency_waterfall(trace: dict):
+    """トレースのスパン（ノード・LLM呼び出し・応答キャッシュ）を、開始時刻と所要時間の横棒グラフで表示します。"""
+    rows = []
+    for position, span in enumerate(trace["spans"]):
+        attributes = span["attributes"]
+        if span["kind"] == "node":
+            label = NODE_PROGRESS_LABELS.get(span["name"], span["name"])
+        elif span["kind"] == "llm":
+            label = f"└ LLM（{NODE_PROGRESS_LABELS.get(attributes.get('node'), attributes.get('node'))}）"
+        else:
+            label = f"応答キャッシュ: {attributes.get('result')}"
+        rows.append({
+            "order": position, "span": f"{position + 1}. {label}", "kind": span["kind"],
+            "start": span["start_ms"], "end": span["start_ms"] + max(span["duration_ms"], 1.0),
+            "duration_ms": round(span["duration_ms"], 1),
+            "tokens": f"{attributes.get('prompt_tokens', '-')} / {attributes.get('completion_tokens', '-')}",
+        })
+    chart = alt.Chart(pd.DataFrame(rows)).mark_bar().encode(
+        x=alt.X("start:Q", title="経過時間 (ms)"),
+        x2="end:Q",
+        y=alt.Y("span:N", sort=alt.SortField("order"), title=None),
+        color=alt.Color("kind:N", legend=None),
+        tooltip=[alt.Tooltip("span:N", title="区間"), alt.Tooltip("duration_ms:Q", title="所要時間 (ms)"),
+                 alt.Tooltip("tokens:N", title="トークン（入力 / 出力）")],
+    ).properties(height=24 * len(rows) + 40)
+    st.markdown("**処理の内訳**")
+    st.altair_chart(chart, use_container_width=True)
+
 # Langchainのメッセージタイプをインポート
 # ★★★ この行が正しく実行される必要があります ★★★
 from langchain_core.messages import HumanMessage, AIMessage
 
-# クリップボードにコピーするJavaScriptコードを埋め込む関数
-def copy_to_clipboard_js(text_to_copy):
-    """クリップボードにテキストをコピーするJavaScriptを実行するHTMLを埋め込みます。"""
-    js_code = f"""
-    <script>
-    navigator.clipboard.writeText({json.dumps(text_to_copy)}).then(function() {{
-        console.log('クリップボードにコピーしました');
-        // 必要であれば、ここでStreamlitにイベントを通知することも可能ですが、今回は単にコピーするだけです。
-        // Streamlit.setComponentValue({{copied: true, text: "{text_to_copy}"}});
-    }}, function(err) {{
-        console.error('クリップボードへのコピーに失敗しました: ', err);
-        alert('クリップボードへのコピーに失敗しました。手動でコピーしてください。');
-    }});
-    </script>
-    """
-    components.html(js_code, height=0, width=0) # UIには表示しない
+def append_chat_message(message):
+    """表示用のチャット履歴にメッセージを追加します。CHAT_DISPLAY_MESSAGES 件を超えた古いメッセージは表示から外し、件数だけを記録します。"""
+    messages = st.session_state.messages
+    messages.append(message)
+    overflow = len(messages) - CHAT_DISPLAY_MESSAGES
+    if overflow > 0:
+        del messages[:overflow]
+        st.session_state.hidden_message_count = st.session_state.get("hidden_message_count", 0) + overflow
+
+def start_new_conversation():
+    """会話の保存先から現在の会話を削除し、新しい会話（thread_id）を開始します。"""
+    thread_id = st.session_state.get("thread_id")
+    if thread_id is not None:
+        get_conversation_store().delete_thread(thread_id)
+    st.session_state.thread_id = uuid.uuid4().hex
+    st.session_state.hidden_message_count = 0
+
+# 質問テンプレート（st.pills）のウィジェットのキー
+TEMPLATE_WIDGET_KEY = "template_question"
+
+def submit_template_question():
+    """質問テンプレートがクリックされたとき、その質問を次の実行でチャットとして送信するよう記録します。"""
+    question = st.session_state.get(TEMPLATE_WIDGET_KEY)
+    if question:
+        st.session_state.pending_question = question
+    st.session_state[TEMPLATE_WIDGET_KEY] = None # 選択状態を解除し、同じ質問を再度クリックできるようにする
 
 # ドキュメント選択のUIを追加
 doc_dir = "doc"
-# Streamlitスクリプトの場所からの相対パスでdocディレクトリ内の.pyファイルをリストアップ
+# Streamlitスクリプトの場所からの相対パスでdocディレクトリ内のFAQファイルをリストアップ
+# 同じ名前で複数形式がある場合（例: .py と変換済みの .parquet）は読み込みの速い形式を使う
 script_dir = os.path.dirname(__file__)
 doc_abs_dir = os.path.join(script_dir, doc_dir)
 
-available_docs = glob.glob(os.path.join(doc_abs_dir, "*.py"))
+corpus_catalog = get_corpus_catalog(doc_abs_dir)
+available_docs = corpus_catalog.files()
 available_doc_names = [os.path.basename(doc) for doc in available_docs]
 
 if not available_doc_names:
-    st.warning(f"'{doc_dir}' ディレクトリに利用可能なドキュメントファイルが見つかりません（.pyファイル）。FAQデータがロードできません。")
+    st.warning(f"'{doc_dir}' ディレクトリに利用可能なドキュメントファイルが見つかりません（{', '.join(supported_extensions())}）。FAQデータがロードできません。")
     st.stop() # ファイルがない場合はアプリを停止
 
 # Streamlitのセッションステートで選択されたドキュメント名を管理
 if "selected_doc_name" not in st.session_state:
     st.session_state.selected_doc_name = available_doc_names[0] # デフォルトで最初に見つかったファイルを選択
 
+# セッションの会話のID（会話の保存先のスレッド）。エージェントは同じIDの呼び出しの間で会話の履歴と要約を引き継ぐ
+if "thread_id" not in st.session_state:
+    start_new_conversation()
+conversation_config = {"configurable": {"thread_id": st.session_state.thread_id}}
+
 # ドキュメント選択用のセレクトボックス
 selected_doc_name = st.selectbox(
     "利用するドキュメントを選択してください:",
@@ -66,68 +183,75 @@ selected_doc_name = st.selectbox(
 # 選択が変更されたかチェック
 if selected_doc_name != st.session_state.selected_doc_name:
     st.session_state.selected_doc_name = selected_doc_name
-    # ドキュメントが変更されたらチャット履歴とコンパイル済みアプリをクリア
+    # ドキュメントが変更されたらチャット履歴と会話の状態をクリアし、共有エージェントへの参照を返却
     st.session_state.messages = []
-    if 'langgraph_app' in st.session_state:
-         del st.session_state.langgraph_app # 古いアプリインスタンスを削除
+    start_new_conversation()
+    if st.session_state.get('agent_lease') is not None:
+         st.session_state.agent_lease.release() # 他のセッションが使っていなければレジストリから破棄される
+         st.session_state.agent_lease = None
     # ドキュメント変更時にチャット入力欄の初期値をクリア
     st.session_state.chat_input_key_counter = 0 # 新しい chat_input のキーカウンターをリセット
     st.rerun() # 変更を適用し、チャットとアプリをクリアして再実行
 
 
 # 選択されたドキュメントのデータをロード
+# 読み込み結果（列指向のFAQストア・カテゴリー・質問テンプレート用の行）はカタログが全セッションで共有し、
+# ファイルの更新時刻とサイズが変わらない限り、再実行のたびに読み込み直さない
 selected_doc_path = os.path.join(doc_abs_dir, st.session_state.selected_doc_name)
-loaded_data_dict = load_faq_data_from_py(selected_doc_path)
+corpus = corpus_catalog.get(selected_doc_path)
 
 # ドキュメントが正常にロードされたか確認し、エージェントアプリを作成
 langgraph_app = None
 agent_identity = "AIアシスタント" # デフォルトのアイデンティティ
 qa_data = [] # FAQデータリストを初期化
+categories = []
+system_prompt = f"あなたは{agent_identity}です。"
 
-if loaded_data_dict:
-    qa_data = loaded_data_dict.get('data', [])
-    # データアイテムに 'カテゴリー' キーが存在する場合のみ抽出
-    categories = list(set(item.get('カテゴリー') for item in qa_data if item.get('カテゴリー')))
+if corpus is not None:
+    qa_data = corpus.store # 各行は辞書と同じように読み取れる FaqRow
+    categories = corpus.categories
     # メタデータからアイデンティティを取得、なければデフォルトを使用
-    agent_identity = loaded_data_dict.get('metadata', {}).get('description', 'AIアシスタント')
+    agent_identity = corpus.identity
 
-    # --- プロンプトのロード (任意：選択可能にする場合は別途UI追加) ---
-    # 現時点では、docディレクトリ内のpromptsサブディレクトリにある default.txt をデフォルトプロンプトとする
-    prompt_dir = os.path.join(doc_abs_dir, "prompts") # docディレクトリ内のpromptsディレクトリを想定
-    default_prompt_path = os.path.join(prompt_dir, "default.txt") # 例：デフォルトプロンプトファイル
+    # docディレクトリ内のpromptsサブディレクトリにある default.txt をシステムプロンプトとする（{agent_identity} を置き換える）
+    # ファイルがない場合は、エージェントのアイデンティティを反映したデフォルトプロンプトを使用する
+    system_prompt = corpus_catalog.system_prompt(agent_identity)
 
-    system_prompt = f"あなたは{agent_identity}です。" # エージェントのアイデンティティを反映したデフォルトプロンプト
+    # コンパイル済みのLangGraphアプリは全セッションで共有するレジストリから借りる
+    # 同じコーパス・システムプロンプト・構成のアプリは、プロセス内で1回だけ作成・コンパイルされる
     try:
-        if os.path.exists(default_prompt_path):
-            with open(default_prompt_path, 'r', encoding='utf-8') as f:
-                # ファイルの内容を読み込み、デフォルトプロンプトとして使用
-                system_prompt = f.read().strip().replace("{agent_identity}", agent_identity) # ファイル内で {agent_identity} を置き換える
-                # print(f"Loaded system prompt from {default_prompt_path}") # デバッグ出力
-        # else:
-            # print(f"Default system prompt file not found at {default_prompt_path}. Using generated default prompt.") # デバッグ出力
+        # FAQファイルの内容ハッシュをキーに、検索インデックスをディスクキャッシュから再利用する
+        index_cache_key = corpus.cache_key
+        direct_answer_policy = get_direct_answer_policy()
+        current_agent_key = agent_key(index_cache_key, system_prompt, pipeline=agent_pipeline,
+                                      fuse_classification=agent_fuse_classification,
+                                      local_classifier_threshold=agent_local_classifier_threshold,
+                                      direct_answer=(direct_answer_policy.mode, direct_answer_policy.threshold))
+        lease = st.session_state.get('agent_lease')
+        if lease is None or lease.key != current_agent_key:
+            if lease is not None:
+                lease.release()
+
+            def build_agent_app():
+                compiled_app = create_agent_app(qa_data, categories, agent_identity, system_prompt,
+                                                index_cache_key=index_cache_key,
+                                                pipeline=agent_pipeline,
+                                                fuse_classification=agent_fuse_classification,
+                                                local_classifier_threshold=agent_local_classifier_threshold,
+                                                checkpointer=get_conversation_store(),
+                                                direct_answer=direct_answer_policy)
+                # 同じコーパス・システムプロンプトでの類似質問には、キャッシュ済みの応答を返す
+                return CachedAgentApp(compiled_app, get_response_cache(), corpus_namespace(index_cache_key, system_prompt))
+
+            st.session_state.agent_lease = get_agent_registry().lease(current_agent_key, build_agent_app)
+        langgraph_app = st.session_state.agent_lease.app
     except Exception as e:
-        print(f"エラー: システムプロンプトファイルの読み込み中にエラーが発生しました: {e}。生成されたデフォルトプロンプトを使用します。")
-        # エラー発生時も生成したデフォルトプロンプトを使用
-        system_prompt = f"あなたは{agent_identity}です。"
-    # ----------------------------------------------------------
-
-    # StreamlitのセッションステートにLangGraphアプリがまだない場合のみ作成・コンパイル
-    # これにより、新しいチャットメッセージが送信される度に再コンパイルされるのを防ぐ
-    if 'langgraph_app' not in st.session_state:
-         try:
-            st.session_state.langgraph_app = create_agent_app(qa_data, categories, agent_identity, system_prompt)
-            # st.success(f"ドキュメント '{st.session_state.selected_doc_name}' に基づいてAIエージェントを準備しました。")
-         except Exception as e:
-            st.error(f"AIエージェントの作成中にエラーが発生しました: {e}")
-            st.session_state.langgraph_app = None # エージェント作成失敗
-
-    # セッションステートからコンパイル済みのアプリインスタンスを取得
-    langgraph_app = st.session_state.get('langgraph_app')
+        st.error(f"AIエージェントの作成中にエラーが発生しました: {e}")
+        langgraph_app = None # エージェント作成失敗
 
 else:
-     st.error(f"選択されたドキュメント '{st.session_state.selected_doc_name}' の読み込みに失敗しました。ファイル形式（'_JSON'で終わる辞書変数を含む.pyファイルで、'data'/'metadata'キーがあること）を確認してください。")
-     st.session_state.langgraph_app = None # データロード失敗時はアプリインスタンスをNoneに
-     langgraph_app = None # ローカル変数もNoneに
+     st.error(f"選択されたドキュメント '{st.session_state.selected_doc_name}' の読み込みに失敗しました。ファイル形式（'data'/'metadata'キーを持つJSON/JSONL/Parquet/Arrowファイル、または'_JSON'で終わる辞書変数を含む.pyファイル）を確認してください。")
+     langgraph_app = None # データロード失敗時はアプリインスタンスをNoneに
 
 
 # サイドバーにドキュメント情報を表示
@@ -147,6 +271,27 @@ with st.sidebar:
         st.markdown(system_prompt)
         st.markdown("```")
 
+    # エージェントが引き継いでいる古い会話の要約（直近の会話からあふれたターン）
+    conversation_summary = langgraph_app.get_state(conversation_config).values.get("summary") if langgraph_app else None
+    if conversation_summary:
+        with st.expander("これまでの会話の要約", expanded=False):
+            st.markdown(conversation_summary)
+
+    # 直前のターンの応答時間（最初のトークンまでの時間 / 全体）
+    last_turn_metrics = st.session_state.get("last_turn_metrics")
+    if last_turn_metrics:
+        st.subheader("⏱️ 直前の応答時間")
+        ttft = last_turn_metrics["ttft"]
+        st.metric("最初のトークンまで (TTFT)", f"{ttft:.2f} 秒" if ttft is not None else "-")
+        st.metric("回答完了まで", f"{last_turn_metrics['total']:.2f} 秒")
+        cache_stats = get_response_cache().stats()
+        st.caption(f"応答キャッシュ: ヒット率 {cache_stats['hit_rate']:.0%}（完全一致 {cache_stats['exact_hits']} / 類似 {cache_stats['similar_hits']} / ミス {cache_stats['misses']}）")
+
+    # 直前のターンのノード・LLM呼び出しごとの所要時間（ウォーターフォール）
+    last_trace = st.session_state.get("last_trace")
+    if last_trace and last_trace["spans"]:
+        render_latency_waterfall(last_trace)
+
     st.markdown("---")  # 区切り線
 
 
@@ -162,51 +307,32 @@ if "messages" not in st.session_state:
 if "chat_input_key_counter" not in st.session_state:
     st.session_state.chat_input_key_counter = 0
 
-# --- 質問テンプレートの表示（カテゴリー非表示、各カテゴリーからランダム1件を縦並びで） ---
+# --- 質問テンプレートの表示（カテゴリー非表示、各カテゴリーからランダム1件） ---
+# すべての質問を1つのネイティブな要素（st.pills）で表示し、クリックされた質問をそのままチャットとして送信する
 if qa_data: # データが正常にロードされた場合のみ表示
     st.subheader("💡 よくある質問")
 
-    # カテゴリーごとに質問をグループ化
-    questions_by_category = {}
-    for item in qa_data: # qa_data はすでにリスト形式
-        category = item.get("カテゴリー", "その他") # カテゴリーがない場合は「その他」に分類
-        question = item.get("質問")
-        if question: # 質問内容が空でない場合のみ追加
-             if category not in questions_by_category:
-                 questions_by_category[category] = []
-             questions_by_category[category].append(question)
-
-    # 各カテゴリーからランダムに1件選択し、ボタンを表示
-    if questions_by_category:
-        for category, questions in questions_by_category.items():
-            if questions:
-                random_question = random.choice(questions)
-                button_key = f"copy_button_{category}_{random_question[:10]}" # ユニークなキーを生成
-
-                # JavaScriptに渡すために質問テキスト内の引用符をエスケープ
-                # f-stringのエラーを避けるため、エスケープ処理は外で行う
-                escaped_question = random_question.replace("'", "\\'").replace('"', '\\"')
-
-                # JavaScriptを使用してクリップボードにコピーするボタン
-                # 幅をフルにするためにdivで囲む
-                copy_button_html = f"""
-                <div style="width: 100%; margin-bottom: 5px;">
-                    <button onclick="navigator.clipboard.writeText('{escaped_question}').then(function() {{
-                        /* クリップボードへのコピー成功 */
-                        console.log('Async: Copying to clipboard was successful!');
-                    }}, function(err) {{
-                        /* クリップボードへのコピー失敗 */
-                        console.error('Async: Could not copy text: ', err);
-                    }});" style="width: 100%; text-align: left; padding: 10px;">{random_question}</button>
-                </div>
-                """
-                st.components.v1.html(copy_button_html, height=45) # heightを少し調整
+    # 各カテゴリーの質問を持つ行（コーパスのバージョンごとに1回だけ集計済み）からランダムに1件ずつ選ぶ
+    # 選んだ質問はセッション内で保持し、質問を送信するかコーパスが変更されたときに選び直す
+    template_version = (corpus.path, corpus.version)
+    template_questions = st.session_state.get("template_questions")
+    if template_questions is None or template_questions[0] != template_version:
+        questions = [random.choice(rows)["質問"] for rows in corpus.question_pools.values() if rows]
+        template_questions = (template_version, list(dict.fromkeys(questions))) # 同じ質問は1つにまとめる
+        st.session_state.template_questions = template_questions
+
+    if template_questions[1]:
+        st.pills("よくある質問", template_questions[1], key=TEMPLATE_WIDGET_KEY, on_change=submit_template_question,
+                 label_visibility="collapsed", disabled=langgraph_app is None)
     else:
         st.info("表示できる質問テンプレートがありません。")
 # ----------------------------------------------------------------------
 
 
-# チャット履歴を表示
+# チャット履歴を表示（表示するのは直近 CHAT_DISPLAY_MESSAGES 件まで）
+hidden_message_count = st.session_state.get("hidden_message_count", 0)
+if hidden_message_count:
+    st.caption(f"以前の {hidden_message_count} 件のメッセージは表示を省略しています（内容は会話の要約として引き継がれています）。")
 for message in st.session_state.messages:
     if isinstance(message, HumanMessage):
         with st.chat_message("user"):
@@ -225,42 +351,75 @@ prompt = st.chat_input(
     disabled=langgraph_app is None
 )
 
-# ユーザー入力（手動またはボタン）があった場合のみ処理を実行
-# ボタンクリック時は prompt は None なので、手動入力があった場合のみここで処理
+# 質問テンプレートがクリックされた場合は、その質問を送信する
+if not prompt and langgraph_app is not None:
+    prompt = st.session_state.pop("pending_question", None)
+
+# ユーザー入力（手動または質問テンプレート）があった場合のみ処理を実行
 if prompt:
     user_input = prompt
     # chat_input_key_counter をインクリメントして入力欄をリセット
     st.session_state.chat_input_key_counter += 1
+    # 次の実行では質問テンプレートを選び直す
+    st.session_state.template_questions = None
 
     # ユーザーメッセージをチャットコンテナに表示
     with st.chat_message("user"):
         st.markdown(user_input)
 
     # ユーザーメッセージを履歴に追加
-    st.session_state.messages.append(HumanMessage(content=user_input))
+    append_chat_message(HumanMessage(content=user_input))
 
-    # LangGraphアプリへの入力形式を準備
+    # LangGraphアプリへの入力形式を準備（過去のターンはチェックポインターが thread_id ごとに保持している）
     inputs = {"messages": [HumanMessage(content=user_input)]}
 
     try:
-        # セッションステートから取得したコンパイル済みのアプリインスタンスを使用
-        final_state = langgraph_app.invoke(inputs)
-
-        # 最終的なAIからのメッセージを状態から抽出
-        # final_state['messages'] の最後の要素が最終応答と想定
-        ai_message = final_state.get('messages', [])[-1] if final_state.get('messages') else AIMessage(content="申し訳ございません、回答を生成できませんでした。")
+        # セッションステートから取得したコンパイル済みのアプリインスタンスをストリーミング実行し、
+        # ノードの進捗を表示しながら最終応答をトークン単位で描画する
+        turn = {"start": time.perf_counter(), "first_token": None, "final_message": None}
+        trace = RequestTrace() # ノード・LLM呼び出しごとの所要時間とトークン数を記録する
 
-        # アシスタントの応答をチャットコンテナに表示
         with st.chat_message("assistant"):
-            st.markdown(ai_message.content)
-
-        # アシスタントの応答を履歴に追加
-        st.session_state.messages.append(ai_message)
+            status = st.status("質問を分析しています...", expanded=False)
+
+            def token_stream():
+                for kind, payload in stream_agent_events(langgraph_app, inputs, {**conversation_config, "callbacks": [trace]}):
+                    if kind == "progress":
+                        status.write(f"✅ {NODE_PROGRESS_LABELS.get(payload, payload)}")
+                        if payload != STREAMED_NODE:
+                            status.update(label=f"{NODE_PROGRESS_LABELS.get(payload, payload)}が完了しました")
+                    elif kind == "token":
+                        if turn["first_token"] is None:
+                            turn["first_token"] = time.perf_counter()
+                            status.update(label="回答を生成しています...")
+                        yield payload
+                    elif kind == "final":
+                        turn["final_message"] = payload
+
+            streamed_text = st.write_stream(token_stream())
+            status.update(label="回答が完了しました", state="complete")
+
+        # 最終的なAIからのメッセージ（ストリーミングした全文）を履歴に追加
+        if turn["final_message"] is not None:
+            ai_message = AIMessage(content=turn["final_message"].content)
+        elif streamed_text:
+            ai_message = AIMessage(content=streamed_text)
+        else:
+            ai_message = AIMessage(content="申し訳ございません、回答を生成できませんでした。")
+        append_chat_message(ai_message)
+
+        # 最初のトークンまでの時間（TTFT）と全体の所要時間を記録し、サイドバーに表示する
+        end = time.perf_counter()
+        st.session_state.last_turn_metrics = {
+            "ttft": (turn["first_token"] - turn["start"]) if turn["first_token"] else None,
+            "total": end - turn["start"],
+        }
+        st.session_state.last_trace = trace.finish()
 
     except Exception as e:
         st.error(f"リクエスト処理中にエラーが発生しました: {e}")
         # エラーメッセージをチャット履歴に追加することも考慮
-        st.session_state.messages.append(AIMessage(content="申し訳ございません、処理中にエラーが発生しました。時間をおいて再度お試しください。"))
+        append_chat_message(AIMessage(content="申し訳ございません、処理中にエラーが発生しました。時間をおいて再度お試しください。"))
 
     # 応答生成後、Streamlitを再実行してUIを更新し、chat_input をリセットする
     st.rerun()